@@ -34,16 +34,43 @@ app = Flask(__name__, static_folder = 'templates/static')
 
 # Allow Cross origin requests
 cors = CORS(app, resources={r"*": {"origins": "*"}})
-cache = Cache(app)
 
 # Configurations
 app.config.from_object('config')
 
+# The cache is configured by CACHE_TYPE and friends of the configuration
+cache = Cache(app)
+
 # Set server side session engine
 server_session = Session(app)
 
 config_ = app.config;
 
+# Sorted list of the segments, kept up to date by watching the folder
+from app.utils.catalog import SegmentCatalog
+catalog = SegmentCatalog(config_["OUTPUT_FOLDER"], config_["VIDEO_CONTAINER"])
+
+# Initialization sections of the fMP4 recordings
+from app.utils.fmp4 import InitSegments
+init_segments = InitSegments(config_["OUTPUT_FOLDER"])
+
+# Segment durations are computed once and kept in memory
+from app.utils.durations import DurationIndex
+duration_index = DurationIndex(config_["OUTPUT_FOLDER"], config_["VIDEO_CONTAINER"], config_["DEFAULT_SEGMENT_DURATION"], init_segments)
+catalog.subscribe(duration_index.invalidate)
+
+# Key frame positions written by the capture next to every segment
+from app.utils.segmentindex import KeyFrameIndex
+keyframe_index = KeyFrameIndex(config_["OUTPUT_FOLDER"], config_["VIDEO_CONTAINER"])
+
+# Low latency parts of the segment the capture is filling
+from app.utils.live import LivePlaylist
+live_playlist = LivePlaylist(config_["OUTPUT_FOLDER"])
+
+# Playlists of the windows somebody is watching
+from app.utils.playlistcache import PlaylistCache
+playlist_cache = PlaylistCache(cache)
+
 # Sample HTTP error handling
 @app.errorhandler(404)
 def not_found(error):
@@ -20,6 +20,8 @@ from flask import Blueprint, request, render_template, \
     flash, g, redirect, url_for, jsonify, send_from_directory, after_this_request, send_file, abort, Response, session
 # Secure filename
 from werkzeug.utils import secure_filename
+# Signed playlist cursors
+from itsdangerous import URLSafeSerializer, BadSignature
 
 # importing os module
 import os
@@ -38,6 +40,14 @@ from math import ceil
 
 # Configuration
 from app import config_ as config
+from app import duration_index
+from app import keyframe_index
+from app.utils.segmentindex import frame_length
+from app import catalog
+from app import live_playlist
+from app import playlist_cache
+from app import init_segments
+from app.utils.fmp4 import FMP4_EXTENSION
 #from app import cache
 #from app import session
 
@@ -54,6 +64,12 @@ from datetime import date
 from time import sleep
 import threading
 
+# Timing
+import time
+
+# Remuxing of the exports
+import subprocess
+
 # Logging 
 import logging
 
@@ -70,22 +86,308 @@ from Crypto.Hash import SHA256
 # Regular expressions
 import re
 
+# Binary search
+import bisect
+
+# URL quoting of the redirects
+from urllib.parse import quote
+
 # Blueprint
 mod_api = Blueprint("api", __name__, url_prefix="/api")
 
+# Signs the playlist cursors handed out by set_timestamp
+cursor_serializer = URLSafeSerializer(config["SECRET_KEY"], salt="playlist-cursor")
+
+# Content types of the recordings
+MIME_TYPES = {
+    "ts": "video/mp2t",
+    "mp4": "video/mp4",
+    "mpeg4": "video/mp4",
+    "mkv": "video/x-matroska",
+    "m4s": "video/iso.segment"
+}
+
+
 
 
 def getListOfTimestamps(config):
-    #print(config["OUTPUT_FOLDER"])
-    tsFiles = os.listdir(config["OUTPUT_FOLDER"])
-    timestamps = []
-    for file in tsFiles:
-        if re.match("[0-9]+\." + config["VIDEO_CONTAINER"], file):
-            timestamp = file.split(".")[0]
-            timestamps.append(int(timestamp))
-    
-    timestamps.sort()
-    return timestamps
+    """
+    Returns the sorted list of segment timestamps from the catalog,
+    the list is shared and must not be modified
+    """
+    return catalog.timestamps()
+
+def media_segments(timestamps_to_add, durations, seek=None):
+    """
+    Returns (duration, byte range, URI) of every media segment of the
+    playlist. With HLS_BYTERANGE the indexed segments are split at the
+    key frames, the segment holding the seek position starts at the last
+    key frame before it
+    """
+    entries = []
+    for i in range(0, len(timestamps_to_add)):
+        timestamp = timestamps_to_add[i]
+        uri = "/api/get_file/" + str(timestamp) + "." + config["VIDEO_CONTAINER"]
+        index = keyframe_index.get(timestamp)
+        ranges = index.ranges() if index else None
+        if not ranges:
+            entries.append((durations[i], None, uri))
+            continue
+        first = 0
+        if seek is not None and i == 0 and catalog.floor(seek) == timestamp:
+            first = index.seek(seek - timestamp)
+        if config["HLS_BYTERANGE"]:
+            for offset, length, duration in ranges[first:]:
+                entries.append((duration, (offset, length), uri))
+        elif first > 0:
+            offset = ranges[first][0]
+            entries.append((sum([r[2] for r in ranges[first:]]), (offset, index.size - offset), uri))
+        else:
+            entries.append((durations[i], None, uri))
+    return entries
+
+def count_entries(timestamps, seek=None):
+    """
+    Number of playlist entries the segments take
+    """
+    if not config["HLS_BYTERANGE"]:
+        return len(timestamps)
+    return len(media_segments(timestamps, [0] * len(timestamps), seek))
+
+def media_sequence(timestamp, seek=None):
+    """
+    Sequence number of the first playlist entry of the segment, the same
+    for every viewer. Consecutive entries differ by one, with HLS_BYTERANGE
+    every segment takes as many numbers as it has entries
+    """
+    timestamps = getListOfTimestamps(config)
+    if not config["HLS_BYTERANGE"]:
+        return catalog.sequence(timestamp, timestamps)
+    # The entries before the seek position are left out
+    skipped = count_entries([timestamp]) - count_entries([timestamp], seek)
+    return catalog.sequence(timestamp, timestamps, count_entries) + skipped
+
+def window_playlist(window, seek=None, start_tag=False):
+    """
+    Renders the playlist of the window of segments. The viewers of the
+    same window share one build, the key changes whenever a segment lands
+    in or leaves the window
+    """
+    sequence = media_sequence(window[0], seek)
+    # A segment landing in a gap changes the last segment or the length
+    key = "playlist:%d:%d:%d:%d:%s:%d" % (window[0], window[-1], len(window), sequence, seek, start_tag)
+    def build():
+        durations = [duration_index.get(timestamp) for timestamp in window]
+        entries = media_segments(window, durations, seek)
+        version = config["M3U8_VERSION"]
+        inits = None
+        if config["VIDEO_CONTAINER"] == FMP4_EXTENSION:
+            # fMP4 segments are not indexed, there is one entry per segment
+            inits = [init_segments.get(timestamp) for timestamp in window]
+            version = max(version, config["FMP4_M3U8_VERSION"])
+        playlist = "#EXTM3U\r\n";
+        playlist += "#EXT-X-DISCONTINUITY\r\n"
+        playlist += "#EXT-X-TARGETDURATION:" + str(ceil(max([entry[0] for entry in entries]))) + "\r\n";
+        playlist += "#EXT-X-VERSION:" + str(version) + "\r\n";
+        playlist += "#EXT-X-MEDIA-SEQUENCE:" + str(sequence) + "\r\n";
+        if start_tag:
+            # Players start at the requested time rather than near the end of the window
+            playlist += "#EXT-X-START:TIME-OFFSET=0\r\n";
+        playlist += "#EXT-X-PROGRAM-DATE-TIME:" + datetime.fromtimestamp(window[0]).isoformat() + "Z\r\n";
+        current_init = None
+        for i in range(0, len(entries)):
+            duration, byterange, uri = entries[i]
+            if inits is not None and inits[i] is not None and inits[i] != current_init:
+                # Every restart of the capture writes a new initialization
+                # section and starts the timestamps over
+                if current_init is not None:
+                    playlist += "#EXT-X-DISCONTINUITY\r\n"
+                playlist += "#EXT-X-MAP:URI=\"" + init_segments.uri(inits[i]) + "\"\r\n"
+                current_init = inits[i]
+            playlist += "#EXTINF:" + ("%.3f" % duration) + ",\r\n";
+            if byterange:
+                playlist += "#EXT-X-BYTERANGE:%d@%d\r\n" % (byterange[1], byterange[0]);
+            playlist += uri + "\r\n";
+        return playlist
+    return playlist_cache.get(key, build)
+
+def export_ranges(start, end):
+    """
+    Returns (path, offset, length) of the bytes of every segment covering
+    [start, end). The first segment starts at the last key frame at or
+    before start, the last one ends at the first key frame after end.
+    Segments without a usable index are taken whole. fMP4 segments are
+    preceded by their initialization section and the export ends where
+    the capture was restarted
+    """
+    timestamps = getListOfTimestamps(config)
+    first = max(catalog.index_after(start, timestamps) - 1, 0)
+    last = bisect.bisect_left(timestamps, end)
+    ranges = []
+    init = None
+    for timestamp in timestamps[first:last]:
+        if timestamp + duration_index.get(timestamp) <= start:
+            continue
+        path = config["OUTPUT_FOLDER"] + "/" + str(timestamp) + "." + config["VIDEO_CONTAINER"]
+        if config["VIDEO_CONTAINER"] == FMP4_EXTENSION:
+            segment_init = init_segments.get(timestamp)
+            if segment_init is None or (init is not None and segment_init != init):
+                break
+            if init is None:
+                init = segment_init
+                ranges.append((init_segments.path(init), 0, None))
+        index = keyframe_index.get(timestamp)
+        if not index or not index.ranges():
+            ranges.append((path, 0, None))
+            continue
+        offset = 0
+        if timestamp < start:
+            offset = index.key_frames[index.seek(start - timestamp)][1]
+        length = index.size - offset
+        position = index.seek(end - timestamp)
+        if position + 1 < len(index.key_frames):
+            length = index.key_frames[position + 1][1] - offset
+        if length > 0:
+            ranges.append((path, offset, length))
+    return ranges
+
+def read_ranges(ranges):
+    """
+    Yields the bytes of the ranges in chunks of EXPORT_CHUNK_SIZE, only
+    one chunk is held in memory at a time
+    """
+    for path, offset, length in ranges:
+        try:
+            with open(path, "rb") as fd:
+                fd.seek(offset)
+                while length is None or length > 0:
+                    size = config["EXPORT_CHUNK_SIZE"] if length is None else min(length, config["EXPORT_CHUNK_SIZE"])
+                    data = fd.read(size)
+                    if not data:
+                        break
+                    if length is not None:
+                        length -= len(data)
+                    yield data
+        except OSError as e:
+            # The cleanup may have removed the segment in the meantime
+            logging.debug("Skipping %s in the export: %s" % (path, str(e)))
+
+def remux_mp4(chunks):
+    """
+    Remuxes the MPEG-TS chunks into a fragmented MP4 with ffmpeg, which
+    needs no seekable output. A thread feeds ffmpeg while the response
+    reads its output. Raises OSError when ffmpeg cannot be started
+    """
+    process = subprocess.Popen([config["FFMPEG"], "-loglevel", "error",
+        "-f", "mpegts", "-i", "pipe:0", "-c", "copy", "-f", "mp4",
+        "-movflags", "frag_keyframe+empty_moov+default_base_moof", "pipe:1"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    def feed():
+        try:
+            for data in chunks:
+                process.stdin.write(data)
+        except (OSError, ValueError):
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+    def generate():
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            while True:
+                data = process.stdout.read(config["EXPORT_CHUNK_SIZE"])
+                if not data:
+                    break
+                yield data
+        finally:
+            # Also reached when the client goes away in the middle
+            process.kill()
+            process.wait()
+            process.stdout.close()
+            feeder.join()
+    return generate()
+
+def live_target_duration(state):
+    """
+    Target duration of the live playlist, the longest published segment
+    """
+    durations = [segment["duration"] for segment in state["segments"] if segment["duration"] is not None]
+    return ceil(max(durations + [config["DEFAULT_SEGMENT_DURATION"]]))
+
+def live_playlist_text(state):
+    """
+    Renders the LL-HLS playlist of the live edge. Parts are listed for the
+    last complete segment and for the one being filled, the next part is
+    announced with the preload hint
+    """
+    segments = state["segments"]
+    part_target = state["part_target"]
+    playlist = "#EXTM3U\r\n";
+    playlist += "#EXT-X-TARGETDURATION:" + str(live_target_duration(state)) + "\r\n";
+    playlist += "#EXT-X-VERSION:" + str(config["LIVE_M3U8_VERSION"]) + "\r\n";
+    playlist += "#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK=" + ("%.3f" % (3 * part_target)) + "\r\n";
+    playlist += "#EXT-X-PART-INF:PART-TARGET=" + ("%.3f" % part_target) + "\r\n";
+    playlist += "#EXT-X-MEDIA-SEQUENCE:" + str(segments[0]["sequence"]) + "\r\n";
+    playlist += "#EXT-X-PROGRAM-DATE-TIME:" + datetime.fromtimestamp(segments[0]["timestamp"]).isoformat() + "Z\r\n";
+    for i in range(0, len(segments)):
+        segment = segments[i]
+        if i >= len(segments) - 2:
+            for index in range(0, len(segment["parts"])):
+                part = segment["parts"][index]
+                playlist += "#EXT-X-PART:DURATION=" + ("%.3f" % part["duration"]);
+                playlist += ",URI=\"/api/get_part/" + str(segment["timestamp"]) + "." + str(index) + ".ts\"";
+                if part["independent"]:
+                    playlist += ",INDEPENDENT=YES";
+                playlist += "\r\n";
+        if segment["duration"] is not None:
+            playlist += "#EXTINF:" + ("%.3f" % segment["duration"]) + ",\r\n";
+            playlist += "/api/get_file/" + str(segment["timestamp"]) + ".ts\r\n";
+    if segments[-1]["duration"] is None:
+        playlist += "#EXT-X-PRELOAD-HINT:TYPE=PART,URI=\"/api/get_part/" + str(segments[-1]["timestamp"]) + "." + str(len(segments[-1]["parts"])) + ".ts\"\r\n";
+    return playlist
+
+def accel_redirect_uri(path):
+    """
+    URI of the file under the internal nginx location, which serves
+    X_ACCEL_REDIRECT_ROOT. None if the file is outside of it
+    """
+    relative = os.path.relpath(os.path.abspath(path), os.path.abspath(config["X_ACCEL_REDIRECT_ROOT"]))
+    if relative == ".." or relative.startswith("../"):
+        return None
+    return config["X_ACCEL_REDIRECT_LOCATION"] + quote(relative)
+
+def send_segment(path):
+    """
+    Sends the segment or the part, both never change once written. Behind
+    nginx the response only carries the headers and nginx sends the file
+    from its internal location with sendfile, answering Range and
+    conditional requests itself. Standalone the file goes out through the
+    WSGI file wrapper with the same Range and ETag support
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return Response(response=None, status=404,  mimetype="plain/text")
+    mimetype = MIME_TYPES.get(path.rsplit(".", 1)[-1], "application/octet-stream")
+    uri = None
+    if request.headers.get("X-Sendfile-Type", None) == "X-Accel-Redirect":
+        uri = accel_redirect_uri(path)
+        if uri is None:
+            logging.critical("%s is outside of X_ACCEL_REDIRECT_ROOT, sending it without nginx" % path)
+    if uri is not None:
+        response = Response(status=200, mimetype=mimetype)
+        response.headers["X-Accel-Redirect"] = uri
+    else:
+        # Same ETag nginx computes for the file
+        etag = "%x-%x" % (int(stat.st_mtime), stat.st_size)
+        response = send_file(path, mimetype=mimetype, conditional=True, etag=etag, max_age=config["SEGMENT_MAX_AGE"])
+    response.cache_control.public = True
+    response.cache_control.max_age = config["SEGMENT_MAX_AGE"]
+    response.cache_control.immutable = True
+    return response
 
 @mod_api.teardown_request
 def teardown(error=None):
@@ -96,14 +398,7 @@ def get_timestamps_info():
     #if not is_valid_session(request, config):
     #    return jsonify({"auth_fail": True}, 403)
     
-    tsFiles = os.listdir(config["OUTPUT_FOLDER"])
-    timestamps = []
-    for file in tsFiles:
-        if re.match("[0-9]+\." + config["VIDEO_CONTAINER"], file):
-            timestamp = file.split(".")[0]
-            timestamps.append(int(timestamp))
-    
-    timestamps.sort()
+    timestamps = getListOfTimestamps(config)
 
     if len(timestamps) > 1:
         return jsonify({
@@ -154,21 +449,179 @@ def set_timestamp(timestamp):
         return jsonify({"auth_fail": False, "result": False, "reason": "Timestamp is out of range"}, 404)
     if timestamp < timestamps[0] or timestamp > timestamps[-1]:
         return jsonify({"auth_fail": False, "result": False, "reason": "Timestamp is out of range"}, 404)
-    session["sequence"] = 0
-    session["last_timestamp"] = timestamp
+    # The playlist URL carries the whole playback state, nothing is
+    # kept on the server
+    cursor = cursor_serializer.dumps([timestamp, int(time.time())])
     return jsonify({
         "auth_fail": False,
-        "result": True
+        "result": True,
+        "playlist": "/api/get_next_m3u8/" + cursor + "/playlist.m3u8"
     }, 200)
 
 @mod_api.route("/get_file/<file>", methods=["GET"])
 def get_file(file):
     #if not re.match("[0-9]+.(ts|mp4|mkv|mpeg4)", file):
     #    return jsonify({"auth_fail": True}, 403)
-    if not re.match("^[0-9]+.(ts|mkv|mp4|mpeg4)$", file):
+    if not re.match("^[0-9]+\.(ts|mkv|mp4|mpeg4|m4s|init\.mp4)$", file):
         return jsonify({"auth_fail": True}, 404)
     filename = config["OUTPUT_FOLDER"] + "/" + file;
-    return send_file(filename, mimetype='video/mp2t');
+    if not os.path.exists(filename) and file.endswith(".ts"):
+        # The complete segment may still be on its way to the disk while
+        # its parts are already there
+        segment = live_playlist.segment(int(file.split(".")[0]))
+        if segment is not None and segment["duration"] is not None:
+            paths = [live_playlist.part_path(segment["timestamp"], index) for index in range(0, len(segment["parts"]))]
+            def generate():
+                for path in paths:
+                    with open(path, "rb") as fd:
+                        yield fd.read()
+            return Response(generate(), status=200, mimetype="video/mp2t")
+    return send_segment(filename)
+
+@mod_api.route("/get_part/<file>", methods=["GET"])
+def get_part(file):
+    """
+    Serves the LL-HLS part, the request for the part announced with the
+    preload hint is held until the capture publishes it
+    """
+    match = re.match("^([0-9]+)\.([0-9]+)\.ts$", file)
+    if not match:
+        return jsonify({"auth_fail": True}, 404)
+    timestamp = int(match.group(1))
+    index = int(match.group(2))
+    def ready(state):
+        segment = live_playlist.segment(timestamp, state)
+        return segment is None or segment["duration"] is not None or len(segment["parts"]) > index
+    state = live_playlist.wait(ready, config["DEFAULT_SEGMENT_DURATION"])
+    filename = live_playlist.part_path(timestamp, index)
+    if state is None:
+        return Response(response=None, status=404,  mimetype="plain/text")
+    return send_segment(filename)
+
+@mod_api.route("/live/playlist.m3u8", methods=["GET"])
+def get_live_m3u8():
+    """
+    LL-HLS playlist of the live edge. With _HLS_msn and _HLS_part the
+    request is held until the playlist contains the given segment or part
+    """
+    msn = request.args.get("_HLS_msn", None, type=int)
+    part = request.args.get("_HLS_part", None, type=int)
+    state = live_playlist.current()
+    if state is None or not state["segments"]:
+        return Response(response=None, status=404,  mimetype="plain/text")
+    if msn is not None:
+        if msn > state["segments"][-1]["sequence"] + 2:
+            return Response(response=None, status=400,  mimetype="plain/text")
+        def ready(state):
+            for segment in reversed(state["segments"]):
+                if segment["sequence"] > msn:
+                    return True
+                if segment["sequence"] == msn:
+                    return segment["duration"] is not None or (part is not None and len(segment["parts"]) > part)
+            return False
+        state = live_playlist.wait(ready, 3 * live_target_duration(state))
+        if state is None:
+            return Response(response=None, status=503,  mimetype="plain/text")
+    elif part is not None:
+        return Response(response=None, status=400,  mimetype="plain/text")
+    return Response(response=live_playlist_text(state), status=200,  mimetype="application/x-mpegurl")
+
+@mod_api.route("/export/<int:start>/<int:end>", methods=["GET"])
+def export(start, end):
+    """
+    Streams the footage between the timestamps as a single download, the
+    segments are concatenated on the fly. MPEG-TS by default, fragmented
+    MP4 with ?format=mp4. fMP4 recordings are exported as they are, as
+    a fragmented MP4
+    """
+    #if not is_valid_session(request, config):
+    #    return jsonify({"auth_fail": True}), 403
+    fmp4 = config["VIDEO_CONTAINER"] == FMP4_EXTENSION
+    output = request.args.get("format", "mp4" if fmp4 else "ts")
+    if output not in ("ts", "mp4"):
+        return jsonify({"auth_fail": False, "result": False, "reason": "Unknown format"}), 400
+    if config["VIDEO_CONTAINER"] != "ts" and not (fmp4 and output == "mp4"):
+        return jsonify({"auth_fail": False, "result": False, "reason": "The recordings cannot be exported in this format"}), 400
+    if end <= start or end - start > config["EXPORT_MAX_DURATION"]:
+        return jsonify({"auth_fail": False, "result": False, "reason": "Invalid time range"}), 400
+    ranges = export_ranges(start, end)
+    if not ranges:
+        return jsonify({"auth_fail": False, "result": False, "reason": "Timestamp is out of range"}), 404
+    chunks = read_ranges(ranges)
+    if output == "mp4" and not fmp4:
+        try:
+            chunks = remux_mp4(chunks)
+        except OSError as e:
+            logging.critical("Cannot start ffmpeg: %s" % str(e))
+            return jsonify({"auth_fail": False, "result": False, "reason": "Remuxing is not available"}), 503
+    response = Response(chunks, status=200, mimetype=MIME_TYPES[output])
+    response.headers["Content-Disposition"] = "attachment; filename=\"export-%d-%d.%s\"" % (start, end, output)
+    # Let nginx pass the chunks on as they come instead of buffering them
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+@mod_api.route("/get_keyframe/<int:timestamp>", methods=["GET"])
+def get_keyframe(timestamp):
+    """
+    Returns the last key frame before the timestamp as a tiny MPEG-TS
+    (PAT, PMT and the frame) for the thumbnails, found with the key frame
+    index without parsing the segment
+    """
+    segment = catalog.floor(timestamp)
+    index = keyframe_index.get(segment) if segment is not None else None
+    if not index or not index.key_frames:
+        return Response(response=None, status=404,  mimetype="plain/text")
+    position = index.seek(timestamp - segment)
+    start = index.key_frames[position][1]
+    if position + 1 < len(index.key_frames):
+        end = index.key_frames[position + 1][1]
+    else:
+        end = index.size
+    filename = config["OUTPUT_FOLDER"] + "/" + str(segment) + "." + config["VIDEO_CONTAINER"]
+    try:
+        with open(filename, "rb") as fd:
+            fd.seek(start)
+            data = fd.read(end - start)
+    except OSError:
+        return Response(response=None, status=404,  mimetype="plain/text")
+    return Response(response=data[0:frame_length(data)], status=200, mimetype="video/mp2t")
+
+@mod_api.route("/get_next_m3u8/<cursor>/playlist.m3u8", methods=["GET"])
+def get_cursor_m3u8(cursor):
+    """
+    Stateless archive playlist. The cursor holds the requested timestamp
+    and the time it was handed out, the window follows the playback from
+    there at the pace of the wall clock. The same URL yields the same
+    playlist on every worker, so it can be cached until the window moves
+    """
+    try:
+        start, issued = cursor_serializer.loads(cursor)
+    except BadSignature:
+        return Response(response=None, status=404,  mimetype="plain/text")
+    timestamps = getListOfTimestamps(config)
+    if len(timestamps) < 1:
+        return Response(response=None, status=404,  mimetype="plain/text")
+    duration_index.discard_older_than(timestamps[0])
+    keyframe_index.discard_older_than(timestamps[0])
+    position = start + time.time() - issued
+    first = max(catalog.index_after(start, timestamps) - 1, 0)
+    current = max(catalog.index_after(position, timestamps) - 1, first)
+    # The segment being played stays in the window
+    window_start = max(first, current - 1)
+    window = timestamps[window_start:window_start + config["MAX_SEGMENTS_PER_HLS"]]
+    # Only the first segment of the playback starts at the seek position
+    seek = start if window_start == first else None
+    playlist = window_playlist(window, seek, True)
+
+    response = Response(response=playlist, status=200,  mimetype="application/x-mpegurl")
+    # The window moves when the playback enters the next segment or, at
+    # the live edge, when a new segment arrives
+    max_age = 1
+    if window_start + len(window) < len(timestamps) and current + 1 < len(timestamps):
+        max_age = max(1, min(int(timestamps[current + 1] - position), config["DEFAULT_SEGMENT_DURATION"]))
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response
 
 @mod_api.route("/get_next_m3u8/playlist.m3u8", methods=["GET"])
 def get_next_m3u8():
@@ -185,12 +638,9 @@ def get_next_m3u8():
             lastTimestamp = int(timestamps[-10])
             newIndex = len(timestamps) - 10
             print("--------------------------------- LAST TIMESTAMP -------------------------------------------------- ")
-        sequence = 0
-        session["sequence"] = sequence
         session["last_timestamp"] = int(lastTimestamp)
     else:
         lastTimestamp = int(session["last_timestamp"])
-        sequence = session["sequence"]
         #timestamps = getListOfTimestamps(config)
 
         if session.get("last_timestamp", None) < timestamps[0] or session.get("last_timestamp", None) > timestamps[-1]:
@@ -198,81 +648,34 @@ def get_next_m3u8():
                 lastTimestamp = int(timestamps[0])
             else:
                 lastTimestamp = int(timestamps[-10])
-            sequence = 0
-            session["sequence"] = sequence
             session["last_timestamp"] = int(lastTimestamp)
         else:
-            l = 0
-            r = len(timestamps) - 1
-            notFound = True
-            newIndex = 0
-            while l < r and notFound:
-                if timestamps[floor((r + l)/2)] <=  lastTimestamp and lastTimestamp < timestamps[floor((r + l)/2) + 1]:
-                    lastTimestamp = timestamps[floor((r + l)/2) + 1]
-                    newIndex = floor((r + l)/2) + 1
-                    notFound = False;
-                    break;
-                if notFound:
-                    if timestamps[floor((r + l)/2)] <  lastTimestamp:
-                        l = floor((r + l) / 2)
-                    else:
-                        r = floor((r + l) / 2)
-            if notFound:
+            newIndex = catalog.index_after(lastTimestamp, timestamps)
+            if newIndex >= len(timestamps):
                 return Response(response=None, status=404,  mimetype="plain/text")
+            lastTimestamp = timestamps[newIndex]
             session["last_timestamp"] = lastTimestamp
 
     print("Building the file list")
-    durations = [];
+    duration_index.discard_older_than(timestamps[0])
+    keyframe_index.discard_older_than(timestamps[0])
     timestampsToAdd = []
     if newIndex + config["MAX_SEGMENTS_PER_HLS"] < len(timestamps):
         print("+++++++++++++++++++++++++++++++++ BUILDING NEW FILE ++++++++++++++++++++++++++++++++++")
-        sequence += min(config["MAX_SEGMENTS_PER_HLS"], len(timestamps));
-        session["sequence"] = sequence
         for idx in range(newIndex, min(newIndex + config["MAX_SEGMENTS_PER_HLS"], newIndex + len(timestamps))):
-            vfile = str(timestamps[idx]) + "." + config["VIDEO_CONTAINER"];
-            vfile_full_path = config["OUTPUT_FOLDER"] + vfile;
-            result=os.popen("".join([config["EXEC_DIR"], "/", config["EXTRACT_DURATION_SCRIPT"], " ", vfile_full_path])).read().strip();
-            durations.append(result);
             timestampsToAdd.append(timestamps[idx])
-
-        max_duration = max(durations);
-        playlist = "#EXTM3U\r\n";
-        playlist += "#EXT-X-DISCONTINUITY\r\n"
-        playlist += "#EXT-X-TARGETDURATION:" + str(max_duration) + "\r\n";
-        playlist += "#EXT-X-VERSION:" + str(config["M3U8_VERSION"]) + "\r\n";
-        playlist += "#EXT-X-MEDIA-SEQUENCE:" + str(sequence) + "\r\n";
-        playlist += "#EXT-X-PROGRAM-DATE-TIME:" + datetime.fromtimestamp(lastTimestamp).isoformat() + "Z\r\n";
-
-        for i in range(0, len(durations)):
-            playlist += "#EXTINF:" + str(durations[i]) + ",\r\n";
-            playlist += "/api/get_file/" + str(timestampsToAdd[i]) + "." + config["VIDEO_CONTAINER"] + "\r\n";
-            session["last_timestamp"] = timestampsToAdd[i]
+        playlist = window_playlist(timestampsToAdd)
+        session["last_timestamp"] = timestampsToAdd[-1]
     else:
         if newIndex > 0:
             newIndex = newIndex - config["MAX_SEGMENTS_PER_HLS"]
         for idx in range(newIndex, min(newIndex + config["MAX_SEGMENTS_PER_HLS"], newIndex + len(timestamps))):
-            vfile = str(timestamps[idx]) + "." + config["VIDEO_CONTAINER"];
-            vfile_full_path = config["OUTPUT_FOLDER"] + vfile;
-            result=os.popen("".join([config["EXEC_DIR"], "/", config["EXTRACT_DURATION_SCRIPT"], " ", vfile_full_path])).read().strip();
-            durations.append(result);
             timestampsToAdd.append(timestamps[idx])
-
-        max_duration = max(durations);
-        playlist = "#EXTM3U\r\n";
-        playlist += "#EXT-X-DISCONTINUITY\r\n"
-        playlist += "#EXT-X-TARGETDURATION:" + str(max_duration) + "\r\n";
-        playlist += "#EXT-X-VERSION:" + str(config["M3U8_VERSION"]) + "\r\n";
-        playlist += "#EXT-X-MEDIA-SEQUENCE:" + str(sequence) + "\r\n";
-        playlist += "#EXT-X-PROGRAM-DATE-TIME:" + datetime.fromtimestamp(lastTimestamp).isoformat() + "Z\r\n";
-
-        for i in range(0, len(durations)):
-            playlist += "#EXTINF:" + str(durations[i]) + ",\r\n";
-            playlist += "/api/get_file/" + str(timestampsToAdd[i]) + "." + config["VIDEO_CONTAINER"] + "\r\n";
-            session["last_timestamp"] = timestampsToAdd[i]
+        playlist = window_playlist(timestampsToAdd)
+        session["last_timestamp"] = timestampsToAdd[-1]
 
     print("=========================================")
     print(playlist)
-    print(session["sequence"])
     print(session["last_timestamp"])
     print("=========================================")
     return Response(response=playlist, status=200,  mimetype="application/x-mpegurl")
@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# OS stuff
+import os
+
+# Regular expressions
+import re
+
+# Binary search
+import bisect
+
+# Sequence anchor
+import json
+
+# Native inotify interface
+import ctypes
+import ctypes.util
+import struct
+
+# Threading stuff
+import threading
+
+# Timing
+import time
+
+# Logging
+import logging
+
+# inotify event masks (see inotify(7))
+IN_CLOSE_WRITE             = 0x00000008
+IN_MOVED_FROM              = 0x00000040
+IN_MOVED_TO                = 0x00000080
+IN_DELETE                  = 0x00000200
+IN_DELETE_SELF             = 0x00000400
+IN_MOVE_SELF               = 0x00000800
+IN_Q_OVERFLOW              = 0x00004000
+IN_CLOEXEC                 = 0o2000000
+
+INOTIFY_EVENT_HEADER       = struct.Struct("iIII")
+INOTIFY_READ_SIZE          = 64 * 1024
+
+# How often the folder is checked when inotify is not available
+POLL_INTERVAL_IN_SECONDS   = 1.0
+
+# Segment whose sequence number the others count from, shared by the workers
+SEQUENCE_ANCHOR_FILE       = ".sequence.json"
+
+class InotifyWatcher():
+    """
+    Minimal inotify binding, yields (mask, name) tuples
+    """
+    def __init__(self, path, mask):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+    def events(self):
+        while True:
+            data = os.read(self.fd, INOTIFY_READ_SIZE)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0").decode("UTF-8", "replace")
+                offset += length
+                yield mask, name
+
+class SegmentCatalog():
+    """
+    Sorted in-memory list of the segment timestamps found in the
+    output folder. The list is never modified in place: writers publish
+    a new list, so request handlers can take a reference and run
+    binary searches over it without locking or copying. The listeners
+    are given the timestamp of every segment which shows up, is replaced
+    or goes away
+    """
+    def __init__(self, folder, extension):
+        self.folder = folder
+        self.extension = extension
+        self.pattern = re.compile("^([0-9]+)\." + re.escape(extension) + "$")
+        self.lock = threading.Lock()
+        self.entries = []
+        self.version = 0
+        self.pid = None
+        self.watching = False
+        self.folder_mtime = None
+        self.checked_at = 0
+        self.listeners = []
+        # (mtime, size) of the segments, kept only without inotify
+        self.signatures = {}
+        self.anchor = None
+        self.anchor_lock = threading.Lock()
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+    def notify(self, timestamps):
+        for timestamp in timestamps:
+            for listener in self.listeners:
+                listener(timestamp)
+    def start(self):
+        """
+        Loads the folder and starts watching it. Called lazily so that
+        every worker process gets its own watcher
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.watching = False
+        try:
+            watcher = InotifyWatcher(self.folder, IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+            self.watching = True
+            threading.Thread(target = self.watch, args = (watcher, ), daemon = True).start()
+        except Exception as e:
+            logging.debug("inotify is not available, falling back to polling: %s" % str(e))
+        self.rescan()
+    def watch(self, watcher):
+        try:
+            for mask, name in watcher.events():
+                if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF):
+                    self.rescan()
+                    if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                        break
+                    continue
+                match = self.pattern.match(name)
+                if not match:
+                    continue
+                if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    self.add(int(match.group(1)))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.remove(int(match.group(1)))
+        except Exception as e:
+            logging.critical("Segment catalog watcher failed: %s" % str(e))
+        # Fall back to polling, the folder might be recreated later
+        self.watching = False
+    def rescan(self):
+        """
+        Lists the whole folder, only done on start and on inotify overflow
+        """
+        timestamps = []
+        signatures = {}
+        try:
+            self.folder_mtime = os.stat(self.folder).st_mtime_ns
+            with os.scandir(self.folder) as it:
+                for entry in it:
+                    match = self.pattern.match(entry.name)
+                    if match:
+                        timestamp = int(match.group(1))
+                        timestamps.append(timestamp)
+                        if not self.watching:
+                            signatures[timestamp] = self.signature(entry.path)
+        except OSError as e:
+            logging.debug("Cannot list %s: %s" % (self.folder, str(e)))
+        timestamps.sort()
+        with self.lock:
+            changed = set(self.entries).symmetric_difference(timestamps)
+            # Without inotify a segment replaced under the same name only
+            # shows in its modification time or size
+            changed.update([timestamp for timestamp, signature in signatures.items()
+                if timestamp in self.signatures and self.signatures[timestamp] != signature])
+            self.signatures = signatures
+            self.entries = timestamps
+            self.version += 1
+        self.notify(changed)
+    def segment_path(self, timestamp):
+        return "".join([self.folder, "/", str(timestamp), ".", self.extension])
+    def signature(self, path):
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+    def check_newest(self):
+        """
+        The newest segment might still be written in place, which does not
+        change the modification time of the folder
+        """
+        timestamps = self.entries
+        if not timestamps:
+            return
+        timestamp = timestamps[-1]
+        signature = self.signature(self.segment_path(timestamp))
+        with self.lock:
+            if self.signatures.get(timestamp, None) == signature:
+                return
+            self.signatures[timestamp] = signature
+        self.notify([timestamp])
+    def add(self, timestamp):
+        with self.lock:
+            index = bisect.bisect_left(self.entries, timestamp)
+            if index == len(self.entries) or self.entries[index] != timestamp:
+                self.entries = self.entries[:index] + [timestamp] + self.entries[index:]
+                self.version += 1
+        # A segment written again is a new segment as well
+        self.notify([timestamp])
+    def remove(self, timestamp):
+        with self.lock:
+            index = bisect.bisect_left(self.entries, timestamp)
+            if index == len(self.entries) or self.entries[index] != timestamp:
+                return
+            self.entries = self.entries[:index] + self.entries[index + 1:]
+            self.version += 1
+        self.notify([timestamp])
+    def refresh(self):
+        if self.pid != os.getpid():
+            self.start()
+        if self.watching:
+            return
+        # Without inotify the folder is re-listed only when its
+        # modification time changes, and at most once per interval
+        now = time.monotonic()
+        if now - self.checked_at < POLL_INTERVAL_IN_SECONDS:
+            return
+        self.checked_at = now
+        try:
+            mtime = os.stat(self.folder).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self.folder_mtime:
+            self.rescan()
+        else:
+            self.check_newest()
+    def timestamps(self):
+        """
+        Returns the current sorted list of timestamps, must not be modified
+        """
+        self.refresh()
+        return self.entries
+    def get_version(self):
+        self.refresh()
+        return self.version
+    def first(self):
+        timestamps = self.timestamps()
+        return timestamps[0] if timestamps else None
+    def last(self):
+        timestamps = self.timestamps()
+        return timestamps[-1] if timestamps else None
+    def step(self):
+        """
+        Distance between the first two segments
+        """
+        timestamps = self.timestamps()
+        if len(timestamps) < 2:
+            return 0
+        return timestamps[1] - timestamps[0]
+    def index_after(self, timestamp, timestamps=None):
+        """
+        Index of the first segment which starts after the timestamp
+        """
+        if timestamps is None:
+            timestamps = self.timestamps()
+        return bisect.bisect_right(timestamps, timestamp)
+    def floor(self, timestamp, timestamps=None):
+        """
+        Segment which contains the timestamp, or None
+        """
+        if timestamps is None:
+            timestamps = self.timestamps()
+        index = bisect.bisect_right(timestamps, timestamp) - 1
+        if index < 0:
+            return None
+        return timestamps[index]
+    def anchor_path(self):
+        return "".join([self.folder, "/", SEQUENCE_ANCHOR_FILE])
+    def load_anchor(self):
+        try:
+            with open(self.anchor_path(), "r") as fd:
+                anchor = json.load(fd)
+            return (int(anchor["timestamp"]), int(anchor["sequence"]))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+    def save_anchor(self, anchor):
+        self.anchor = anchor
+        temporary_path = "".join([self.folder, "/.", SEQUENCE_ANCHOR_FILE, ".%d.tmp" % os.getpid()])
+        try:
+            with open(temporary_path, "w") as fd:
+                json.dump({"timestamp": anchor[0], "sequence": anchor[1]}, fd)
+            os.rename(temporary_path, self.anchor_path())
+        except OSError as e:
+            logging.debug("Cannot save the sequence anchor: %s" % str(e))
+    def sequence(self, timestamp, timestamps, weight=None):
+        """
+        Sequence number of the segment, the same for every worker and on
+        every reload. The numbers count from the anchor segment, each
+        segment takes weight([segment]) numbers or one. The anchor moves
+        forward well before the cleanup reaches it
+        """
+        if weight is None:
+            weight = len
+        with self.anchor_lock:
+            anchor = self.anchor
+            present = lambda anchor: anchor is not None and self.floor(anchor[0], timestamps) == anchor[0]
+            if not present(anchor):
+                # Another worker might have moved it
+                anchor = self.load_anchor() or anchor
+            if anchor is None:
+                anchor = (timestamps[0], 0)
+                self.save_anchor(anchor)
+            elif not present(anchor):
+                # The segment went away before the anchor could move, the
+                # numbers go on roughly where the missing segments left them
+                first = min(self.index_after(anchor[0], timestamps), len(timestamps) - 1)
+                step = (timestamps[-1] - timestamps[0]) / max(1, len(timestamps) - 1) or 1
+                skipped = int(round((timestamps[first] - anchor[0]) / step)) - first
+                anchor = (timestamps[first], anchor[1] + max(1, skipped) + weight(timestamps[:first]))
+                self.save_anchor(anchor)
+            self.anchor = anchor
+            index = bisect.bisect_left(timestamps, anchor[0])
+            if index < len(timestamps) // 4:
+                middle = len(timestamps) // 2
+                anchor = (timestamps[middle], anchor[1] + weight(timestamps[index:middle]))
+                self.save_anchor(anchor)
+                index = middle
+        position = bisect.bisect_left(timestamps, timestamp)
+        if position >= index:
+            return anchor[1] + weight(timestamps[index:position])
+        return anchor[1] - weight(timestamps[position:index])
+    def range(self, start, end):
+        """
+        Segments that start within [start, end]
+        """
+        timestamps = self.timestamps()
+        return timestamps[bisect.bisect_left(timestamps, start):bisect.bisect_right(timestamps, end)]
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# OS stuff
+import os
+
+# Threading stuff
+import threading
+
+# Logging
+import logging
+
+# Fragmented MP4 segments
+from app.utils.fmp4 import FMP4_EXTENSION, read_fmp4_duration
+
+# MPEG-TS constants
+TS_PACKET_SIZE             = 0xBC
+TS_HEADER_SIZE             = 0x4
+SYNC_BYTE                  = 0x47
+
+# Adaptation field types
+TS_PACKET_ADAPTATION_ONLY        = 0x2
+TS_PACKET_ADAPTATION_AND_PAYLOAD = 0x3
+
+# 90 kHz clock used by PTS and PCR base
+CLOCK_RATE                 = 90000
+# PTS and PCR base are 33 bit counters
+PTS_WRAP                   = 1 << 33
+
+# PES stream ids reserved for video elementary streams
+PES_VIDEO_STREAM_ID_MIN    = 0xE0
+PES_VIDEO_STREAM_ID_MAX    = 0xEF
+
+# Only the head and the tail of the segment are parsed
+SCAN_WINDOW_IN_PACKETS     = 1024
+
+def parse_timestamps(data):
+    """
+    Walks over the TS packets in the buffer and collects
+    PTS values of the video PES headers and the PCR values
+    """
+    pts_values = []
+    pcr_values = []
+    offset = 0
+    length = len(data) - (len(data) % TS_PACKET_SIZE)
+    while offset < length:
+        if data[offset] != SYNC_BYTE:
+            offset += 1
+            continue
+        b1 = data[offset + 1]
+        b3 = data[offset + 3]
+        adaptation = (b3 & 0x30) >> 4
+        payload = offset + TS_HEADER_SIZE
+        if adaptation == TS_PACKET_ADAPTATION_ONLY or adaptation == TS_PACKET_ADAPTATION_AND_PAYLOAD:
+            adaptation_length = data[payload]
+            # PCR flag is the fifth bit of the adaptation field flags
+            if adaptation_length >= 7 and (data[payload + 1] & 0x10):
+                p = payload + 2
+                pcr_values.append((data[p] << 25) | (data[p + 1] << 17) | (data[p + 2] << 9) | (data[p + 3] << 1) | (data[p + 4] >> 7))
+            payload += adaptation_length + 1
+        # Only packets with the payload unit start indicator carry PES header
+        if (b1 & 0x40) and payload + 14 <= offset + TS_PACKET_SIZE:
+            if data[payload] == 0x0 and data[payload + 1] == 0x0 and data[payload + 2] == 0x1:
+                stream_id = data[payload + 3]
+                if PES_VIDEO_STREAM_ID_MIN <= stream_id <= PES_VIDEO_STREAM_ID_MAX and (data[payload + 7] & 0x80):
+                    p = payload + 9
+                    pts_values.append(((data[p] & 0x0E) << 29) | (data[p + 1] << 22) | ((data[p + 2] & 0xFE) << 14) | (data[p + 3] << 7) | (data[p + 4] >> 1))
+        offset += TS_PACKET_SIZE
+    return pts_values, pcr_values
+
+def compute_duration(head, tail):
+    """
+    Computes duration of the segment in seconds from the
+    timestamps found in the first and last packets of the file
+    """
+    head_pts, head_pcr = parse_timestamps(head)
+    tail_pts, tail_pcr = parse_timestamps(tail)
+    if head_pts and tail_pts:
+        first = min(head_pts)
+        last = max(tail_pts)
+        # Presentation order differs from decoding order, so the frame
+        # duration is the smallest positive distance between two PTS
+        ordered = sorted(set(tail_pts))
+        frame_duration = 0
+        for i in range(1, len(ordered)):
+            delta = ordered[i] - ordered[i - 1]
+            if delta > 0 and (frame_duration == 0 or delta < frame_duration):
+                frame_duration = delta
+        span = (last - first) % PTS_WRAP
+        return (span + frame_duration) / CLOCK_RATE
+    if head_pcr and tail_pcr:
+        return ((tail_pcr[-1] - head_pcr[0]) % PTS_WRAP) / CLOCK_RATE
+    return None
+
+def read_segment_duration(path):
+    """
+    Reads the head and the tail of the MPEG-TS segment and
+    computes its duration without decoding the whole file
+    """
+    window = SCAN_WINDOW_IN_PACKETS * TS_PACKET_SIZE
+    with open(path, "rb") as fd:
+        size = os.fstat(fd.fileno()).st_size
+        head = fd.read(window)
+        if size <= window:
+            tail = head
+        else:
+            fd.seek(max(window, size - window - (size % TS_PACKET_SIZE)))
+            tail = fd.read()
+    return compute_duration(head, tail)
+
+class DurationIndex():
+    """
+    In-memory index of the segment durations. Every segment is parsed
+    once on first access, afterwards the playlist builder only does
+    a dictionary lookup. Segments do not change once in place, the
+    catalog tells about the ones which are replaced or removed. The
+    timescales of the fMP4 segments come from their initialization
+    sections
+    """
+    def __init__(self, folder, extension, default_duration, init_segments=None):
+        self.folder = folder
+        self.extension = extension
+        self.default_duration = default_duration
+        self.init_segments = init_segments
+        self.durations = {}
+        self.lock = threading.Lock()
+    def path(self, timestamp):
+        return "".join([self.folder, "/", str(timestamp), ".", self.extension])
+    def get(self, timestamp):
+        """
+        Returns the duration of the segment in seconds
+        """
+        with self.lock:
+            if timestamp in self.durations:
+                return self.durations[timestamp]
+        path = self.path(timestamp)
+        try:
+            if self.extension == FMP4_EXTENSION:
+                init = self.init_segments.get(timestamp) if self.init_segments else None
+                duration = read_fmp4_duration(path, self.init_segments.track_info(init)) if init else None
+            else:
+                duration = read_segment_duration(path)
+        except OSError:
+            # Gone already, nothing to remember
+            return self.default_duration
+        except Exception as e:
+            logging.debug("Cannot compute duration of %s: %s" % (path, str(e)))
+            duration = None
+        if not duration:
+            duration = self.default_duration
+        duration = round(duration, 3)
+        with self.lock:
+            self.durations[timestamp] = duration
+        return duration
+    def invalidate(self, timestamp):
+        """
+        Forgets the duration of the segment which was replaced or removed
+        """
+        with self.lock:
+            self.durations.pop(timestamp, None)
+    def discard_older_than(self, timestamp):
+        """
+        Drops entries of the segments which were removed by the cleanup
+        """
+        with self.lock:
+            for key in [key for key in self.durations if key < timestamp]:
+                del self.durations[key]
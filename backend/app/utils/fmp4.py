@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Binary data
+import struct
+
+# Threading stuff
+import threading
+
+# Logging
+import logging
+
+# Initialization sections, see capture/capture.py
+from app.utils.catalog import SegmentCatalog
+
+# Extension of the fragmented MP4 media segments
+FMP4_EXTENSION             = "m4s"
+# The capture writes <timestamp>.init.mp4 whenever ffmpeg starts
+INIT_EXTENSION             = "init.mp4"
+
+BOX_HEADER                 = struct.Struct(">I4s")
+BOX_LARGE_SIZE             = struct.Struct(">Q")
+
+# tfhd flags
+TFHD_BASE_DATA_OFFSET      = 0x000001
+TFHD_SAMPLE_DESCRIPTION    = 0x000002
+TFHD_DEFAULT_DURATION      = 0x000008
+# trun flags
+TRUN_DATA_OFFSET           = 0x000001
+TRUN_FIRST_SAMPLE_FLAGS    = 0x000004
+TRUN_SAMPLE_DURATION       = 0x000100
+TRUN_SAMPLE_SIZE           = 0x000200
+TRUN_SAMPLE_FLAGS          = 0x000400
+TRUN_SAMPLE_CTO            = 0x000800
+
+def boxes(data, offset=0, end=None):
+    """
+    Yields (type, payload offset, end) of the boxes in data[offset:end]
+    """
+    if end is None:
+        end = len(data)
+    while offset + BOX_HEADER.size <= end:
+        size, kind = BOX_HEADER.unpack_from(data, offset)
+        header = BOX_HEADER.size
+        if size == 1:
+            if offset + header + BOX_LARGE_SIZE.size > end:
+                return
+            size = BOX_LARGE_SIZE.unpack_from(data, offset + header)[0]
+            header += BOX_LARGE_SIZE.size
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return
+        yield kind, offset + header, min(offset + size, end)
+        offset += size
+
+def child(data, kind, offset, end):
+    for box, payload, box_end in boxes(data, offset, end):
+        if box == kind:
+            return payload, box_end
+    return None
+
+def parse_init(data):
+    """
+    Returns {track id: [timescale, default sample duration]} of the tracks
+    in the moov box of the initialization section
+    """
+    tracks = {}
+    moov = child(data, b"moov", 0, len(data))
+    if moov is None:
+        return tracks
+    for kind, payload, end in boxes(data, moov[0], moov[1]):
+        if kind == b"trak":
+            tkhd = child(data, b"tkhd", payload, end)
+            mdia = child(data, b"mdia", payload, end)
+            mdhd = child(data, b"mdhd", mdia[0], mdia[1]) if mdia else None
+            if not tkhd or not mdhd:
+                continue
+            track_id = struct.unpack_from(">I", data, tkhd[0] + (20 if data[tkhd[0]] == 1 else 12))[0]
+            timescale = struct.unpack_from(">I", data, mdhd[0] + (20 if data[mdhd[0]] == 1 else 12))[0]
+            tracks.setdefault(track_id, [0, 0])[0] = timescale
+        elif kind == b"mvex":
+            for trex, trex_payload, trex_end in boxes(data, payload, end):
+                if trex == b"trex":
+                    track_id, index, duration = struct.unpack_from(">III", data, trex_payload + 4)
+                    tracks.setdefault(track_id, [0, 0])[1] = duration
+    return tracks
+
+def fragment_durations(data, tracks, totals):
+    """
+    Adds the durations of the samples in the moof box to the totals of
+    their tracks, in the ticks of the track
+    """
+    for kind, payload, end in boxes(data):
+        if kind != b"traf":
+            continue
+        track_id = None
+        default_duration = 0
+        for box, offset, box_end in boxes(data, payload, end):
+            if box == b"tfhd":
+                flags = struct.unpack_from(">I", data, offset)[0] & 0xFFFFFF
+                track_id = struct.unpack_from(">I", data, offset + 4)[0]
+                default_duration = tracks.get(track_id, [0, 0])[1]
+                position = offset + 8
+                if flags & TFHD_BASE_DATA_OFFSET:
+                    position += 8
+                if flags & TFHD_SAMPLE_DESCRIPTION:
+                    position += 4
+                if flags & TFHD_DEFAULT_DURATION:
+                    default_duration = struct.unpack_from(">I", data, position)[0]
+            elif box == b"trun" and track_id is not None:
+                flags = struct.unpack_from(">I", data, offset)[0] & 0xFFFFFF
+                count = struct.unpack_from(">I", data, offset + 4)[0]
+                if not flags & TRUN_SAMPLE_DURATION:
+                    totals[track_id] = totals.get(track_id, 0) + count * default_duration
+                    continue
+                position = offset + 8
+                if flags & TRUN_DATA_OFFSET:
+                    position += 4
+                if flags & TRUN_FIRST_SAMPLE_FLAGS:
+                    position += 4
+                step = 4 * (1 + bool(flags & TRUN_SAMPLE_SIZE) + bool(flags & TRUN_SAMPLE_FLAGS) + bool(flags & TRUN_SAMPLE_CTO))
+                count = min(count, max(0, (box_end - position) // step))
+                totals[track_id] = totals.get(track_id, 0) + sum(
+                    [struct.unpack_from(">I", data, position + i * step)[0] for i in range(0, count)])
+
+def read_fmp4_duration(path, tracks):
+    """
+    Sums the sample durations of the fragments, only the moof boxes are
+    read. Returns the duration of the longest track in seconds or None
+    """
+    totals = {}
+    with open(path, "rb") as fd:
+        while True:
+            header = fd.read(BOX_HEADER.size + BOX_LARGE_SIZE.size)
+            if len(header) < BOX_HEADER.size:
+                break
+            size, kind = BOX_HEADER.unpack_from(header)
+            length = BOX_HEADER.size
+            if size == 1 and len(header) == BOX_HEADER.size + BOX_LARGE_SIZE.size:
+                size = BOX_LARGE_SIZE.unpack_from(header, BOX_HEADER.size)[0]
+                length += BOX_LARGE_SIZE.size
+            if size < length:
+                break
+            fd.seek(length - len(header), 1)
+            if kind == b"moof":
+                fragment_durations(fd.read(size - length), tracks, totals)
+            else:
+                fd.seek(size - length, 1)
+    durations = [ticks / tracks[track_id][0] for track_id, ticks in totals.items()
+        if track_id in tracks and tracks[track_id][0]]
+    return max(durations) if durations else None
+
+class InitSegments():
+    """
+    Initialization sections of the fMP4 recordings, every segment belongs
+    to the last one written before it. The tracks of every section are
+    parsed only once, the sections never change
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.catalog = SegmentCatalog(folder, INIT_EXTENSION)
+        self.tracks = {}
+        self.lock = threading.Lock()
+    def get(self, timestamp):
+        """
+        Returns the timestamp of the section of the segment or None
+        """
+        return self.catalog.floor(timestamp)
+    def path(self, init):
+        return "".join([self.folder, "/", str(init), ".", INIT_EXTENSION])
+    def uri(self, init):
+        return "".join(["/api/get_file/", str(init), ".", INIT_EXTENSION])
+    def track_info(self, init):
+        """
+        Returns {track id: [timescale, default sample duration]}
+        """
+        with self.lock:
+            if init in self.tracks:
+                return self.tracks[init]
+        try:
+            with open(self.path(init), "rb") as fd:
+                tracks = parse_init(fd.read())
+        except Exception as e:
+            logging.debug("Cannot read the initialization section %s: %s" % (str(init), str(e)))
+            tracks = {}
+        with self.lock:
+            self.tracks[init] = tracks
+        return tracks
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# OS stuff
+import os
+
+# State file
+import json
+
+# Threading stuff
+import threading
+
+# Timing
+import time
+
+# Logging
+import logging
+
+# Change notifications
+from app.utils.catalog import InotifyWatcher, IN_MOVED_TO, IN_CLOSE_WRITE, IN_DELETE_SELF, IN_MOVE_SELF
+
+# Folder and state file written by capture_mpegts/livehls.py
+PARTS_FOLDER               = "parts"
+LIVE_STATE_FILE            = "live.json"
+
+# How often the state file is checked when inotify is not available
+POLL_INTERVAL_IN_SECONDS   = 0.1
+
+class LivePlaylist():
+    """
+    Live edge of the MPEG-TS capture: the recent segments and the LL-HLS
+    parts of the one being filled. The state file is re-read only when
+    the capture replaces it, and the requests blocked waiting for a part
+    are woken up right away
+    """
+    def __init__(self, folder):
+        self.folder = "".join([folder, "/", PARTS_FOLDER])
+        self.path = "".join([self.folder, "/", LIVE_STATE_FILE])
+        self.state = None
+        self.signature = None
+        self.condition = threading.Condition()
+        self.pid = None
+        self.watching = False
+    def start(self):
+        """
+        Loads the state and starts watching the folder. Called lazily so
+        that every worker process gets its own watcher
+        """
+        with self.condition:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.watching = False
+        try:
+            watcher = InotifyWatcher(self.folder, IN_MOVED_TO | IN_CLOSE_WRITE | IN_DELETE_SELF | IN_MOVE_SELF)
+            self.watching = True
+            threading.Thread(target = self.watch, args = (watcher, ), daemon = True).start()
+        except Exception as e:
+            logging.debug("inotify is not available, falling back to polling: %s" % str(e))
+        self.reload()
+    def watch(self, watcher):
+        try:
+            for mask, name in watcher.events():
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    break
+                if name == LIVE_STATE_FILE:
+                    self.reload()
+        except Exception as e:
+            logging.critical("Live playlist watcher failed: %s" % str(e))
+        # Fall back to polling, the folder might be recreated later
+        self.watching = False
+    def reload(self):
+        try:
+            # The capture replaces the file, a new inode is a new state
+            stat = os.stat(self.path)
+            signature = (stat.st_ino, stat.st_mtime_ns)
+            if signature == self.signature:
+                return
+            with open(self.path, "r") as fd:
+                state = json.load(fd)
+        except (OSError, ValueError):
+            signature = None
+            state = None
+        with self.condition:
+            self.signature = signature
+            self.state = state
+            self.condition.notify_all()
+    def current(self):
+        """
+        Returns the last published state, None if the capture publishes none
+        """
+        if self.pid != os.getpid():
+            self.start()
+        if not self.watching:
+            self.reload()
+        return self.state
+    def wait(self, ready, timeout):
+        """
+        Blocks until ready(state) holds, returns the state or None when
+        the timeout expires first
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                state = self.current()
+                if state is not None and ready(state):
+                    return state
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                if self.watching:
+                    self.condition.wait(remaining)
+                else:
+                    self.condition.wait(min(remaining, POLL_INTERVAL_IN_SECONDS))
+    def segment(self, timestamp, state=None):
+        """
+        Returns the published segment with the given timestamp or None
+        """
+        if state is None:
+            state = self.current()
+        if state is None:
+            return None
+        for segment in state["segments"]:
+            if segment["timestamp"] == timestamp:
+                return segment
+        return None
+    def part_path(self, timestamp, index):
+        return "".join([self.folder, "/", str(timestamp), ".", str(index), ".ts"])
@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Threading stuff
+import threading
+
+# Requests waiting for a build give up after this and build it themselves
+BUILD_WAIT_IN_SECONDS      = 10
+
+class PlaylistCache():
+    """
+    Rendered playlists shared by the viewers of the same window. The
+    entries live in the Flask-Caching store, so all the workers share
+    them when the store is shared. Concurrent requests for a missing
+    entry wait for a single build within the process
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.building = {}
+    def get(self, key, build):
+        """
+        Returns the cached playlist, builds it with build() if missing
+        """
+        playlist = self.cache.get(key)
+        if playlist is not None:
+            return playlist
+        with self.lock:
+            event = self.building.get(key, None)
+            owner = event is None
+            if owner:
+                event = threading.Event()
+                self.building[key] = event
+        if not owner:
+            event.wait(BUILD_WAIT_IN_SECONDS)
+            playlist = self.cache.get(key)
+            if playlist is not None:
+                return playlist
+            return build()
+        try:
+            playlist = build()
+            self.cache.set(key, playlist)
+            return playlist
+        finally:
+            with self.lock:
+                del self.building[key]
+            event.set()
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Binary data
+import struct
+
+# Threading stuff
+import threading
+
+# Logging
+import logging
+
+# Layout of the <timestamp>.idx file the capture writes next to every
+# segment, see capture_mpegts/segmentindex.py
+INDEX_MAGIC                = b"TSIX"
+INDEX_VERSION              = 0x1
+INDEX_HEADER               = struct.Struct("<4sHHIQ")
+INDEX_ENTRY                = struct.Struct("<QI")
+
+TS_PACKET_SIZE             = 0xBC
+
+# 90 kHz clock used by PTS
+CLOCK_RATE                 = 90000
+# PTS is a 33 bit counter
+PTS_WRAP                   = 1 << 33
+
+class SegmentIndex():
+    """
+    Key frames of a single segment, every key frame is preceded by a PAT
+    and a PMT, so the bytes from its offset on can be played on their own
+    """
+    def __init__(self, size, end_pts, key_frames):
+        self.size = size
+        self.end_pts = end_pts
+        self.key_frames = key_frames
+    def ranges(self):
+        """
+        Splits the segment at the key frames, returns list of (offset,
+        length, duration) tuples. The bytes before the first key frame
+        are not decodable and are left out
+        """
+        ranges = []
+        for i in range(0, len(self.key_frames)):
+            pts, offset = self.key_frames[i]
+            if i + 1 < len(self.key_frames):
+                next_pts, end = self.key_frames[i + 1]
+            else:
+                next_pts, end = self.end_pts, self.size
+            step = (next_pts - pts) % PTS_WRAP
+            # Unknown PTS or a timestamp discontinuity, durations of the
+            # parts cannot be trusted
+            if not pts or not next_pts or step == 0 or step >= PTS_WRAP // 2:
+                return None
+            ranges.append((offset, end - offset, step / CLOCK_RATE))
+        return ranges
+    def seek(self, seconds):
+        """
+        Returns the position of the last key frame at most given number
+        of seconds into the segment
+        """
+        if not self.key_frames:
+            return None
+        first = self.key_frames[0][0]
+        position = 0
+        for i in range(1, len(self.key_frames)):
+            if ((self.key_frames[i][0] - first) % PTS_WRAP) / CLOCK_RATE > seconds:
+                break
+            position = i
+        return position
+
+def frame_length(data):
+    """
+    Length of the PAT, PMT and the key frame at the start of the data,
+    the frame ends where the next PES of the video PID starts
+    """
+    if len(data) < TS_PACKET_SIZE * 3:
+        return len(data) - (len(data) % TS_PACKET_SIZE)
+    video_pid = ((data[TS_PACKET_SIZE * 2 + 1] & 0x1F) << 8) | data[TS_PACKET_SIZE * 2 + 2]
+    for offset in range(TS_PACKET_SIZE * 3, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+        pid = ((data[offset + 1] & 0x1F) << 8) | data[offset + 2]
+        if pid == video_pid and (data[offset + 1] & 0x40):
+            return offset
+    return len(data) - (len(data) % TS_PACKET_SIZE)
+
+def read_index(path):
+    """
+    Reads the key frame index, returns None if the file is not a valid index
+    """
+    with open(path, "rb") as fd:
+        data = fd.read()
+    if len(data) < INDEX_HEADER.size:
+        return None
+    magic, version, entry_size, size, end_pts = INDEX_HEADER.unpack_from(data)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION or entry_size < INDEX_ENTRY.size:
+        return None
+    key_frames = []
+    for offset in range(INDEX_HEADER.size, len(data) - entry_size + 1, entry_size):
+        pts, position = INDEX_ENTRY.unpack_from(data, offset)
+        if position % TS_PACKET_SIZE or position >= size:
+            return None
+        key_frames.append((pts, position))
+    return SegmentIndex(size, end_pts, key_frames)
+
+class KeyFrameIndex():
+    """
+    In-memory cache of the segment indexes. Indexes never change once
+    written, so every one of them is read from the disk only once
+    """
+    def __init__(self, folder, extension):
+        self.folder = folder
+        self.extension = extension
+        self.indexes = {}
+        self.lock = threading.Lock()
+    def path(self, timestamp):
+        return "".join([self.folder, "/", str(timestamp), ".idx"])
+    def get(self, timestamp):
+        """
+        Returns the index of the segment or None if the segment has none
+        """
+        with self.lock:
+            if timestamp in self.indexes:
+                return self.indexes[timestamp]
+        index = None
+        # Offsets are only valid for the segments written by the MPEG-TS
+        # capture, which writes the index before the segment appears
+        if self.extension == "ts":
+            try:
+                index = read_index(self.path(timestamp))
+            except OSError:
+                pass
+            except Exception as e:
+                logging.debug("Cannot read the index of %s: %s" % (str(timestamp), str(e)))
+        with self.lock:
+            self.indexes[timestamp] = index
+        return index
+    def discard_older_than(self, timestamp):
+        """
+        Drops entries of the segments which were removed by the cleanup
+        """
+        with self.lock:
+            for key in [key for key in self.indexes if key < timestamp]:
+                del self.indexes[key]
@@ -25,9 +25,22 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 # Application threads. A common general assumption is
 # using 2 per available processor cores - to handle
 # incoming requests using one and performing background
-# operations using the other.
+# operations using the other. Used as the number of request
+# threads of every worker process, see run.py
 THREADS_PER_PAGE = 10
 
+# Production server, run.py serves the application with gunicorn
+# worker processes when it is installed
+SERVER_HOST = "localhost"
+SERVER_PORT = int(os.environ.get("IPCAM_SERVER_PORT", 5000))
+SERVER_WORKERS = 4
+# Seconds an idle keep-alive connection is kept open
+SERVER_KEEPALIVE = 5
+# Seconds the workers get to finish their requests on reload (SIGHUP)
+SERVER_GRACEFUL_TIMEOUT = 30
+# Blocking live playlist reloads are held for up to three target durations
+SERVER_TIMEOUT = 60
+
 # Enable protection agains *Cross-site Request Forgery (CSRF)*
 CSRF_ENABLED     = True
 
@@ -52,7 +65,8 @@ SERVER_NONCE = "RabroyllIjhywofuckcorwojnamvowAg"
 
 MAX_CONTENT_PATH = 30*1024*1024;
 
-OUTPUT_FOLDER = "/opt/data2/ipcam/storage/192.168.1.21/video1/"
+# Must be below X_ACCEL_REDIRECT_ROOT when the segments are sent by nginx
+OUTPUT_FOLDER = os.environ.get("IPCAM_OUTPUT_FOLDER", "/opt/data2/ipcam/storage/192.168.1.21/video1/")
 
 USER = "admin"
 
@@ -62,10 +76,50 @@ PASSWORD = "a696afa681056ae310944b72384726053306dad3ff4a8a4aa5a27f85e856af92" #H
 
 MAX_SEGMENTS_PER_HLS = 10
 
+# "ts" for the MPEG-TS recordings, "m4s" for the fragmented MP4 ones
+# (RECORDING_FORMAT "fmp4" of capture/config.py)
 VIDEO_CONTAINER = "ts"
 
-EXTRACT_DURATION_SCRIPT = "compute_duration.sh"
-
-EXEC_DIR = "."
+# Used when the duration cannot be extracted from the segment timestamps
+DEFAULT_SEGMENT_DURATION = 10
 
 M3U8_VERSION = 0x4
+
+# fMP4 segments with EXT-X-MAP need at least version 7
+FMP4_M3U8_VERSION = 0x7
+
+# Split the segments at the key frames with EXT-X-BYTERANGE, needs the
+# key frame index of the capture and M3U8_VERSION of at least 4
+HLS_BYTERANGE = False
+
+# The low latency live playlist is served from OUTPUT_FOLDER/parts, which
+# the MPEG-TS capture fills only with LLHLS on for the camera recording to
+# OUTPUT_FOLDER. Without it the player falls back to the segment playlist.
+# Version of the low latency live playlist, EXT-X-PART needs at least 6
+LIVE_M3U8_VERSION = 9
+
+# Internal nginx location, used when nginx asks for X-Accel-Redirect with
+# the X-Sendfile-Type header. The location aliases X_ACCEL_REDIRECT_ROOT,
+# the storage of all the cameras (see streaming/default), the redirects
+# carry the path of the file relative to it
+X_ACCEL_REDIRECT_LOCATION = "/segments/"
+X_ACCEL_REDIRECT_ROOT = os.environ.get("IPCAM_STORAGE_ROOT", "/opt/data2/ipcam/storage/")
+
+# Segments and parts never change once written, clients may cache them
+SEGMENT_MAX_AGE = 365 * 24 * 3600
+
+# Rendered playlists are cached per worker: SimpleCache lives in the
+# memory of each gunicorn worker (SERVER_WORKERS), so the viewers of a
+# window share one build per worker, not one in total. A shared
+# Flask-Caching store (e.g. CACHE_TYPE = "RedisCache" with
+# CACHE_REDIS_URL) makes all the workers share the builds
+CACHE_TYPE = "SimpleCache"
+CACHE_DEFAULT_TIMEOUT = 300
+CACHE_THRESHOLD = 1000
+
+# Exports stream the footage in chunks of this many bytes
+EXPORT_CHUNK_SIZE = 1024 * 1024
+# Longest time range of a single export in seconds
+EXPORT_MAX_DURATION = 24 * 3600
+# Remuxes the exports requested as MP4
+FFMPEG = "/usr/bin/ffmpeg"
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measures the throughput and the latency of the playlist and segment
+# requests. Fills a temporary folder with synthetic segments, starts
+# run.py on it (unless --url points to a running server) and lets a
+# number of clients with keep-alive connections hammer the endpoints.
+#
+# Usage: python3 loadtest.py [--clients 32] [--duration 10] [--segments 360]
+#            [--segment-size 1048576] [--url http://localhost:5000]
+
+# System libraries
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+# HTTP client
+import http.client
+from urllib.parse import urlsplit
+
+TS_PACKET_SIZE             = 0xBC
+SEGMENT_STEP_IN_SECONDS    = 10
+LOCAL_PORT                 = 5055
+
+def create_segments(folder, count, size):
+    """
+    Writes count segments of null packets, one every SEGMENT_STEP_IN_SECONDS
+    seconds, ending now. Returns their timestamps
+    """
+    packet = bytes([0x47, 0x1F, 0xFF, 0x10]) + bytes(TS_PACKET_SIZE - 4)
+    data = packet * max(1, size // TS_PACKET_SIZE)
+    now = int(time.time())
+    timestamps = [now - (count - i) * SEGMENT_STEP_IN_SECONDS for i in range(0, count)]
+    for timestamp in timestamps:
+        with open(os.path.join(folder, "%d.ts" % timestamp), "wb") as fd:
+            fd.write(data)
+    return timestamps
+
+def start_server(folder):
+    env = dict(os.environ)
+    env["IPCAM_OUTPUT_FOLDER"] = folder
+    env["IPCAM_SERVER_PORT"] = str(LOCAL_PORT)
+    server = subprocess.Popen([sys.executable, "run.py"], env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection("localhost", LOCAL_PORT, timeout=1)
+            connection.request("POST", "/api/get_step/")
+            connection.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("The server did not start")
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run_scenario(url, clients, duration, paths):
+    """
+    Every client requests random paths over its own keep-alive
+    connection until the time is up
+    """
+    parts = urlsplit(url)
+    latencies = []
+    counters = {"bytes": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.time() + duration
+    def client():
+        connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        local_latencies = []
+        received = 0
+        errors = 0
+        while time.time() < deadline:
+            start = time.perf_counter()
+            try:
+                connection.request("GET", random.choice(paths))
+                response = connection.getresponse()
+                received += len(response.read())
+                if response.status != 200:
+                    errors += 1
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                connection.close()
+                connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+                continue
+            local_latencies.append(time.perf_counter() - start)
+        connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            counters["bytes"] += received
+            counters["errors"] += errors
+    threads = [threading.Thread(target=client) for i in range(0, clients)]
+    began = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - began
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": counters["errors"],
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "megabytes_per_second": round(counters["bytes"] / elapsed / 1000000, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2)
+    }
+
+def playlist_path(url, timestamp):
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+    connection.request("POST", "/api/set_timestamp/%d" % timestamp)
+    result = json.loads(connection.getresponse().read())
+    connection.close()
+    return result[0]["playlist"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the playlist and segment endpoints")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per scenario")
+    parser.add_argument("--segments", type=int, default=360)
+    parser.add_argument("--segment-size", type=int, default=1024 * 1024, help="Bytes")
+    parser.add_argument("--url", default=None, help="Running server, its OUTPUT_FOLDER must hold the segments")
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="ipcam-loadtest-")
+    server = None
+    try:
+        timestamps = create_segments(folder, args.segments, args.segment_size)
+        url = args.url
+        if url is None:
+            server = start_server(folder)
+            url = "http://localhost:%d" % LOCAL_PORT
+        # Viewers of the same moment share the playlist, archive viewers do not
+        shared = playlist_path(url, timestamps[len(timestamps) // 2])
+        scattered = [playlist_path(url, random.choice(timestamps)) for i in range(0, args.clients)]
+        segments = ["/api/get_file/%d.ts" % timestamp for timestamp in timestamps]
+        scenarios = [
+            ("shared playlist", [shared]),
+            ("scattered playlists", scattered),
+            ("legacy playlist", ["/api/get_next_m3u8/playlist.m3u8"]),
+            ("segments", segments)
+        ]
+        for name, paths in scenarios:
+            result = run_scenario(url, args.clients, args.duration, paths)
+            print("%-20s %8d requests %6d errors %10.1f req/s %8.1f MB/s  p50 %8.2f ms  p99 %8.2f ms" % (
+                name, result["requests"], result["errors"], result["requests_per_second"],
+                result["megabytes_per_second"], result["p50_ms"], result["p99_ms"]))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(folder, ignore_errors=True)
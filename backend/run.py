@@ -23,6 +23,42 @@ __maintainer__ = "Dmitriy Kuptsov"
 __email__ = "dmitriy.kuptsov@gmail.com"
 __status__ = "development"
 
-# Run a test server.
+# The application is loaded once, the worker processes are forked from it
 from app import app
-app.run(host="localhost", port=5000, debug=False)
+from app import config_ as config
+
+def serve():
+    """
+    Serves the application with gunicorn: SERVER_WORKERS processes with
+    THREADS_PER_PAGE request threads each. SIGHUP replaces the workers
+    gracefully, SIGTERM lets the running requests finish. Falls back to
+    the threaded development server when gunicorn is not installed
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        app.run(host=config["SERVER_HOST"], port=config["SERVER_PORT"], debug=False, threaded=True)
+        return
+
+    class Server(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": "%s:%d" % (config["SERVER_HOST"], config["SERVER_PORT"]),
+                "workers": config["SERVER_WORKERS"],
+                # Threads keep serving segments while others wait on the blocking reloads
+                "worker_class": "gthread",
+                "threads": config["THREADS_PER_PAGE"],
+                "keepalive": config["SERVER_KEEPALIVE"],
+                "graceful_timeout": config["SERVER_GRACEFUL_TIMEOUT"],
+                "timeout": config["SERVER_TIMEOUT"],
+                "preload_app": True
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+        def load(self):
+            return app
+
+    Server().run()
+
+if __name__ == "__main__":
+    serve()
@@ -1,4 +1,4 @@
-#!/bin/bash
+#!/usr/bin/python3
 
 # Copyright (C) 2019 strangebit
 
@@ -15,4 +15,22 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-ffmpeg -i "$1" 2>&1 | grep -Pi "Duration" | awk -F: '/Duration:/{print $2*3600+$3*60+$4}';
\ No newline at end of file
+# The application reads its configuration on import, so the tests point it
+# to a temporary folder before any of them imports the app package
+
+# System libraries
+import os
+import sys
+import tempfile
+
+BACKEND_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_FOLDER not in sys.path:
+    sys.path.insert(0, BACKEND_FOLDER)
+
+OUTPUT_FOLDER = tempfile.mkdtemp(prefix="ipcam-tests-")
+
+import config
+config.OUTPUT_FOLDER = OUTPUT_FOLDER
+config.SESSION_FILE_DIR = os.path.join(OUTPUT_FOLDER, ".sessions")
+config.MAX_SEGMENTS_PER_HLS = 3
+config.HLS_BYTERANGE = False
@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Unit tests
+import os
+import struct
+import tempfile
+import unittest
+
+import tests
+from app.utils.fmp4 import boxes, parse_init, read_fmp4_duration, TFHD_DEFAULT_DURATION, \
+    TRUN_DATA_OFFSET, TRUN_SAMPLE_DURATION, TRUN_SAMPLE_SIZE
+
+def box(kind, payload):
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+def full_box(kind, payload, version=0, flags=0):
+    return box(kind, struct.pack(">I", (version << 24) | flags) + payload)
+
+def init_section(timescale, default_duration):
+    """
+    Initialization section with a single track number 1
+    """
+    tkhd = full_box(b"tkhd", struct.pack(">III", 0, 0, 1) + bytes(68))
+    mdhd = full_box(b"mdhd", struct.pack(">IIII", 0, 0, timescale, 0) + bytes(4))
+    trak = box(b"trak", tkhd + box(b"mdia", mdhd))
+    trex = full_box(b"trex", struct.pack(">IIIII", 1, 1, default_duration, 0, 0))
+    return box(b"ftyp", b"iso6") + box(b"moov", box(b"mvhd", bytes(100)) + trak + box(b"mvex", trex))
+
+def fragment(durations=None, count=0, default_duration=None):
+    """
+    Fragment of track 1 with the given sample durations, or count samples
+    of the default duration
+    """
+    tfhd_flags = 0
+    tfhd = struct.pack(">I", 1)
+    if default_duration is not None:
+        tfhd_flags |= TFHD_DEFAULT_DURATION
+        tfhd += struct.pack(">I", default_duration)
+    if durations is None:
+        trun = full_box(b"trun", struct.pack(">Ii", count, 0), flags=TRUN_DATA_OFFSET)
+    else:
+        samples = b"".join([struct.pack(">II", duration, 10) for duration in durations])
+        trun = full_box(b"trun", struct.pack(">Ii", len(durations), 0) + samples,
+            flags=TRUN_DATA_OFFSET | TRUN_SAMPLE_DURATION | TRUN_SAMPLE_SIZE)
+    traf = box(b"traf", full_box(b"tfhd", tfhd, flags=tfhd_flags) + trun)
+    return box(b"moof", box(b"mfhd", bytes(8)) + traf) + box(b"mdat", bytes(64))
+
+class Fmp4Test(unittest.TestCase):
+    def write(self, data):
+        fd, path = tempfile.mkstemp(suffix=".m4s")
+        with os.fdopen(fd, "wb") as output:
+            output.write(data)
+        self.addCleanup(os.remove, path)
+        return path
+    def test_boxes(self):
+        data = box(b"aaaa", b"12") + box(b"bbbb", b"")
+        self.assertEqual(list(boxes(data)), [(b"aaaa", 8, 10), (b"bbbb", 18, 18)])
+    def test_truncated_box_stops_the_walk(self):
+        data = box(b"aaaa", b"") + struct.pack(">I4s", 4, b"bbbb")
+        self.assertEqual([kind for kind, payload, end in boxes(data)], [b"aaaa"])
+    def test_parse_init(self):
+        self.assertEqual(parse_init(init_section(90000, 3000)), {1: [90000, 3000]})
+        self.assertEqual(parse_init(box(b"ftyp", b"iso6")), {})
+    def test_sample_durations(self):
+        tracks = parse_init(init_section(90000, 3000))
+        path = self.write(fragment([3600] * 125) + fragment([3600] * 125))
+        self.assertAlmostEqual(read_fmp4_duration(path, tracks), 10.0)
+    def test_default_durations(self):
+        tracks = parse_init(init_section(1000, 40))
+        # The trex default, then the one of the fragment
+        path = self.write(fragment(count=50) + fragment(count=25, default_duration=80))
+        self.assertAlmostEqual(read_fmp4_duration(path, tracks), 4.0)
+    def test_unknown_track(self):
+        path = self.write(fragment([3600] * 10))
+        self.assertIsNone(read_fmp4_duration(path, {}))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Unit tests
+import os
+import re
+import unittest
+
+from tests import OUTPUT_FOLDER
+from app import app, catalog
+from app.utils.catalog import SEQUENCE_ANCHOR_FILE
+from app.api.controllers import window_playlist
+
+# Segment of null packets, the durations fall back to the default
+SEGMENT = (bytes([0x47, 0x1F, 0xFF, 0x10]) + bytes(0xBC - 4)) * 4
+
+def write_segment(timestamp):
+    path = os.path.join(OUTPUT_FOLDER, "%d.ts" % timestamp)
+    with open(path, "wb") as fd:
+        fd.write(SEGMENT)
+
+def numbers(playlist):
+    """
+    Returns {segment URI: media sequence number} of the playlist
+    """
+    sequence = int(re.search(r"#EXT-X-MEDIA-SEQUENCE:([0-9]+)", playlist).group(1))
+    uris = re.findall(r"^/api/get_file/[^\r\n]+", playlist, re.M)
+    return dict([(uri, sequence + i) for i, uri in enumerate(uris)])
+
+class WindowPlaylistTest(unittest.TestCase):
+    def setUp(self):
+        for name in os.listdir(OUTPUT_FOLDER):
+            if not name.startswith("."):
+                os.remove(os.path.join(OUTPUT_FOLDER, name))
+        try:
+            os.remove(os.path.join(OUTPUT_FOLDER, SEQUENCE_ANCHOR_FILE))
+        except OSError:
+            pass
+        # Segments ten seconds apart give or take the key frame positions
+        self.timestamps = [1700000000 + i * 10 + (i % 3) for i in range(0, 12)]
+        for timestamp in self.timestamps:
+            write_segment(timestamp)
+        catalog.rescan()
+        catalog.anchor = None
+        self.context = app.app_context()
+        self.context.push()
+    def tearDown(self):
+        self.context.pop()
+    def assertConsistent(self, playlists):
+        seen = {}
+        for playlist in playlists:
+            for uri, number in numbers(playlist).items():
+                self.assertEqual(seen.setdefault(uri, number), number, uri)
+        return seen
+    def test_reloads_keep_the_numbers(self):
+        timestamps = catalog.timestamps()
+        playlists = [window_playlist(timestamps[i:i + 3]) for i in range(0, 6)]
+        seen = self.assertConsistent(playlists)
+        ordered = [seen["/api/get_file/%d.ts" % timestamp] for timestamp in timestamps[0:8]]
+        self.assertEqual(ordered, list(range(ordered[0], ordered[0] + 8)))
+    def test_numbers_survive_the_cleanup_and_other_workers(self):
+        timestamps = catalog.timestamps()
+        before = window_playlist(timestamps[8:11])
+        # The cleanup removes the oldest half, a worker starts with a fresh catalog
+        for timestamp in self.timestamps[0:6]:
+            os.remove(os.path.join(OUTPUT_FOLDER, "%d.ts" % timestamp))
+        catalog.rescan()
+        catalog.anchor = None
+        after = window_playlist(catalog.timestamps()[2:5])
+        self.assertConsistent([before, after])
+    def test_segment_filling_a_gap_is_listed(self):
+        os.remove(os.path.join(OUTPUT_FOLDER, "%d.ts" % self.timestamps[1]))
+        catalog.rescan()
+        first = window_playlist(catalog.timestamps()[0:3])
+        self.assertNotIn("%d.ts" % self.timestamps[1], first)
+        write_segment(self.timestamps[1])
+        catalog.rescan()
+        second = window_playlist(catalog.timestamps()[0:3])
+        self.assertIn("%d.ts" % self.timestamps[1], second)
+
+if __name__ == "__main__":
+    unittest.main()
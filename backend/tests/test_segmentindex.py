@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Unit tests
+import os
+import importlib.util
+import tempfile
+import unittest
+
+import tests
+from app.utils.segmentindex import read_index, CLOCK_RATE, PTS_WRAP, TS_PACKET_SIZE
+
+# The index is written by capture_mpegts/segmentindex.py
+spec = importlib.util.spec_from_file_location("capture_segmentindex",
+    os.path.join(tests.BACKEND_FOLDER, "..", "capture_mpegts", "segmentindex.py"))
+capture_segmentindex = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(capture_segmentindex)
+
+class SegmentIndexTest(unittest.TestCase):
+    def write(self, data):
+        fd, path = tempfile.mkstemp(suffix=".idx")
+        with os.fdopen(fd, "wb") as output:
+            output.write(data)
+        self.addCleanup(os.remove, path)
+        return path
+    def test_round_trip(self):
+        key_frames = [(90000, 0), (180000, TS_PACKET_SIZE * 100), (270000, TS_PACKET_SIZE * 250)]
+        size = TS_PACKET_SIZE * 400
+        index = read_index(self.write(capture_segmentindex.pack_index(size, 360000, key_frames)))
+        self.assertEqual(index.size, size)
+        self.assertEqual(index.key_frames, key_frames)
+        self.assertEqual(index.ranges(), [
+            (0, TS_PACKET_SIZE * 100, 1.0),
+            (TS_PACKET_SIZE * 100, TS_PACKET_SIZE * 150, 1.0),
+            (TS_PACKET_SIZE * 250, TS_PACKET_SIZE * 150, 1.0)])
+        self.assertEqual(index.seek(0.5), 0)
+        self.assertEqual(index.seek(1.5), 1)
+        self.assertEqual(index.seek(10), 2)
+    def test_pts_wrap(self):
+        key_frames = [(PTS_WRAP - CLOCK_RATE, 0), (CLOCK_RATE, TS_PACKET_SIZE * 10)]
+        index = read_index(self.write(capture_segmentindex.pack_index(TS_PACKET_SIZE * 20, CLOCK_RATE * 2, key_frames)))
+        self.assertEqual([duration for offset, length, duration in index.ranges()], [2.0, 1.0])
+    def test_unknown_end_is_not_split(self):
+        key_frames = [(90000, 0)]
+        index = read_index(self.write(capture_segmentindex.pack_index(TS_PACKET_SIZE * 20,
+            capture_segmentindex.NO_PTS, key_frames)))
+        self.assertIsNone(index.ranges())
+    def test_invalid_index(self):
+        self.assertIsNone(read_index(self.write(b"XXXX" + bytes(32))))
+        # Offsets must be on packet boundaries within the segment
+        data = capture_segmentindex.pack_index(TS_PACKET_SIZE * 20, 180000, [(90000, 5)])
+        self.assertIsNone(read_index(self.write(data)))
+
+if __name__ == "__main__":
+    unittest.main()
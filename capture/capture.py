@@ -54,6 +54,14 @@ import subprocess
 # Datetime stuff
 from datetime import datetime
 
+# Retention of the recordings, shared with capture_mpegts. Deployed next
+# to this file, found in ../common when run from the source tree
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+from retention import RetentionPolicy
+
+# MP4 to MPEG-TS conversion
+from converter import SegmentConverter
+
 # Configure logging to console and file
 logging.basicConfig(
 	level=logging.DEBUG,
@@ -64,32 +72,21 @@ logging.basicConfig(
 	]
 );
 
-def convertMp4ToMPEGTS():
-    """
-    Converts the MP4 files to MPEGTS stream files
-    """
-    while True:
-        try:
-            print("1!!!11111!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-            files = os.listdir(config["OUTPUT_FOLDER"])
-            files.sort()
-            for file in files:
-                if re.match("[0-9]+\.mp4", file):
-                    timestamp = int(file.split(".")[0])
-                    #subprocess.run(["ffmpeg", "-i", file, "-vcodec", "copy", "-vbsf", "h264_mp4toannexb", "-acodec", "copy", str(timestamp) + ".ts"])
-                    #subprocess.run(["rm", file])
-                    iff = config["OUTPUT_FOLDER"] + file;
-                    off = config["OUTPUT_FOLDER"] + str(timestamp) + ".ts";
-                    logging.debug("------------------------- Converting the file -------------------------------")
-                    if not os.path.exists(off):
-                        result=os.popen(" ".join(["ffmpeg", "-i", iff, "-vcodec", "copy", "-vbsf", "h264_mp4toannexb", "-acodec", "copy", off])).read().strip();
-                    else:
-                        result=os.popen(" ".join(["rm", iff])).read().strip();
-        except Exception as e:
-            logging.critical("Exception occured while converting the file")
-            logging.critical(e);
-            traceback.print_exc()
-        sleep(1)
+# Recordings of the camera, the converter reports the segments ffmpeg
+# finishes and the files of the conversion
+retention_policy = RetentionPolicy(os.path.normpath(config["OUTPUT_FOLDER"]),
+    int(config["MAX_VIDEO_LIFETIME"]),
+    int(config["MAX_STORAGE_BYTES"]),
+    int(config["RETENTION_BUCKET_SECONDS"]),
+    int(config["MIN_FREE_BYTES"]))
+
+converter = SegmentConverter(os.path.normpath(config["OUTPUT_FOLDER"]),
+    config["CONVERT_PROCESSES"],
+    config["CONVERT_QUEUE"],
+    os.path.join(config["OUTPUT_FOLDER"], config["CONVERT_STATE_FILE"]),
+    config["CONVERT_MAX_ATTEMPTS"],
+    retention_policy.add,
+    retention_policy.discard)
 
 def capturing(config):
     """
@@ -100,20 +97,53 @@ def capturing(config):
         folder = config["OUTPUT_FOLDER"]
         if not os.path.exists(config["OUTPUT_FOLDER"]):
             os.makedirs(folder)
+        # A full volume is the usual reason for ffmpeg to give up
+        retention_policy.reclaim(int(datetime.now().timestamp()))
         try:
-            subprocess.run(["ffmpeg", \
-                    "-i", \
-                    config["RTSP_URL"], \
-                    "-rtsp_transport", \
-                    config["TRANSPORT_PROTOCOL"], \
-                    "-vcodec", "copy", \
-                    "-acodec", "copy", \
+            if config["RECORDING_FORMAT"] == "fmp4":
+                output = [ \
+                    "-f", "hls", \
+                    "-hls_time", str(config["SEGMENT_DURATION"]), \
+                    "-hls_list_size", "1", \
+                    "-hls_segment_type", "fmp4", \
+                    "-hls_fmp4_init_filename", folder + str(int(datetime.now().timestamp())) + ".init.mp4", \
+                    "-strftime", "1", \
+                    "-hls_segment_filename", folder + "%s.m4s", \
+                    "pipe:1" \
+                    ]
+            else:
+                output = [ \
                     "-f", "segment", \
                     "-reset_timestamps", "1", \
                     "-segment_time", str(config["SEGMENT_DURATION"]), \
                     "-segment_format", config["VIDEO_CONTAINER"], \
+                    "-segment_list", "pipe:1", \
+                    "-segment_list_type", "csv", \
                     "-strftime", "1",  folder + "%s." + config["VIDEO_CONTAINER"] \
-                    ])
+                    ]
+            process = subprocess.Popen(["ffmpeg", \
+                    "-i", \
+                    config["RTSP_URL"], \
+                    "-rtsp_transport", \
+                    config["TRANSPORT_PROTOCOL"], \
+                    "-vcodec", "copy", \
+                    "-acodec", "copy" \
+                    ] + output, stdin = subprocess.DEVNULL, stdout = subprocess.PIPE)
+            # ffmpeg lists every segment once it has closed it, one
+            # "file,start,end" line each or, for fMP4, a playlist with
+            # the last segment. fMP4 segments are served as they are
+            for line in process.stdout:
+                line = line.decode("UTF-8", "replace").strip()
+                if line.startswith("#EXT-X-MAP:"):
+                    # The initialization section of the fMP4 segments
+                    retention_policy.add(os.path.basename(line.split("URI=")[-1].strip("\"")))
+                    continue
+                if line.startswith("#"):
+                    continue
+                name = os.path.basename(line.split(",")[0])
+                if name:
+                    converter.completed(name)
+            logging.critical("ffmpeg exited with the code %d" % process.wait())
         except Exception as e:
             logging.critical("Exception occured while capturing the video stream ....!!!!")
             logging.critical(e);
@@ -123,33 +153,32 @@ def capturing(config):
 
 def cleanup(config):
     """
-    Cleans up old MP4 files
+    Removes the recordings which are too old, do not fit into the quota
+    or have to make room on the volume
     """
+    retention_policy.scan()
     while True:
         try:
-            if os.path.exists(config["OUTPUT_FOLDER"]):
-                files = os.listdir(config["OUTPUT_FOLDER"])
-                now = int(datetime.now().timestamp())
-                for file in files:
-                    if re.match("[0-9]+\.(mp4|mpeg4|mkv|avi)", file):
-                        ts = int(file.split(".")[0])
-                        if ts <= now - int(config["MAX_VIDEO_LIFETIME"]):
-                            logging.debug("Removing the file")
-                            os.remove(file)
+            removed = retention_policy.cleanup(int(datetime.now().timestamp()))
+            if removed:
+                logging.debug("Removed %d files" % removed)
         except Exception as e:
             logging.critical("Exception occured while removing the file... !!!")
             logging.critical(e);
         sleep(config["CLEAN_UP_INTERVAL"])
 
+if not os.path.exists(config["OUTPUT_FOLDER"]):
+    os.makedirs(config["OUTPUT_FOLDER"])
+
+# Converts what the previous run left behind, then follows ffmpeg
+converter.start()
+
 capture_loop = threading.Thread(target = capturing, args = (config, ), daemon = True);
 capture_loop.start()
 
 cleanup_loop = threading.Thread(target = cleanup, args = (config, ), daemon = True);
 cleanup_loop.start()
 
-convert_loop = threading.Thread(target = convertMp4ToMPEGTS, args = (), daemon = True);
-convert_loop.start();
-
 main_loop = True;
 
 while main_loop:
@@ -18,6 +18,7 @@
 config = {
     "SEGMENT_DURATION": 10,
     "VIDEO_CONTAINER": "mp4",
+    "RECORDING_FORMAT": "ts",
     "CAMERA_NAME": "CAMERA1",
     "CAMERA_IP_ADDRESS": "192.168.1.21",
     "TRANSPORT_PROTOCOL": "tcp",
@@ -25,5 +26,14 @@ config = {
     "OUTPUT_FOLDER": "/opt/data2/ipcam/storage/192.168.1.21/video1/",
     "CLEAN_UP_SCRIPT": "/opt/data2/ipcam/scripts/cleanup.py",
     "MAX_VIDEO_LIFETIME": 86400,
-    "CLEAN_UP_INTERVAL": 60
+    "CLEAN_UP_INTERVAL": 60,
+    "MAX_STORAGE_BYTES": 0,
+    "RETENTION_BUCKET_SECONDS": 3600,
+    # Off by default. With a number of bytes, the oldest recordings are
+    # removed whatever their age whenever the volume has less free space
+    "MIN_FREE_BYTES": 0,
+    "CONVERT_PROCESSES": 2,
+    "CONVERT_QUEUE": 64,
+    "CONVERT_MAX_ATTEMPTS": 3,
+    "CONVERT_STATE_FILE": ".converter.json"
 }
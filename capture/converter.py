@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Logging
+import logging
+
+# Import OS stuff
+import os
+
+# Regular expressions
+import re
+
+# Subprocesses
+import subprocess
+
+# State file
+import json
+
+# Timing
+import time
+
+# Threading
+import threading
+import queue
+
+MP4_FILE_PATTERN           = re.compile(r"^([0-9]+)\.mp4$");
+
+class SegmentConverter():
+    """
+    Remuxes the MP4 segments ffmpeg finishes into MPEG-TS. The folder is
+    listed once on start for what the previous run left behind, afterwards
+    the capture reports every segment ffmpeg has closed with completed(),
+    so a segment still being written is never touched. The segments wait
+    in a bounded queue for a pool of workers, each running one ffmpeg at
+    a time. The workers are threads rather than processes, ffmpeg does
+    the work in a process of its own anyway. The state file keeps the
+    number of converted segments and the failed ones, which are retried
+    max_attempts times across restarts. It is replaced atomically, a
+    crash leaves either the old or the new state.
+    The added and removed callbacks get the name of every file which
+    shows up or goes away
+    """
+    def __init__(self, folder, processes, queue_size, state_path, max_attempts = 3, added = None, removed = None):
+        self.folder = folder;
+        self.processes = processes;
+        self.queue = queue.Queue(queue_size);
+        self.state_path = state_path;
+        self.max_attempts = max_attempts;
+        self.added = added;
+        self.removed = removed;
+        self.queued = set();
+        self.lock = threading.Lock();
+        self.state = {"converted": 0, "last_converted": None, "failed": {}};
+        self.load_state();
+    def load_state(self):
+        try:
+            with open(self.state_path, "r") as fd:
+                self.state.update(json.load(fd));
+        except (OSError, ValueError):
+            pass;
+    def save_state(self):
+        temporary_path = "".join([self.state_path, ".tmp"]);
+        try:
+            with open(temporary_path, "w") as fd:
+                json.dump(dict(self.state, updated = time.time()), fd);
+            os.rename(temporary_path, self.state_path);
+        except OSError as e:
+            logging.critical("Cannot save the converter state %s: %s" % (self.state_path, str(e)));
+    def start(self):
+        """
+        Starts the workers and queues the segments left in the folder,
+        must be called before the capture starts a new segment
+        """
+        for i in range(0, self.processes):
+            threading.Thread(target = self.work, daemon = True, name = "converter-%d" % i).start();
+        # The folder is listed right away, queueing the backlog may take a while
+        threading.Thread(target = self.backlog, args = (self.scan(), ), daemon = True, name = "converter-backlog").start();
+    def completed(self, name):
+        """
+        Queues the segment ffmpeg has finished unless it is queued already
+        or gave up, blocks while the queue is full
+        """
+        if self.added:
+            self.added(name);
+        match = MP4_FILE_PATTERN.match(name);
+        if not match:
+            return;
+        with self.lock:
+            if name in self.queued or self.state["failed"].get(match.group(1), 0) >= self.max_attempts:
+                return;
+            self.queued.add(name);
+        self.queue.put(name);
+    def scan(self):
+        """
+        Returns the sorted names of the files in the folder
+        """
+        try:
+            names = sorted(os.listdir(self.folder));
+        except OSError as e:
+            logging.debug("Cannot list %s: %s" % (self.folder, str(e)));
+            return [];
+        # Forget the failures of the segments which are gone
+        with self.lock:
+            self.state["failed"] = dict([(timestamp, attempts) for timestamp, attempts in self.state["failed"].items()
+                if "".join([timestamp, ".mp4"]) in names]);
+        return names;
+    def backlog(self, names):
+        for name in names:
+            self.completed(name);
+    def work(self):
+        while True:
+            name = self.queue.get();
+            try:
+                self.convert(name);
+            except Exception as e:
+                logging.critical("Exception occured while converting the file %s: %s" % (name, str(e)));
+            finally:
+                with self.lock:
+                    self.queued.discard(name);
+    def convert(self, name):
+        timestamp = name.split(".")[0];
+        source = "".join([self.folder, "/", name]);
+        path = "".join([self.folder, "/", timestamp, ".ts"]);
+        temporary_path = "".join([self.folder, "/.", timestamp, ".ts.tmp"]);
+        if not os.path.exists(source):
+            return;
+        if not os.path.exists(path):
+            result = subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-i", source,
+                "-vcodec", "copy", "-vbsf", "h264_mp4toannexb", "-acodec", "copy",
+                "-f", "mpegts", temporary_path],
+                stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE);
+            if result.returncode != 0:
+                try:
+                    os.remove(temporary_path);
+                except OSError:
+                    pass;
+                with self.lock:
+                    attempts = self.state["failed"].get(timestamp, 0) + 1;
+                    self.state["failed"][timestamp] = attempts;
+                    self.save_state();
+                logging.critical("Cannot convert %s (attempt %d): %s" % (source, attempts,
+                    result.stderr.decode("UTF-8", "replace").strip()));
+                return;
+            os.rename(temporary_path, path);
+            if self.added:
+                self.added("".join([timestamp, ".ts"]));
+        os.remove(source);
+        if self.removed:
+            self.removed(name);
+        with self.lock:
+            self.state["converted"] += 1;
+            self.state["last_converted"] = int(timestamp);
+            self.state["failed"].pop(timestamp, None);
+            self.save_state();
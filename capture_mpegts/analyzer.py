@@ -25,23 +25,20 @@ __status__ = "development"
 
 # Logging
 import logging
-from logging.handlers import RotatingFileHandler
 
 # import system library
 import sys
 
-# Configure logging to console and file
-logging.basicConfig(
-	level=logging.DEBUG,
-	format="%(asctime)s [%(levelname)s] %(message)s",
-	handlers=[
-		logging.StreamHandler(sys.stdout)
-	]
-);
-
 # Configuration
 from config import config
 
+# Configure logging to console, the report goes to the standard output
+from logsetup import configure_logging
+configure_logging(config, stream = sys.stderr);
+
+# Per packet tracing, checked once per packet instead of formatting the messages
+TRACE_PACKETS              = config["TRACE_PACKETS"];
+
 # Threading
 import threading
 
@@ -54,9 +51,6 @@ from time import sleep
 # Import OS stuff
 import os
 
-# Buffer copy functionality
-import copy
-
 # Change ownership
 #import pwd
 #import grp
@@ -78,9 +72,35 @@ import binascii
 # Timing
 import time
 
+# Memory mapped input
+import mmap
+
+# File patterns
+import glob
+
+# Processes
+import multiprocessing
+
+# Report
+import json
+
+from sys import argv
+
 # Checksums
 from crccheck.crc import Crc32, Crc32Mpeg2
 
+# Key frame detection
+from keyframe import KeyFrameDetector
+
+# Per stream state and PID dispatch
+from streams import StreamState, LookupTable, PID_COUNT, PID_UNKNOWN, PID_PAT, PID_PMT, PID_VIDEO, PID_AUDIO
+
+# Header decoding
+from demux import decode_headers
+
+# Packets which headers are decoded at once
+ANALYZER_CHUNK_PACKETS     = 0x10000;
+
 # Well known PIDs
 PAT_PID                    = 0x0;
 
@@ -136,6 +156,7 @@ STREAM_TYPE_MPEG2_AUDIO    = 0x04;
 STREAM_TYPE_PRIVATE        = 0x06;
 STREAM_TYPE_AUDIO_ADTS     = 0x0f;
 STREAM_TYPE_H264           = 0x1b;
+STREAM_TYPE_H265           = 0x24;
 STREAM_TYPE_MPEG4_VIDEO    = 0x10;
 STREAM_TYPE_METADATA       = 0x15;
 STREAM_TYPE_AAC            = 0x11;
@@ -169,184 +190,97 @@ def TS_PACKET_CONT_COUNT(b):
 def TS_PACKET_ADAPTATION_LENGTH(b):
 	return (b[4]);
 
-# This was reverse engineered
-# PES header
-# https://en.wikipedia.org/wiki/Packetized_elementary_stream
-# NAL header
-def is_key_frame(b):
-	offset = TS_HEADER_SIZE;
-	if TS_PACKET_ADAPTATION(b) == TS_PACKET_ADAPTATION_ONLY or TS_PACKET_ADAPTATION(b) == TS_PACKET_ADAPTATION_AND_PAYLOAD:
-		adaptation_field_length = b[offset];
-		offset += (adaptation_field_length + 1);
-	#print "PES header length.... %d" % b[TS_HEADER_SIZE + PES_HEADER_LENGTH_OFFSET];
-	#print "Start code.... %d" % (b[offset] << 16 | b[offset + 1] << 8 | b[offset + 2]);
-	#print "Stream id.... %d" % (b[offset + 3]);
-	offset += PES_HEADER_LENGTH_OFFSET + b[offset + PES_HEADER_LENGTH_OFFSET] + 1;
-	# Simply loop through all the bytes, this is rather slow but I did not find other method to search for IDR frame
-	# Thanks to the Internet and reverse engineering effort of the existing IPTV streaming service I inderstood how the
-	# key frame should look like. 
-	sps_found = False;
-	pps_found = False;
-	idr_found = False;
-	#i = offset
-	#import sys
-	#print "Looking for key frame >>>>>>>>>>>>>>>>>>>>>>>>>>>>"
-	#while i < TS_PACKET_SIZE:
-	#	sys.stdout.write("%02x" % b[i]);
-	#	i += 1;
-	#sys.stdout.write("\n");
-	while offset + 4 < TS_PACKET_SIZE:
-		# Most likely it is possible to avoid the loop if the NALU headers and NALU payload lengths
-		# do not change from I-Frame to I-Frame. This can save quite some CPU cycles
-		sync_word = ((b[offset] & 0x1F) << 24 | b[offset + 1] << 16 | b[offset + 2] << 8 | b[offset + 3]);
-		#sync_word = (b[offset] << 16 | b[offset + 1] << 8 | b[offset + 2]);
-		if sync_word == 0x1:
-			# The NALU type are the first 5 bits 
-			nal_type = (b[offset + 4] & 0x1F);
-			#if nal_type == IDR_FRAME_REVERSE_ENGINEERED or nal_type == IDR_2_FRAME_REVERSE_ENGINEERED:
-			if nal_type == H264_NAL_IDR_SLICE or nal_type == H264_NAL_NONIDR_SLICE:
-				idr_found = True;
-			#if nal_type == SPS_FRAME_REVERSE_ENGINEERED:
-			if nal_type == H264_NAL_SPS:
-				sps_found = True;
-			if nal_type == H264_NAL_PPS:
-				pps_found = True;
-		offset += 1;
-	return idr_found and sps_found and pps_found;
-
-class LookupTable():
-	def __init__(self, stream_id):
-		self.pmt_packets = {};
-		self.pat_packets = {};
-		self.stream_id_pmt_pid = {};
-		self.pmt_pid_stream_id = {};
-		self.stream_id_video_pid = {};
-		self.stream_id_audio_pid = {};
-		self.audio_pid_stream_id = {};
-		self.video_pid_stream_id = {};
-		self.streams = [];
-		self.streams.append(stream_id);
-	def get_stream_ids(self):
-		return self.streams;
-	def is_stream_id_in_list(self, stream_id):
-		return stream_id in self.streams;
-	def set_pat_packet(self, stream_id, packet):
-		self.pat_packets[stream_id] = packet;
-	def set_pmt_pid_stream_id(self, stream_id, pmt_pid):
-		self.pmt_pid_stream_id[pmt_pid] = stream_id;
-		self.stream_id_pmt_pid[stream_id] = pmt_pid;
-		logging.debug("********************************** SETTNING MAPPING PMT PID TO STREAM ID *****************************************")
-		logging.debug(pmt_pid)
-		logging.debug(stream_id)
-		logging.debug("********************************** SETTNING MAPPING PMT PID TO STREAM ID *****************************************")
-	def get_stream_id_by_pmt_pid(self, pmt_pid):
-		return self.pmt_pid_stream_id.get(pmt_pid);
-	def is_valid_pmt_pid(self, pmt_pid):
-		logging.debug("Processing PMT pid %d" % pmt_pid);
-		stream_id = self.pmt_pid_stream_id.get(pmt_pid, None)
-		if stream_id != None:
-			return True;
-		return False;
-	def set_pmt_packet(self, stream_id, packet):
-		self.pmt_packets[stream_id] = packet;
-	def set_video_pid_stream_id(self, stream_id, video_pid):
-		self.stream_id_video_pid[stream_id] = video_pid;
-		self.video_pid_stream_id[video_pid] = stream_id;
-	def set_audio_pid_stream_id(self, stream_id, audio_pid):
-		self.stream_id_audio_pid[stream_id] = audio_pid;
-		self.audio_pid_stream_id[audio_pid] = stream_id;
-	def get_pat_packet(self, video_pid):
-		stream_id = self.video_pid_stream_id[video_pid];
-		return self.pat_packets[stream_id];
-	def get_pmt_packet(self, video_pid):
-		stream_id = self.video_pid_stream_id[video_pid];
-		return self.pmt_packets[stream_id];
-	def get_stream_id_by_video_pid(self, video_pid):
-		return self.video_pid_stream_id.get(video_pid, -1);
-	def get_stream_id_by_audio_pid(self, audio_pid):
-		return self.audio_pid_stream_id.get(audio_pid, -1);
-	def is_valid_video_pid(self, video_pid):
-		return self.video_pid_stream_id.get(video_pid, None) != None;
-	def is_valid_audio_pid(self, audio_pid):
-		return self.audio_pid_stream_id.get(audio_pid, None) != None;
+def new_report():
+    return {
+        "packets": 0,
+        "sync_errors": 0,
+        "transport_errors": 0,
+        "pids": {},
+        "cc_errors": {},
+        "key_frames": [],
+        "gop_sizes": [],
+        "segments": []
+    };
 
 def analyzeMPEGTS(buffer):
     """
-    Converts the MP4 files to MPEGTS stream files
+    Runs the stream through the same slicing as the capture does and
+    collects statistics of the packets, key frames and segments. The
+    buffer can be anything supporting the buffer protocol (mmap), the
+    packets are never copied
     """
-
-    lookup = LookupTable(config["VALID_CHANNEL"]);
-    # Precreate buffer twice the size of the maximum buffer size
-    #sequence_buffer = bytearray(MAX_BUFFER_SIZE_IN_BYTES * 2);
-    sequence_buffer = {};
+    report = new_report();
+    lookup = LookupTable();
+    detector = KeyFrameDetector();
     stream_id = config["VALID_CHANNEL"]
-    sequence_buffer[stream_id] = bytearray(MAX_BUFFER_SIZE_IN_BYTES * 2);
     base_dir = config["OUTPUT_FOLDER"];
     #program = config["STREAM_ID"];
-    #output_folder = "".join([base_dir, "/", str(filling_timestamp)]);
-    playing_timestamp = {};
-    waiting_timestamp = {};
-    filling_timestamp = {};
-    buffer_fill = {};
-    sequence = {};
-    playlist_constructed = {};
-    output_folder = {};
-    stream_ids = lookup.get_stream_ids();
-    playlist_constructed[stream_id] = False;
-    playing_timestamp[stream_id] = -1;
-    waiting_timestamp[stream_id] = -1;
-    filling_timestamp[stream_id] = int(time.time());
-    sequence[stream_id] = 1;
-    buffer_fill[stream_id] = 0;
-    output_folder[stream_id] = config["OUTPUT_FOLDER"];
-    sync_count = 0;
-    lost_packets = 0;
-    pmt_pid = 0x0;
-    pmt_packet_processed = {};
-    video_pid = 0x0;
-    audio_pid = 0x0;
-    stream_synchronized = False;
-    cc_counter = -1;
-    pat_commited = False;
-    pmt_commited = False;
-    end_of_pes = False;
+    # Only the fill level of the segments is tracked
+    lookup.add_stream(StreamState(stream_id, None, config["OUTPUT_FOLDER"], int(time.time())));
+    kinds = lookup.kinds;
+    states = lookup.states;
+    trace = TRACE_PACKETS;
+    pid_packets = [0] * PID_COUNT;
+    last_cc = [-1] * PID_COUNT;
+    cc_errors = [0] * PID_COUNT;
+    key_frames = report["key_frames"];
+    gop_sizes = report["gop_sizes"];
+    segments = report["segments"];
+    # Frames since the last key frame, the frames before the first one do not count
+    gop_frames = -1;
     pat_packet_processed = False;
-    #pmt_packet = None;
-    #playlist_constructed = False;
-    buffer_offset = 0;
-    logging.debug("HERE")
-    for buffer_offset in range(0, len(buffer), TS_PACKET_SIZE):
+    view = memoryview(buffer);
+    packet_count = len(view) // TS_PACKET_SIZE;
+    chunk_start = 0;
+    chunk_end = 0;
+    for packet_number in range(packet_count):
+        if packet_number == chunk_end:
+            # Decode the headers of the next chunk of packets at once
+            chunk_start = packet_number;
+            chunk_end = min(packet_number + ANALYZER_CHUNK_PACKETS, packet_count);
+            sync_bytes, errors, pusis, pids, adaptations, counters = decode_headers(buffer,
+                chunk_end - chunk_start, chunk_start * TS_PACKET_SIZE);
         try:
-            try:
-                buf = bytearray(buffer[buffer_offset:buffer_offset + TS_PACKET_SIZE])
-            except IOError:
-                logging.critical("Socket was closed, cannot continue");
-                exit(-1)
-            if len(buf) != TS_PACKET_SIZE:
-                logging.debug("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+            index = packet_number - chunk_start;
+            buffer_offset = packet_number * TS_PACKET_SIZE;
+            if sync_bytes[index] != SYNC_BYTE:
+                report["sync_errors"] += 1;
                 continue;
-            if TS_PACKET_SYNC_BYTE(buf) != SYNC_BYTE:
-                continue;
-                logging.debug("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-            if TS_PACKET_TRANS_ERROR(buf):
-                logging.debug("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+            if errors[index]:
+                report["transport_errors"] += 1;
+                if trace:
+                    logging.debug("TS packet error at the offset %d", buffer_offset)
                 # Skip the packet if we have an error
                 continue;
-            pid = TS_PACKET_PID(buf);
-            logging.debug("**************PID of the packet %d *********************" % (pid));
+            pid = pids[index];
+            pid_packets[pid] += 1;
+            # Continuity counter advances only on packets carrying payload,
+            # one duplicate packet is allowed
+            if adaptations[index] & TS_PACKET_PAYLOAD_ONLY:
+                last = last_cc[pid];
+                if last >= 0 and counters[index] != last and counters[index] != ((last + 1) & 0xF):
+                    cc_errors[pid] += 1;
+                last_cc[pid] = counters[index];
+            if trace:
+                logging.debug("**************PID of the packet %d *********************", pid);
+            kind = kinds[pid];
+            if kind == PID_UNKNOWN:
+                continue;
+            buf = view[buffer_offset:buffer_offset + TS_PACKET_SIZE];
             #Have no idea how and why we have here extra byte but it seems to work that way
             offset = TS_HEADER_SIZE;
             #print "Adaptation header %d" % (TS_PACKET_ADAPTATION(buf));
             #print "PUSI %d" % (TS_PACKET_PAYLOAD_START(buf));
             #Parser is implemented according to the https://github.com/jeoliva/mpegts-basic-parser/blob/master/tsparser.c
-            payload_unit_start_indicator = TS_PACKET_PAYLOAD_START(buf);
-            if TS_PACKET_ADAPTATION(buf) == TS_PACKET_ADAPTATION_AND_PAYLOAD or TS_PACKET_ADAPTATION(buf) == TS_PACKET_ADAPTATION:
+            payload_unit_start_indicator = pusis[index];
+            if adaptations[index] == TS_PACKET_ADAPTATION_AND_PAYLOAD or adaptations[index] == TS_PACKET_ADAPTATION_ONLY:
                 #print "Adaptation header present and its length is %d" % (TS_PACKET_ADAPTATION_LENGTH(buf));
                 offset += (TS_PACKET_ADAPTATION_LENGTH(buf) + 1);
-            logging.critical("IS PAT PID? %d" % pid)
-            if pid == PAT_PID and not pat_packet_processed:
+            if kind == PID_PAT and not pat_packet_processed:
             #if pid == PAT_PID and not pat_commited:
                 pat_packet_processed = True;
+                # The PAT is rewritten in place, so it needs its own copy
+                buf = bytearray(buf);
                 logging.debug("**************** PAT PID ******************");
                 # Program association table (PAT)
                 # Lets look into the contents and find the PID of the program map table first
@@ -372,7 +306,8 @@ def analyzeMPEGTS(buffer):
                     #pmt_pid = (((buf[index + 2] & 0x1F) << 8) | ((buf[index + 3] & 0xFF)));
                     pmt_pid = (((buf[index + 2] & 0x1F) << 8) | (buf[index + 3] & 0xFF));
                     logging.debug("Program number: %d, PMT PID %d" % (stream_id, pmt_pid));
-                    if lookup.is_stream_id_in_list(stream_id):
+                    state = lookup.get_stream(stream_id);
+                    if state is not None:
                         #if not pmt_synced:
                         #pmt_fd = open(config["DEMUX"], "w+");
                         #if pmt_fd < 0:
@@ -390,7 +325,7 @@ def analyzeMPEGTS(buffer):
                         # Header offset, adaptation length field, actual length of the adaptation
                         # Set the payload unit start indicator to 1
                         buf[1] = (buf[1] | 0x40);
-                        if TS_PACKET_ADAPTATION(buf) == TS_PACKET_ADAPTATION_AND_PAYLOAD or TS_PACKET_ADAPTATION(buf) == TS_PACKET_ADAPTATION:
+                        if TS_PACKET_ADAPTATION(buf) == TS_PACKET_ADAPTATION_AND_PAYLOAD or TS_PACKET_ADAPTATION(buf) == TS_PACKET_ADAPTATION_ONLY:
                             pointer_length = TS_PACKET_SIZE - CRC32_LENGTH - (TS_PACKET_ADAPTATION_LENGTH(buf) + 1) -  PMT_RECORD_LENGTH - PAT_PREHEADER_LENGTH - 1;
                             offset = TS_HEADER_SIZE + (TS_PACKET_ADAPTATION_LENGTH(buf) + 1);
                         else:
@@ -438,31 +373,28 @@ def analyzeMPEGTS(buffer):
                         buf[offset + 1] = ((crc32 & 0x00ff0000) >> 16);
                         buf[offset + 2] = ((crc32 & 0x0000ff00) >>  8);
                         buf[offset + 3] = (crc32 & 0x000000ff);
-                        pat_packet = copy.deepcopy(buf);
+                        state.pat_packet = bytes(buf);
                         logging.debug("----------------------------------- SETTING PMT PID %d ----------------------------------------" % pmt_pid)
-                        lookup.set_pat_packet(stream_id, pat_packet);
-                        lookup.set_pmt_pid_stream_id(stream_id, pmt_pid);
+                        lookup.set_pmt_pid(state, pmt_pid);
                         #break;
                     index += PMT_RECORD_LENGTH;
                 #if not pmt_pid_found:
                 #	print "Program was not found in the PAT table";
                 #	continue; # Or should we exit
                 continue;
-            elif pid == PAT_PID and pat_packet_processed:
+            elif kind == PID_PAT:
                 continue;
             # We have found the PMT PID lets look into the internals
             # to find out the PIDs for audio and video elementary streams
             #print pmt_pid == pid, pmt_synced, (not pat_commited)
             #if pid == pmt_pid and pmt_synced and (not pmt_commited):
             #if pid == pmt_pid and pmt_packet_processed:
-            logging.critical("Current PID " + str(pid))
-            logging.debug("Stream ID " + str(stream_id))
-            if lookup.is_valid_pmt_pid(pid) and not pmt_packet_processed.get(pid, False):
-                pmt_packet_processed[pid] = True;
-                pmt_packet = copy.deepcopy(buf);
-                stream_id = lookup.get_stream_id_by_pmt_pid(pid)
-                lookup.set_pmt_packet(stream_id, pmt_packet);
-                logging.critical("**************** PMT PID ******************");
+            state = states[pid];
+            if kind == PID_PMT and not state.pmt_processed:
+                state.pmt_processed = True;
+                state.pmt_packet = bytes(buf);
+                stream_id = state.stream_id;
+                logging.debug("**************** PMT PID ******************");
                 if payload_unit_start_indicator:
                     logging.debug("PUSI bit is set. Skipping %d bytes" % (buf[offset]));
                     offset += ((buf[offset] & 0xFF) + 1);
@@ -493,10 +425,11 @@ def analyzeMPEGTS(buffer):
                     # and MPEG2 audio codec is being used for audio compression
                     logging.debug("Stream type: %d" % (stream_type));
                     logging.debug("Elementary PID: %d" % (elementary_pid)); 
-                    if stream_type == STREAM_TYPE_H264:
+                    if stream_type == STREAM_TYPE_H264 or stream_type == STREAM_TYPE_H265:
                         #if not video_pid:
                         video_pid = elementary_pid;
-                        lookup.set_video_pid_stream_id(stream_id, video_pid);
+                        lookup.set_video_pid(state, video_pid);
+                        detector.set_codec(video_pid, stream_type);
                         #video_fd = open(config["DEMUX"], "w+");
                         logging.debug("Seting up filter for video elementary stream %d for stream %d" % (video_pid, stream_id))
                         #if video_fd < 0:
@@ -509,7 +442,7 @@ def analyzeMPEGTS(buffer):
                     if stream_type == STREAM_TYPE_MPEG2_AUDIO or stream_type == STREAM_TYPE_AAC or stream_type == STREAM_TYPE_AC3 or stream_type == STREAM_TYPE_MPEG1_AUDIO:
                         #if not audio_pid:
                         audio_pid = elementary_pid;
-                        lookup.set_audio_pid_stream_id(stream_id, audio_pid);
+                        lookup.set_audio_pid(state, audio_pid);
                         logging.debug("Seting up filter for audio elementary stream %d" % audio_pid) 
                         #audio_fd = open(config["DEMUX"], "w+");
                         #if audio_fd < 0:
@@ -519,7 +452,7 @@ def analyzeMPEGTS(buffer):
                         #if add_pidfilter(fd, audio_pid):
                         #	logging.debug("Cannot set video filter. Exiting...");
                         #	exit(-1);
-            elif lookup.is_valid_pmt_pid(pid) and pmt_packet_processed.get(pid, False):
+            elif kind == PID_PMT:
                 continue;
             #if pid == PAT_PID:
             #	print "Storing the PAT in the buffer... This should occur only once"
@@ -540,60 +473,122 @@ def analyzeMPEGTS(buffer):
             #	print ">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>"
             #	print "Is key frame %d" % is_key_frame(buf);
             #	print "<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<"
-            #logging.critical("Looking up VIDEO PID " + str(pid))
-            if lookup.is_valid_video_pid(pid) and payload_unit_start_indicator == 0x1 and is_key_frame(buf):
-                stream_id = lookup.get_stream_id_by_video_pid(pid);
-                #print "Stream ID %d, Buffer fill level %d, Maximum buffer size %d " % (stream_id, buffer_fill[stream_id], MAX_BUFFER_SIZE_IN_BYTES);
-                #print "Stream id %d" % stream_id;
-                if buffer_fill[stream_id] >= MAX_BUFFER_SIZE_IN_BYTES:
-                    # We need to copy the sequence buffer otherwise some packets can be overwritten
-                    sequence_buffer_copy = copy.deepcopy(sequence_buffer[stream_id][0:buffer_fill[stream_id]]);
-                    #threading.Thread(target=save_buffer, args=(sequence_buffer_copy, output_folder[stream_id], playing_timestamp[stream_id])).start();
-                    sequence[stream_id] = sequence[stream_id] + 1;
-                    #if sequence[stream_id] > MAX_SEQUENCE_PER_FOLDER:
-                    sequence[stream_id] = 1;
-                    playlist_constructed[stream_id] = False;
-                    playing_timestamp[stream_id] = waiting_timestamp[stream_id];
-                    waiting_timestamp[stream_id] = filling_timestamp[stream_id];
-                    filling_timestamp[stream_id] = int(time.time());
-                    #output_folder[stream_id] = "".join([base_dir, "/", str(stream_id), "/", str(filling_timestamp[stream_id])]);
-                    #create_folder(output_folder[stream_id]);
-                    # Copy PAT, PMT and first packet of a new PES carrying video data
-                    # First two packets of a segment MUST be PAT and PMT packets 
-                    # as described in https://tools.ietf.org/html/rfc8216#section-3
-                    buffer_fill[stream_id] = 0;
-                    sequence_buffer[stream_id][buffer_fill[stream_id]:buffer_fill[stream_id] + TS_PACKET_SIZE] = pat_packet;
-                    buffer_fill[stream_id] += TS_PACKET_SIZE;
-                    sequence_buffer[stream_id][buffer_fill[stream_id]:buffer_fill[stream_id] + TS_PACKET_SIZE] = pmt_packet;
-                    buffer_fill[stream_id] += TS_PACKET_SIZE;
-                    continue;
-                #if (sequence[stream_id] == MAX_SEQUENCE_PER_FOLDER / 2) and buffer_fill[stream_id] >= (MAX_BUFFER_SIZE_IN_BYTES * 0.1) and not playlist_constructed[stream_id] and playing_timestamp[stream_id] > 0:
-                #	playlist_constructed[stream_id] = True;
-                #	logging.debug("Constructing playlist (timestamp %d)" % (playing_timestamp[stream_id]));
-                #	threading.Thread(target=construct_playlist, args=("".join([base_dir, "/", str(stream_id), "/", str(playing_timestamp[stream_id])]), "".join([base_dir, "/", str(stream_id), "/"]), WEB_PATH, stream_id, playing_timestamp[stream_id], config["ENABLE_STREAM_ENCRYPTION"], )).start();
-                sequence_buffer[stream_id][buffer_fill[stream_id]:buffer_fill[stream_id] + TS_PACKET_SIZE] = buf;
-                buffer_fill[stream_id] += TS_PACKET_SIZE;
-                continue;
-                #elif pid == video_pid and pid != 0x0:
-            elif lookup.is_valid_video_pid(pid):
-                stream_id = lookup.get_stream_id_by_video_pid(pid);
-                logging.debug("Stream id %d, buffer fill %d" % (stream_id, buffer_fill[stream_id]));
-                sequence_buffer[stream_id][buffer_fill[stream_id]:buffer_fill[stream_id] + TS_PACKET_SIZE] = buf;
-                buffer_fill[stream_id] += TS_PACKET_SIZE;
+            if kind == PID_VIDEO:
+                if payload_unit_start_indicator == 0x1:
+                    if detector.is_key_frame(buf, pid):
+                        key_frames.append(buffer_offset);
+                        if gop_frames > 0:
+                            gop_sizes.append(gop_frames);
+                        gop_frames = 0;
+                        if state.fill >= MAX_BUFFER_SIZE_IN_BYTES:
+                            segments.append(state.fill);
+                            state.sequence = 1;
+                            state.playlist_constructed = False;
+                            state.playing_timestamp = state.waiting_timestamp;
+                            state.waiting_timestamp = state.filling_timestamp;
+                            state.filling_timestamp = int(time.time());
+                            # First two packets of a segment MUST be PAT and PMT packets 
+                            # as described in https://tools.ietf.org/html/rfc8216#section-3
+                            state.fill = TS_PACKET_SIZE * 2;
+                    if gop_frames >= 0:
+                        gop_frames += 1;
+                if trace:
+                    logging.debug("Stream id %d, buffer fill %d", state.stream_id, state.fill);
+                state.fill += TS_PACKET_SIZE;
                 continue;
-            if lookup.is_valid_audio_pid(pid):
-                stream_id = lookup.get_stream_id_by_audio_pid(pid);
-                #if pid == audio_pid and pid != 0x0:
-                logging.debug("AUDIO Stream id %d, buffer fill %d" % (stream_id, buffer_fill[stream_id]));
-                sequence_buffer[stream_id][buffer_fill[stream_id]:buffer_fill[stream_id] + TS_PACKET_SIZE] = buf;
-                buffer_fill[stream_id] += TS_PACKET_SIZE;
+            if kind == PID_AUDIO:
+                if trace:
+                    logging.debug("AUDIO Stream id %d, buffer fill %d", state.stream_id, state.fill);
+                state.fill += TS_PACKET_SIZE;
         except Exception as e:
-            logging.critical("Exception occured while converting the file")
+            logging.critical("Exception occured while analyzing the packet at the offset %d" % (buffer_offset))
             logging.critical(e);
             traceback.print_exc()
-        #sleep(1)
-
-from sys import argv
-fd = open(argv[1], "rb")
-bytes = fd.read();
-analyzeMPEGTS(bytes);
+    # The last segment is still being filled
+    for state in lookup.streams.values():
+        if state.fill > TS_PACKET_SIZE * 2:
+            segments.append(state.fill);
+    view.release();
+    report["packets"] = packet_count;
+    report["truncated_bytes"] = len(buffer) - packet_count * TS_PACKET_SIZE;
+    report["pids"] = dict([(pid, packets) for pid, packets in enumerate(pid_packets) if packets]);
+    report["cc_errors"] = dict([(pid, errors) for pid, errors in enumerate(cc_errors) if errors]);
+    return report;
+
+def analyze_file(path):
+    """
+    Analyzes the recording memory mapped, so the size of the file does not
+    matter. Returns the report of the file
+    """
+    started = time.monotonic();
+    try:
+        with open(path, "rb") as fd:
+            size = os.fstat(fd.fileno()).st_size;
+            if size == 0:
+                report = analyzeMPEGTS(b"");
+            else:
+                with mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+                    if hasattr(mapped, "madvise"):
+                        mapped.madvise(mmap.MADV_SEQUENTIAL);
+                    report = analyzeMPEGTS(mapped);
+    except Exception as e:
+        logging.critical("Cannot analyze the file %s: %s" % (path, str(e)));
+        return {"file": path, "error": str(e)};
+    seconds = time.monotonic() - started;
+    report["file"] = path;
+    report["bytes"] = size;
+    report["seconds"] = round(seconds, 3);
+    report["packets_per_second"] = int(report["packets"] / seconds) if seconds > 0 else 0;
+    return report;
+
+def expand_inputs(arguments):
+    """
+    Files, folders (all the .ts files inside) and glob patterns
+    """
+    files = [];
+    for argument in arguments:
+        if os.path.isdir(argument):
+            files.extend(sorted(glob.glob(os.path.join(argument, "*.ts"))));
+        elif glob.has_magic(argument):
+            files.extend(sorted(glob.glob(argument)));
+        else:
+            files.append(argument);
+    return files;
+
+def summarize(reports, seconds):
+    summary = {
+        "files": len(reports),
+        "failed": len([report for report in reports if "error" in report]),
+        "bytes": 0,
+        "packets": 0,
+        "cc_errors": 0,
+        "key_frames": 0,
+        "segments": 0,
+        "seconds": round(seconds, 3)
+    };
+    for report in reports:
+        if "error" in report:
+            continue;
+        summary["bytes"] += report["bytes"];
+        summary["packets"] += report["packets"];
+        summary["cc_errors"] += sum(report["cc_errors"].values());
+        summary["key_frames"] += len(report["key_frames"]);
+        summary["segments"] += len(report["segments"]);
+    summary["packets_per_second"] = int(summary["packets"] / seconds) if seconds > 0 else 0;
+    return summary;
+
+if __name__ == "__main__":
+    if len(argv) < 2:
+        print("Usage: %s <file|folder|glob> [...]" % argv[0]);
+        sys.exit(1);
+    files = expand_inputs(argv[1:]);
+    processes = config["ANALYZER_PROCESSES"] or os.cpu_count() or 1;
+    processes = max(1, min(processes, len(files)));
+    started = time.monotonic();
+    if processes == 1:
+        reports = [analyze_file(path) for path in files];
+    else:
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            reports = pool.map(analyze_file, files, chunksize = 1);
+    json.dump({"summary": summarize(reports, time.monotonic() - started), "files": reports}, sys.stdout, indent = 2);
+    sys.stdout.write("\n");
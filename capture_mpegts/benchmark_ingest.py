@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compares CPU usage and packet loss of the UDP and pipe ingest modes.
+# ffmpeg replays a recording in real time (-re) the same way it remuxes
+# the camera stream, the demuxer side only receives the packets and
+# checks the continuity counters.
+#
+# Usage: python3 benchmark_ingest.py <recording.ts> [seconds]
+
+# import system library
+import sys
+
+# Subprocesses
+import subprocess
+
+# CPU accounting
+import resource
+
+# socket functionality
+import socket
+
+# Timing
+import time
+
+# Batch packet reception
+from demux import PacketBatch, UdpSource, PipeSource
+
+UDP_IP                     = "127.0.0.1";
+UDP_PORT                   = 9100;
+BATCH_SIZE                 = 64;
+DATAGRAM_SIZE              = 1316;
+RECEIVE_BUFFER             = 8 * 1024 * 1024;
+PIPE_BATCH_SIZE            = 512;
+
+def replay_command(path, seconds, output):
+    return ["ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-re", "-stream_loop", "-1", "-i", path, "-t", str(seconds),
+        "-c", "copy", "-f", "mpegts", output];
+
+def count_losses(batch, state, totals):
+    """
+    Checks continuity counters of the packets carrying payload
+    """
+    sync_bytes, errors, pusis, pids, adaptations, counters = batch.headers();
+    for index in range(batch.count):
+        if not (adaptations[index] & 0x1):
+            continue;
+        pid = pids[index];
+        last = state.get(pid, -1);
+        state[pid] = counters[index];
+        if last < 0 or counters[index] == ((last + 1) & 0xF):
+            continue;
+        if counters[index] == last:
+            totals["duplicated"] += 1;
+        else:
+            totals["lost"] += (counters[index] - last - 1) & 0xF;
+
+def run(mode, path, seconds):
+    totals = {"packets": 0, "lost": 0, "duplicated": 0};
+    state = {};
+    usage = resource.getrusage(resource.RUSAGE_SELF);
+    children = resource.getrusage(resource.RUSAGE_CHILDREN);
+    start = time.monotonic();
+    if mode == "udp":
+        source = UdpSource(UDP_IP, UDP_PORT, RECEIVE_BUFFER);
+        source.sock.settimeout(1.0);
+        batch = PacketBatch(BATCH_SIZE, DATAGRAM_SIZE);
+        process = subprocess.Popen(replay_command(path, seconds,
+            "udp://%s:%d?pkt_size=%d&buffer_size=1048576" % (UDP_IP, UDP_PORT, DATAGRAM_SIZE)));
+        while True:
+            try:
+                source.fill(batch);
+            except socket.timeout:
+                if process.poll() is not None:
+                    break;
+                continue;
+            totals["packets"] += batch.count;
+            count_losses(batch, state, totals);
+        source.sock.close();
+    else:
+        process = subprocess.Popen(replay_command(path, seconds, "pipe:1"), stdout = subprocess.PIPE, bufsize = 0);
+        source = PipeSource(process.stdout);
+        batch = PacketBatch(PIPE_BATCH_SIZE);
+        while source.fill(batch) > 0:
+            totals["packets"] += batch.count;
+            count_losses(batch, state, totals);
+        process.stdout.close();
+    process.wait();
+    elapsed = time.monotonic() - start;
+    after = resource.getrusage(resource.RUSAGE_SELF);
+    after_children = resource.getrusage(resource.RUSAGE_CHILDREN);
+    demux_cpu = (after.ru_utime - usage.ru_utime) + (after.ru_stime - usage.ru_stime);
+    ffmpeg_cpu = (after_children.ru_utime - children.ru_utime) + (after_children.ru_stime - children.ru_stime);
+    print("%-4s %10d packets %8d lost %6d duplicated  demux CPU %6.2f%%  ffmpeg CPU %6.2f%%" % (mode,
+        totals["packets"], totals["lost"], totals["duplicated"],
+        100 * demux_cpu / elapsed, 100 * ffmpeg_cpu / elapsed));
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: %s <recording.ts> [seconds]" % sys.argv[0]);
+        sys.exit(1);
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 30;
+    for mode in ["udp", "pipe"]:
+        run(mode, sys.argv[1], seconds);
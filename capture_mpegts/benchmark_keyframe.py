@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Micro-benchmark of the key frame detection on a recorded capture
+#
+# Usage: python3 benchmark_keyframe.py <recording.ts> [repeat]
+
+# import system library
+import sys
+
+# Timing
+import time
+
+# Key frame detection
+from keyframe import KeyFrameDetector, es_offset
+
+TS_PACKET_SIZE             = 0xBC;
+TS_HEADER_SIZE             = 0x4;
+SYNC_BYTE                  = 0x47;
+
+# H264
+H264_NAL_NONIDR_SLICE      = 0x1;
+H264_NAL_IDR_SLICE         = 0x5;
+H264_NAL_SPS               = 0x7;
+H264_NAL_PPS               = 0x8;
+
+def legacy_is_key_frame(b):
+    """
+    The original byte by byte scanner, kept for comparison
+    """
+    offset = es_offset(b);
+    sps_found = False;
+    pps_found = False;
+    idr_found = False;
+    while offset + 4 < TS_PACKET_SIZE:
+        sync_word = ((b[offset] & 0x1F) << 24 | b[offset + 1] << 16 | b[offset + 2] << 8 | b[offset + 3]);
+        if sync_word == 0x1:
+            nal_type = (b[offset + 4] & 0x1F);
+            if nal_type == H264_NAL_IDR_SLICE or nal_type == H264_NAL_NONIDR_SLICE:
+                idr_found = True;
+            if nal_type == H264_NAL_SPS:
+                sps_found = True;
+            if nal_type == H264_NAL_PPS:
+                pps_found = True;
+        offset += 1;
+    return idr_found and sps_found and pps_found;
+
+def video_pes_starts(data):
+    """
+    Packets that start a video PES, these are the ones the demuxer scans
+    """
+    packets = [];
+    view = memoryview(data);
+    for offset in range(0, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+        packet = view[offset:offset + TS_PACKET_SIZE];
+        if packet[0] != SYNC_BYTE or not (packet[1] & 0x40):
+            continue;
+        pid = ((packet[1] & 0x1F) << 8) | packet[2];
+        # PES stream ids 0xE0-0xEF carry video
+        header = TS_HEADER_SIZE if not (packet[3] & 0x20) else TS_HEADER_SIZE + packet[4] + 1;
+        if header + 4 < TS_PACKET_SIZE and bytes(packet[header:header + 3]) == b"\x00\x00\x01" and 0xE0 <= packet[header + 3] <= 0xEF:
+            packets.append((pid, bytes(packet)));
+    return packets;
+
+def run(name, packets, detect, repeat):
+    keys = 0;
+    start = time.perf_counter();
+    for i in range(repeat):
+        for pid, packet in packets:
+            if detect(packet, pid):
+                keys += 1;
+    elapsed = time.perf_counter() - start;
+    rate = (len(packets) * repeat) / elapsed if elapsed > 0 else 0;
+    print("%-8s %10d packets %8.3f s %12.0f packets/s %6d key frames" % (name, len(packets) * repeat, elapsed, rate, keys // repeat));
+    return rate;
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: %s <recording.ts> [repeat]" % sys.argv[0]);
+        sys.exit(1);
+    with open(sys.argv[1], "rb") as fd:
+        data = fd.read();
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 10;
+    packets = video_pes_starts(data);
+    print("%d video PES start packets in %s" % (len(packets), sys.argv[1]));
+    detector = KeyFrameDetector();
+    before = run("legacy", packets, lambda packet, pid: legacy_is_key_frame(packet), repeat);
+    after = run("find", packets, detector.is_key_frame, repeat);
+    if before > 0:
+        print("Speedup: %.1fx" % (after / before));
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Measures the drop rate of the UDP ingest for different bitrates,
+# receive buffer sizes and datagram sizes. udp_replay.py sends a
+# recording, the receiving side decodes the headers of every batch the
+# same way the demuxer does.
+#
+# Usage: python3 benchmark_receive.py <recording.ts> [seconds]
+
+# import system library
+import sys
+
+# Subprocesses
+import subprocess
+
+# socket functionality
+import socket
+
+# Timing
+import time
+
+# Batch packet reception
+from demux import PacketBatch, UdpSource, TS_PACKET_SIZE
+
+UDP_IP                     = "127.0.0.1";
+UDP_PORT                   = 9101;
+BATCH_SIZE                 = 64;
+
+# Megabits per second, 0 is as fast as the sender can go
+BITRATES                   = [8, 32, 128, 0];
+RECEIVE_BUFFERS            = [0, 8 * 1024 * 1024];
+DATAGRAM_SIZES             = [TS_PACKET_SIZE, 7 * TS_PACKET_SIZE];
+
+def run(path, seconds, bitrate, receive_buffer, datagram_size):
+    source = UdpSource(UDP_IP, UDP_PORT, receive_buffer);
+    source.sock.settimeout(1.0);
+    effective_buffer = source.receive_buffer();
+    batch = PacketBatch(BATCH_SIZE, datagram_size);
+    replay = subprocess.Popen([sys.executable, "udp_replay.py", path,
+        "--host", UDP_IP, "--port", str(UDP_PORT),
+        "--bitrate", str(bitrate), "--packet-size", str(datagram_size),
+        "--duration", str(seconds)], stdout = subprocess.PIPE);
+    received = 0;
+    while True:
+        try:
+            source.fill(batch);
+        except socket.timeout:
+            if replay.poll() is not None:
+                break;
+            continue;
+        received += batch.count;
+        batch.headers();
+    output = replay.communicate()[0].decode("utf-8");
+    drops = source.drops();
+    source.sock.close();
+    sent = int(output.split(" bytes")[0].split(", ")[-1]) // TS_PACKET_SIZE;
+    lost = max(0, sent - received);
+    print("%8s Mbit/s  buffer %9d  datagram %5d  %10d sent %10d lost (%6.3f%%)  kernel drops %d datagrams" % (
+        str(bitrate) if bitrate else "max", effective_buffer, datagram_size,
+        sent, lost, 100.0 * lost / sent if sent else 0, drops));
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: %s <recording.ts> [seconds]" % sys.argv[0]);
+        sys.exit(1);
+    seconds = int(sys.argv[2]) if len(sys.argv) > 2 else 10;
+    for bitrate in BITRATES:
+        for receive_buffer in RECEIVE_BUFFERS:
+            for datagram_size in DATAGRAM_SIZES:
+                run(sys.argv[1], seconds, bitrate, receive_buffer, datagram_size);
+                time.sleep(0.5);
@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Threading
+import threading
+
+class BufferPool():
+    """
+    Pool of preallocated sequence buffers. The demuxer fills one buffer
+    while the previous ones are being written to the disk, the writer
+    hands them back once the segment is on the disk
+    """
+    def __init__(self, buffer_size, max_free, metrics = None):
+        self.buffer_size = buffer_size;
+        self.max_free = max_free;
+        self.metrics = metrics;
+        self.free = [];
+        self.lock = threading.Lock();
+        self.in_use = 0;
+    def acquire(self):
+        """
+        Returns a free buffer, allocates a new one only when all the
+        buffers are still waiting for the disk
+        """
+        with self.lock:
+            buf = self.free.pop() if self.free else None;
+            self.in_use += 1;
+            in_use = self.in_use;
+        if self.metrics is not None:
+            self.metrics.increment("buffer_reuses" if buf is not None else "buffer_allocations");
+            self.metrics.set("buffers_in_use", in_use);
+        if buf is None:
+            buf = bytearray(self.buffer_size);
+        return buf;
+    def release(self, buf):
+        """
+        Returns the buffer to the pool, buffers above the limit are left
+        to the garbage collector
+        """
+        with self.lock:
+            self.in_use -= 1;
+            if len(self.free) < self.max_free:
+                self.free.append(buf);
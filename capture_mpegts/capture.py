@@ -25,7 +25,6 @@ __status__ = "development"
 
 # Logging
 import logging
-from logging.handlers import RotatingFileHandler
 
 # import system library
 import sys
@@ -45,9 +44,6 @@ from time import sleep
 # Import OS stuff
 import os
 
-# Buffer copy functionality
-import copy
-
 # Change ownership
 import pwd
 import grp
@@ -69,18 +65,49 @@ import binascii
 # Timing
 import time
 
+# Native calls
+import ctypes
+import signal
+import fcntl
+
 # Checksums
 from crccheck.crc import Crc32, Crc32Mpeg2
 
-# Configure logging to console and file
-logging.basicConfig(
-	level=logging.DEBUG,
-	format="%(asctime)s [%(levelname)s] %(message)s",
-	handlers=[
-		RotatingFileHandler("rtsp_capture.log", backupCount=10),
-		logging.StreamHandler(sys.stdout)
-	]
-);
+# Key frame detection
+from keyframe import KeyFrameDetector
+
+# Metrics
+from metrics import registry
+
+# Segment writing
+from writer import SegmentWriter
+from bufferpool import BufferPool
+
+# Asynchronous logging
+from logsetup import configure_logging
+
+# Batch packet reception
+from demux import PacketBatch, UdpSource, PipeSource
+
+# Per stream state and PID dispatch
+from streams import StreamState, LookupTable, PID_COUNT, PID_UNKNOWN, PID_PAT, PID_PMT, PID_VIDEO, PID_AUDIO
+
+# Key frame index of the segments
+from segmentindex import pes_pts, pack_index, NO_PTS, PTS_WRAP
+
+# Low latency HLS parts
+from livehls import LivePublisher
+
+# Retention of the recordings, shared with capture. Deployed next to this
+# file, found in ../common when run from the source tree
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"));
+from retention import RetentionPolicy
+
+# The log file is opened by the entry point only, see supervisor.py
+LOG_FILE                   = "rtsp_capture.log";
+
+# Per packet tracing, checked once per packet instead of formatting the messages
+TRACE_PACKETS              = config["TRACE_PACKETS"];
 
 # Well known PIDs
 PAT_PID                    = 0x0;
@@ -132,6 +159,7 @@ STREAM_TYPE_MPEG2_AUDIO    = 0x04;
 STREAM_TYPE_PRIVATE        = 0x06;
 STREAM_TYPE_AUDIO_ADTS     = 0x0f;
 STREAM_TYPE_H264           = 0x1b;
+STREAM_TYPE_H265           = 0x24;
 STREAM_TYPE_MPEG4_VIDEO    = 0x10;
 STREAM_TYPE_METADATA       = 0x15;
 STREAM_TYPE_AAC            = 0x11;
@@ -142,6 +170,11 @@ STREAM_TYPE_SCTE35         = 0x86;
 
 MAX_BUFFER_SIZE_IN_BYTES   = config["SEQUENCE_LENGTH_IN_BYTES"];
 
+# 90 kHz clock of the PTS
+PTS_CLOCK_RATE             = 90000;
+# Larger PTS steps in either direction are discontinuities
+MAX_PTS_GAP                = 5 * PTS_CLOCK_RATE;
+
 # PES header
 PES_HEADER_LENGTH_OFFSET       = 0x8;
 
@@ -164,103 +197,6 @@ def TS_PACKET_CONT_COUNT(b):
 def TS_PACKET_ADAPTATION_LENGTH(b):
 	return (b[4]);
 
-# This was reverse engineered
-# PES header
-# https://en.wikipedia.org/wiki/Packetized_elementary_stream
-# NAL header
-def is_key_frame(b):
-	offset = TS_HEADER_SIZE;
-	if TS_PACKET_ADAPTATION(b) == TS_PACKET_ADAPTATION_ONLY or TS_PACKET_ADAPTATION(b) == TS_PACKET_ADAPTATION_AND_PAYLOAD:
-		adaptation_field_length = b[offset];
-		offset += (adaptation_field_length + 1);
-	#print "PES header length.... %d" % b[TS_HEADER_SIZE + PES_HEADER_LENGTH_OFFSET];
-	#print "Start code.... %d" % (b[offset] << 16 | b[offset + 1] << 8 | b[offset + 2]);
-	#print "Stream id.... %d" % (b[offset + 3]);
-	offset += PES_HEADER_LENGTH_OFFSET + b[offset + PES_HEADER_LENGTH_OFFSET] + 1;
-	# Simply loop through all the bytes, this is rather slow but I did not find other method to search for IDR frame
-	# Thanks to the Internet and reverse engineering effort of the existing IPTV streaming service I inderstood how the
-	# key frame should look like. 
-	sps_found = False;
-	pps_found = False;
-	idr_found = False;
-	#i = offset
-	#import sys
-	#print "Looking for key frame >>>>>>>>>>>>>>>>>>>>>>>>>>>>"
-	#while i < TS_PACKET_SIZE:
-	#	sys.stdout.write("%02x" % b[i]);
-	#	i += 1;
-	#sys.stdout.write("\n");
-	while offset + 4 < TS_PACKET_SIZE:
-		# Most likely it is possible to avoid the loop if the NALU headers and NALU payload lengths
-		# do not change from I-Frame to I-Frame. This can save quite some CPU cycles
-		sync_word = ((b[offset] & 0x1F) << 24 | b[offset + 1] << 16 | b[offset + 2] << 8 | b[offset + 3]);
-		#sync_word = (b[offset] << 16 | b[offset + 1] << 8 | b[offset + 2]);
-		if sync_word == 0x1:
-			# The NALU type are the first 5 bits 
-			nal_type = (b[offset + 4] & 0x1F);
-			#if nal_type == IDR_FRAME_REVERSE_ENGINEERED or nal_type == IDR_2_FRAME_REVERSE_ENGINEERED:
-			if nal_type == H264_NAL_IDR_SLICE or nal_type == H264_NAL_NONIDR_SLICE:
-				idr_found = True;
-			#if nal_type == SPS_FRAME_REVERSE_ENGINEERED:
-			if nal_type == H264_NAL_SPS:
-				sps_found = True;
-			if nal_type == H264_NAL_PPS:
-				pps_found = True;
-		offset += 1;
-	return idr_found and sps_found and pps_found;
-
-class LookupTable():
-	def __init__(self, stream_id):
-		self.pmt_packets = {};
-		self.pat_packets = {};
-		self.stream_id_pmt_pid = {};
-		self.pmt_pid_stream_id = {};
-		self.stream_id_video_pid = {};
-		self.stream_id_audio_pid = {};
-		self.audio_pid_stream_id = {};
-		self.video_pid_stream_id = {};
-		self.streams = [];
-		self.streams.append(stream_id);
-	def get_stream_ids(self):
-		return self.streams;
-	def is_stream_id_in_list(self, stream_id):
-		return stream_id in self.streams;
-	def set_pat_packet(self, stream_id, packet):
-		self.pat_packets[stream_id] = packet;
-	def set_pmt_pid_stream_id(self, stream_id, pmt_pid):
-		self.pmt_pid_stream_id[pmt_pid] = stream_id;
-		self.stream_id_pmt_pid[stream_id] = pmt_pid;
-	def get_stream_id_by_pmt_pid(self, pmt_pid):
-		return self.pmt_pid_stream_id.get(pmt_pid);
-	def is_valid_pmt_pid(self, pmt_pid):
-		logging.debug("Processing PMT pid %d" % pmt_pid);
-		stream_id = self.pmt_pid_stream_id.get(pmt_pid, None)
-		if stream_id != None:
-			return True;
-		return False;
-	def set_pmt_packet(self, stream_id, packet):
-		self.pmt_packets[stream_id] = packet;
-	def set_video_pid_stream_id(self, stream_id, video_pid):
-		self.stream_id_video_pid[stream_id] = video_pid;
-		self.video_pid_stream_id[video_pid] = stream_id;
-	def set_audio_pid_stream_id(self, stream_id, audio_pid):
-		self.stream_id_audio_pid[stream_id] = audio_pid;
-		self.audio_pid_stream_id[audio_pid] = stream_id;
-	def get_pat_packet(self, video_pid):
-		stream_id = self.video_pid_stream_id[video_pid];
-		return self.pat_packets[stream_id];
-	def get_pmt_packet(self, video_pid):
-		stream_id = self.video_pid_stream_id[video_pid];
-		return self.pmt_packets[stream_id];
-	def get_stream_id_by_video_pid(self, video_pid):
-		return self.video_pid_stream_id.get(video_pid, -1);
-	def get_stream_id_by_audio_pid(self, audio_pid):
-		return self.audio_pid_stream_id.get(audio_pid, -1);
-	def is_valid_video_pid(self, video_pid):
-		return self.video_pid_stream_id.get(video_pid, None) != None;
-	def is_valid_audio_pid(self, audio_pid):
-		return self.audio_pid_stream_id.get(audio_pid, None) != None;
-
 # Sets owner of the folder/file to www-data
 def set_ownership(path):
     uid = pwd.getpwnam("www-data").pw_uid;
@@ -286,118 +222,213 @@ def remove_file(path):
     except:
         return False;
 
-def captureMPEGTS():
+def publish_part(publisher, state, pts):
+    """
+    Hands the bytes filled since the previous part over to the publisher,
+    the part ends right before the PES starting with the given PTS
     """
-    Converts the MP4 files to MPEGTS stream files
+    if state.fill == state.part_start:
+        return;
+    duration = 0;
+    if pts != NO_PTS and state.part_pts != NO_PTS:
+        elapsed = (pts - state.part_pts) % PTS_WRAP;
+        if elapsed <= MAX_PTS_GAP:
+            duration = elapsed / PTS_CLOCK_RATE;
+    publisher.part(state.sequence, state.filling_timestamp,
+        bytes(memoryview(state.buffer)[state.part_start:state.fill]), duration, state.part_independent);
+
+def finish_segment(config, state, writer, pool, publisher, metrics, pts):
     """
-    logging.debug("Binding to socket........................")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind((config["MPEGTS_UDP_IP"], config["MPEGTS_UDP_PORT"]))
-    #sock.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF, 10*1024*1024)
-    logging.debug("Setting socket option.................")
-    logging.debug("Buffer size --------------------------------------")
-    logging.debug(sock.getsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF))
-    logging.debug("Buffer size --------------------------------------")
-
-    lookup = LookupTable(config["VALID_CHANNEL"]);
-    # Precreate buffer twice the size of the maximum buffer size
-    #sequence_buffer = bytearray(MAX_BUFFER_SIZE_IN_BYTES * 2);
-    sequence_buffer = {};
+    Hands the filled segment over to the writer and its last part over to
+    the publisher. The segment ends right before the PES starting with the
+    given PTS, at the end of the stream it ends after its last frame
+    """
+    end_pts = NO_PTS;
+    if state.max_pts != NO_PTS:
+        end_pts = (state.max_pts + state.frame_duration) % PTS_WRAP;
+    if publisher is not None:
+        publish_part(publisher, state, pts if pts != NO_PTS else end_pts);
+        publisher.complete(state.sequence, state.filling_timestamp);
+    meta = None;
+    if config["SEGMENT_SIDECAR"]:
+        meta = {
+            "camera": config["CAMERA_NAME"],
+            "stream_id": state.stream_id,
+            "timestamp": state.filling_timestamp,
+            "bytes": state.fill,
+            "packets": state.fill // TS_PACKET_SIZE,
+            "lost_packets": state.lost,
+            "duplicated_packets": state.duplicated,
+            "errored_packets": state.errored
+        };
+    index_data = None;
+    if config["SEGMENT_INDEX"]:
+        index_data = pack_index(state.fill, end_pts, state.key_frames);
+    state.lost = state.duplicated = state.errored = 0;
+    writer.submit(state.buffer, state.output_folder, state.filling_timestamp,
+        state.fill, pool.release, meta, index_data, metrics);
+    metrics.increment("segments");
+    metrics.set("last_segment", state.filling_timestamp);
+
+def create_publisher(config):
+    """
+    Returns the LL-HLS publisher of the camera, None with LLHLS off
+    """
+    if not config["LLHLS"]:
+        return None;
+    return LivePublisher(config["OUTPUT_FOLDER"], config["LLHLS_PART_DURATION"],
+        config["LLHLS_WINDOW"], set_ownership);
+
+def create_buffer_pool(config, metrics):
+    # Buffers twice the size of the maximum buffer size, one is being filled
+    # while the others wait for the writer
+    return BufferPool(MAX_BUFFER_SIZE_IN_BYTES * 2, config["SEGMENT_WRITER_QUEUE"] + 1, metrics);
+
+def camera_configs(config):
+    """
+    Returns configuration of every camera, each entry of CAMERAS
+    overrides the top level settings
+    """
+    cameras = [];
+    for entry in config.get("CAMERAS", [{}]):
+        camera = dict([(key, value) for key, value in config.items() if key != "CAMERAS"]);
+        camera.update(entry);
+        cameras.append(camera);
+    return cameras;
+
+def captureMPEGTS(config, metrics = None, source = None, pool = None, publisher = None):
+    """
+    Receives the MPEG-TS stream of the camera and slices it into segments.
+    Reads from the UDP socket unless other source is given, returns when
+    the source reaches the end of the stream after handing over the
+    segment being filled. A caller which restarts the source passes the
+    same buffer pool and publisher to every call, so the live playlist
+    goes on where it stopped
+    """
+    if metrics is None:
+        metrics = registry.camera(config["CAMERA_NAME"]);
+    if pool is None:
+        pool = create_buffer_pool(config, metrics);
+    if publisher is None:
+        publisher = create_publisher(config);
+    socket_drops = None;
+    if source is None:
+        logging.debug("Binding to socket........................")
+        # Bursts around I-frames have to fit into the receive buffer
+        source = UdpSource(config["MPEGTS_UDP_IP"], config["MPEGTS_UDP_PORT"], config["MPEGTS_RECEIVE_BUFFER"]);
+        metrics.set("receive_buffer", source.receive_buffer());
+        socket_drops = source.drops;
+        batch = PacketBatch(config["MPEGTS_BATCH_SIZE"], config["MPEGTS_PACKET_SIZE"]);
+    else:
+        batch = PacketBatch(config["PIPE_BATCH_SIZE"]);
+
+    lookup = LookupTable();
+    detector = KeyFrameDetector();
+    writer = get_segment_writer(config);
     stream_id = config["VALID_CHANNEL"]
-    sequence_buffer[stream_id] = bytearray(MAX_BUFFER_SIZE_IN_BYTES * 2);
     base_dir = config["OUTPUT_FOLDER"];
     #program = config["STREAM_ID"];
-    #output_folder = "".join([base_dir, "/", str(filling_timestamp)]);
-    playing_timestamp = {};
-    waiting_timestamp = {};
-    filling_timestamp = {};
-    buffer_fill = {};
-    sequence = {};
-    playlist_constructed = {};
-    output_folder = {};
-    stream_ids = lookup.get_stream_ids();
-    playlist_constructed[stream_id] = False;
-    playing_timestamp[stream_id] = -1;
-    waiting_timestamp[stream_id] = -1;
-    filling_timestamp[stream_id] = int(time.time());
-    sequence[stream_id] = 1;
-    buffer_fill[stream_id] = 0;
-    output_folder[stream_id] = config["OUTPUT_FOLDER"];
-    if not create_folder(output_folder[stream_id]):
+    lookup.add_stream(StreamState(stream_id, pool.acquire(), config["OUTPUT_FOLDER"], int(time.time())));
+    if not create_folder(config["OUTPUT_FOLDER"]):
         logging.debug("Could not create folder. Exiting...");
         #exit(-1);
+    if publisher is not None:
+        # The sequence numbers go on from the previous run
+        for state in lookup.streams.values():
+            state.sequence = publisher.last_sequence + 1;
+    part_ticks = int(config["LLHLS_PART_DURATION"] * PTS_CLOCK_RATE);
+    kinds = lookup.kinds;
+    states = lookup.states;
+    trace = TRACE_PACKETS;
+    streams = list(lookup.streams.values());
+    # Last continuity counter of every PID
+    last_cc = [-1] * PID_COUNT;
     sync_count = 0;
-    lost_packets = 0;
-    pmt_pid = 0x0;
-    pmt_packet_processed = {};
-    video_pid = 0x0;
-    audio_pid = 0x0;
     stream_synchronized = False;
-    cc_counter = -1;
     pat_commited = False;
     pmt_commited = False;
     end_of_pes = False;
     pat_packet_processed = False;
     #pmt_packet = None;
     #playlist_constructed = False;
-    cumulative_buf = bytearray([])
+    packet_index = 0;
     while True:
         try:
-            buf = list([])
-            try:
-                buf, addr = sock.recvfrom(TS_PACKET_SIZE)
-                #sbuf = fd.read(TS_PACKET_SIZE)
-                #fd.write(buf)
-                #continue
-                buf = bytearray(buf)
-                logging.debug("Got data on the socket..........")
-                #sbuf = bytearray(sbuf)
-                #cumulative_buf[len(cumulative_buf):] = sbuf
-                #index = 0
-                #found = False
-                #if not synched:
-                #    while index < len(cumulative_buf):
-                #        if cumulative_buf[index] == SYNC_BYTE:
-                #            if index + TS_PACKET_SIZE > len(cumulative_buf):
-                #                break;
-                #            logging.debug("SYNC BYTE IS NOT THE FIRST ONE %d " % index)
-                #            buf = cumulative_buf[index:index + TS_PACKET_SIZE]
-                #            cumulative_buf = cumulative_buf[index + TS_PACKET_SIZE:]
-                #            logging.debug("SIZE OF THE BUFFER AFTER %d %d" % (len(cumulative_buf), index))
-                #            found = True
-                #            break
-                #        index += 1
-                #if not found:
-                #    
-                #    continue
-            except IOError:
-                logging.critical("Socket was closed, cannot continue");
-                exit(-1)
-            #if len(buf) != TS_PACKET_SIZE:
-            #    logging.debug("Invalid packet size %d " % len(buf))
-            #    continue;
-            if TS_PACKET_SYNC_BYTE(buf) != SYNC_BYTE:
-                logging.critical("Invalid synchronization byte: %d %d" % (TS_PACKET_SYNC_BYTE(buf), SYNC_BYTE) )
+            if packet_index == batch.count:
+                # Receive the next batch of packets and decode all headers at once
+                try:
+                    if source.fill(batch) == 0:
+                        logging.debug("End of the MPEG-TS stream");
+                        for state in streams:
+                            if state.fill > 0:
+                                finish_segment(config, state, writer, pool, publisher, metrics, NO_PTS);
+                            else:
+                                pool.release(state.buffer);
+                        return;
+                except IOError:
+                    logging.critical("Socket was closed, cannot continue");
+                    exit(-1)
+                if trace:
+                    logging.debug("Got %d packets from the source..........", batch.count);
+                metrics.increment("packets", batch.count);
+                sync_bytes, errors, pusis, pids, adaptations, counters = batch.headers();
+                packet_index = 0;
                 continue;
-            if TS_PACKET_TRANS_ERROR(buf):
-                logging.critical("*******************************TS packet error*******************************")
+            index = packet_index;
+            packet_index += 1;
+            buf = batch.packet(index);
+            if sync_bytes[index] != SYNC_BYTE or errors[index]:
+                # Corrupted packet, the PID cannot be trusted so the error
+                # counts against all the streams
+                if sync_bytes[index] != SYNC_BYTE:
+                    logging.critical("Invalid synchronization byte: %d %d", sync_bytes[index], SYNC_BYTE)
+                else:
+                    logging.critical("*******************************TS packet error*******************************")
+                metrics.increment("errored_packets");
+                for stream in streams:
+                    stream.errored += 1;
                 # Skip the packet if we have an error
                 continue;
-            pid = TS_PACKET_PID(buf);
-            logging.debug("**************PID of the packet %d *********************" % (pid));
+            pid = pids[index];
+            if trace:
+                logging.debug("**************PID of the packet %d *********************", pid);
+            kind = kinds[pid];
+            if kind == PID_UNKNOWN:
+                continue;
+            # Continuity counter advances only on packets carrying payload
+            if adaptations[index] & TS_PACKET_PAYLOAD_ONLY:
+                cc = counters[index];
+                last = last_cc[pid];
+                last_cc[pid] = cc;
+                if last >= 0 and cc != ((last + 1) % MAX_CC_COUNTER):
+                    state = states[pid];
+                    if cc == last:
+                        # Duplicate packet, the first copy is already in the segment
+                        metrics.increment("duplicated_packets");
+                        if state is not None:
+                            state.duplicated += 1;
+                        continue;
+                    # The jump is expected when the discontinuity indicator is set
+                    if not (adaptations[index] & TS_PACKET_ADAPTATION_ONLY and buf[4] > 0 and buf[5] & 0x80):
+                        lost = (cc - last - 1) % MAX_CC_COUNTER;
+                        metrics.increment("lost_packets", lost);
+                        if state is not None:
+                            state.lost += lost;
+                        logging.warning("%d packets of PID %d were lost", lost, pid);
             #Have no idea how and why we have here extra byte but it seems to work that way
             offset = TS_HEADER_SIZE;
             #print "Adaptation header %d" % (TS_PACKET_ADAPTATION(buf));
             #print "PUSI %d" % (TS_PACKET_PAYLOAD_START(buf));
             #Parser is implemented according to the https://github.com/jeoliva/mpegts-basic-parser/blob/master/tsparser.c
-            payload_unit_start_indicator = TS_PACKET_PAYLOAD_START(buf);
-            if TS_PACKET_ADAPTATION(buf) == TS_PACKET_ADAPTATION_AND_PAYLOAD or TS_PACKET_ADAPTATION(buf) == TS_PACKET_ADAPTATION:
+            payload_unit_start_indicator = pusis[index];
+            if adaptations[index] == TS_PACKET_ADAPTATION_AND_PAYLOAD or adaptations[index] == TS_PACKET_ADAPTATION_ONLY:
                 #print "Adaptation header present and its length is %d" % (TS_PACKET_ADAPTATION_LENGTH(buf));
                 offset += (TS_PACKET_ADAPTATION_LENGTH(buf) + 1);
-            logging.debug("IS PAT PID? %d" % pid)
-            if pid == PAT_PID and not pat_packet_processed:
+            if kind == PID_PAT and not pat_packet_processed:
             #if pid == PAT_PID and not pat_commited:
                 pat_packet_processed = True;
+                # The PAT is rewritten in place, so it needs its own copy
+                buf = bytearray(buf);
                 logging.debug("**************** PAT PID ******************");
                 # Program association table (PAT)
                 # Lets look into the contents and find the PID of the program map table first
@@ -423,7 +454,8 @@ def captureMPEGTS():
                     #pmt_pid = (((buf[index + 2] & 0x1F) << 8) | ((buf[index + 3] & 0xFF)));
                     pmt_pid = (((buf[index + 2] & 0x1F) << 8) | (buf[index + 3] & 0xFF));
                     logging.debug("Program number: %d, PMT PID %d" % (stream_id, pmt_pid));
-                    if lookup.is_stream_id_in_list(stream_id):
+                    state = lookup.get_stream(stream_id);
+                    if state is not None:
                         #if not pmt_synced:
                         #pmt_fd = open(config["DEMUX"], "w+");
                         #if pmt_fd < 0:
@@ -441,7 +473,7 @@ def captureMPEGTS():
                         # Header offset, adaptation length field, actual length of the adaptation
                         # Set the payload unit start indicator to 1
                         buf[1] = (buf[1] | 0x40);
-                        if TS_PACKET_ADAPTATION(buf) == TS_PACKET_ADAPTATION_AND_PAYLOAD or TS_PACKET_ADAPTATION(buf) == TS_PACKET_ADAPTATION:
+                        if TS_PACKET_ADAPTATION(buf) == TS_PACKET_ADAPTATION_AND_PAYLOAD or TS_PACKET_ADAPTATION(buf) == TS_PACKET_ADAPTATION_ONLY:
                             pointer_length = TS_PACKET_SIZE - CRC32_LENGTH - (TS_PACKET_ADAPTATION_LENGTH(buf) + 1) -  PMT_RECORD_LENGTH - PAT_PREHEADER_LENGTH - 1;
                             offset = TS_HEADER_SIZE + (TS_PACKET_ADAPTATION_LENGTH(buf) + 1);
                         else:
@@ -489,30 +521,27 @@ def captureMPEGTS():
                         buf[offset + 1] = ((crc32 & 0x00ff0000) >> 16);
                         buf[offset + 2] = ((crc32 & 0x0000ff00) >>  8);
                         buf[offset + 3] = (crc32 & 0x000000ff);
-                        pat_packet = copy.deepcopy(buf);
+                        state.pat_packet = bytes(buf);
                         logging.debug("----------------------------------- SETTING PMT PID %d ----------------------------------------" % pmt_pid)
-                        lookup.set_pat_packet(stream_id, pat_packet);
-                        lookup.set_pmt_pid_stream_id(stream_id, pmt_pid);
+                        lookup.set_pmt_pid(state, pmt_pid);
                         #break;
                     index += PMT_RECORD_LENGTH;
                 #if not pmt_pid_found:
                 #	print "Program was not found in the PAT table";
                 #	continue; # Or should we exit
                 continue;
-            elif pid == PAT_PID and pat_packet_processed:
+            elif kind == PID_PAT:
                 continue;
             # We have found the PMT PID lets look into the internals
             # to find out the PIDs for audio and video elementary streams
             #print pmt_pid == pid, pmt_synced, (not pat_commited)
             #if pid == pmt_pid and pmt_synced and (not pmt_commited):
             #if pid == pmt_pid and pmt_packet_processed:
-            logging.debug("Current PID " + str(pid))
-            logging.debug("Stream ID " + str(stream_id))
-            if lookup.is_valid_pmt_pid(pid) and not pmt_packet_processed.get(pid, False):
-                pmt_packet_processed[pid] = True;
-                pmt_packet = copy.deepcopy(buf);
-                stream_id = lookup.get_stream_id_by_pmt_pid(pid)
-                lookup.set_pmt_packet(stream_id, pmt_packet);
+            state = states[pid];
+            if kind == PID_PMT and not state.pmt_processed:
+                state.pmt_processed = True;
+                state.pmt_packet = bytes(buf);
+                stream_id = state.stream_id;
                 logging.debug("**************** PMT PID ******************");
                 if payload_unit_start_indicator:
                     logging.debug("PUSI bit is set. Skipping %d bytes" % (buf[offset]));
@@ -544,10 +573,11 @@ def captureMPEGTS():
                     # and MPEG2 audio codec is being used for audio compression
                     logging.debug("Stream type: %d" % (stream_type));
                     logging.debug("Elementary PID: %d" % (elementary_pid)); 
-                    if stream_type == STREAM_TYPE_H264:
+                    if stream_type == STREAM_TYPE_H264 or stream_type == STREAM_TYPE_H265:
                         #if not video_pid:
                         video_pid = elementary_pid;
-                        lookup.set_video_pid_stream_id(stream_id, video_pid);
+                        lookup.set_video_pid(state, video_pid);
+                        detector.set_codec(video_pid, stream_type);
                         #video_fd = open(config["DEMUX"], "w+");
                         logging.debug("Seting up filter for video elementary stream %d for stream %d" % (video_pid, stream_id))
                         #if video_fd < 0:
@@ -560,7 +590,7 @@ def captureMPEGTS():
                     if stream_type == STREAM_TYPE_MPEG2_AUDIO or stream_type == STREAM_TYPE_AAC or stream_type == STREAM_TYPE_AC3 or stream_type == STREAM_TYPE_MPEG1_AUDIO:
                         #if not audio_pid:
                         audio_pid = elementary_pid;
-                        lookup.set_audio_pid_stream_id(stream_id, audio_pid);
+                        lookup.set_audio_pid(state, audio_pid);
                         logging.debug("Seting up filter for audio elementary stream %d" % audio_pid) 
                         #audio_fd = open(config["DEMUX"], "w+");
                         #if audio_fd < 0:
@@ -570,7 +600,7 @@ def captureMPEGTS():
                         #if add_pidfilter(fd, audio_pid):
                         #	logging.debug("Cannot set video filter. Exiting...");
                         #	exit(-1);
-            elif lookup.is_valid_pmt_pid(pid) and pmt_packet_processed.get(pid, False):
+            elif kind == PID_PMT:
                 continue;
             #if pid == PAT_PID:
             #	print "Storing the PAT in the buffer... This should occur only once"
@@ -591,82 +621,174 @@ def captureMPEGTS():
             #	print ">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>"
             #	print "Is key frame %d" % is_key_frame(buf);
             #	print "<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<"
-            logging.debug("Looking up VIDEO PID " + str(pid))
-            if lookup.is_valid_video_pid(pid) and payload_unit_start_indicator == 0x1 and is_key_frame(buf):
-                stream_id = lookup.get_stream_id_by_video_pid(pid);
-                #print "Stream ID %d, Buffer fill level %d, Maximum buffer size %d " % (stream_id, buffer_fill[stream_id], MAX_BUFFER_SIZE_IN_BYTES);
-                #print "Stream id %d" % stream_id;
-                if buffer_fill[stream_id] >= MAX_BUFFER_SIZE_IN_BYTES:
-                    # We need to copy the sequence buffer otherwise some packets can be overwritten
-                    sequence_buffer_copy = copy.deepcopy(sequence_buffer[stream_id][0:buffer_fill[stream_id]]);
-                    threading.Thread(target=save_buffer, args=(sequence_buffer_copy, output_folder[stream_id], filling_timestamp[stream_id])).start();
-                    filling_timestamp[stream_id] = int(time.time());
-                    #output_folder[stream_id] = "".join([base_dir, "/", str(stream_id), "/", str(filling_timestamp[stream_id])]);
-                    #create_folder(output_folder[stream_id]);
-                    # Copy PAT, PMT and first packet of a new PES carrying video data
-                    # First two packets of a segment MUST be PAT and PMT packets 
-                    # as described in https://tools.ietf.org/html/rfc8216#section-3
-                    buffer_fill[stream_id] = 0;
-                    sequence_buffer[stream_id][buffer_fill[stream_id]:buffer_fill[stream_id] + TS_PACKET_SIZE] = pat_packet;
-                    buffer_fill[stream_id] += TS_PACKET_SIZE;
-                    sequence_buffer[stream_id][buffer_fill[stream_id]:buffer_fill[stream_id] + TS_PACKET_SIZE] = pmt_packet;
-                    buffer_fill[stream_id] += TS_PACKET_SIZE;
-                    continue;
-                #if (sequence[stream_id] == MAX_SEQUENCE_PER_FOLDER / 2) and buffer_fill[stream_id] >= (MAX_BUFFER_SIZE_IN_BYTES * 0.1) and not playlist_constructed[stream_id] and playing_timestamp[stream_id] > 0:
-                #	playlist_constructed[stream_id] = True;
-                #	logging.debug("Constructing playlist (timestamp %d)" % (playing_timestamp[stream_id]));
-                #	threading.Thread(target=construct_playlist, args=("".join([base_dir, "/", str(stream_id), "/", str(playing_timestamp[stream_id])]), "".join([base_dir, "/", str(stream_id), "/"]), WEB_PATH, stream_id, playing_timestamp[stream_id], config["ENABLE_STREAM_ENCRYPTION"], )).start();
-                sequence_buffer[stream_id][buffer_fill[stream_id]:buffer_fill[stream_id] + TS_PACKET_SIZE] = buf;
-                buffer_fill[stream_id] += TS_PACKET_SIZE;
-                continue;
-                #elif pid == video_pid and pid != 0x0:
-            elif lookup.is_valid_video_pid(pid):
-                stream_id = lookup.get_stream_id_by_video_pid(pid);
-                logging.debug("Stream id %d, buffer fill %d" % (stream_id, buffer_fill[stream_id]));
-                sequence_buffer[stream_id][buffer_fill[stream_id]:buffer_fill[stream_id] + TS_PACKET_SIZE] = buf;
-                buffer_fill[stream_id] += TS_PACKET_SIZE;
+            if kind == PID_VIDEO:
+                if payload_unit_start_indicator == 0x1:
+                    pts = pes_pts(buf);
+                    key_frame = detector.is_key_frame(buf, pid);
+                    if key_frame and state.fill >= MAX_BUFFER_SIZE_IN_BYTES:
+                        # The filled buffer goes to the writer as is and comes back to
+                        # the pool once written, the demuxer continues with a free one
+                        finish_segment(config, state, writer, pool, publisher, metrics, pts);
+                        state.buffer = pool.acquire();
+                        if socket_drops is not None:
+                            metrics.set("socket_drops", socket_drops());
+                        state.filling_timestamp = int(time.time());
+                        state.fill = 0;
+                        state.key_frames = [];
+                        state.max_pts = NO_PTS;
+                        state.sequence += 1;
+                        state.part_start = 0;
+                        state.part_pts = pts;
+                        state.part_independent = True;
+                    elif publisher is not None and pts != NO_PTS:
+                        elapsed = (pts - state.part_pts) % PTS_WRAP;
+                        if state.part_pts == NO_PTS or MAX_PTS_GAP < elapsed < PTS_WRAP - MAX_PTS_GAP:
+                            state.part_pts = pts;
+                        # Parts end at a frame boundary and do not exceed the part target
+                        elif part_ticks - state.frame_duration <= elapsed <= MAX_PTS_GAP:
+                            publish_part(publisher, state, pts);
+                            state.part_start = state.fill;
+                            state.part_pts = pts;
+                            state.part_independent = key_frame;
+                    if pts != NO_PTS:
+                        # Frames come in the decoding order, the shortest step
+                        # forward is the duration of a frame
+                        if state.last_pts != NO_PTS:
+                            step = (pts - state.last_pts) % PTS_WRAP;
+                            if 0 < step < PTS_WRAP // 2 and (state.frame_duration == 0 or step < state.frame_duration):
+                                state.frame_duration = step;
+                        state.last_pts = pts;
+                        if state.max_pts == NO_PTS or (pts - state.max_pts) % PTS_WRAP < PTS_WRAP // 2:
+                            state.max_pts = pts;
+                    if key_frame:
+                        # Copy PAT, PMT and first packet of a new PES carrying video data
+                        # First two packets of a segment MUST be PAT and PMT packets 
+                        # as described in https://tools.ietf.org/html/rfc8216#section-3
+                        # Every key frame gets them, so a byte range starting at any
+                        # indexed key frame can be decoded on its own
+                        fill = state.fill;
+                        state.key_frames.append((pts, fill));
+                        state.buffer[fill:fill + TS_PACKET_SIZE] = state.pat_packet;
+                        state.buffer[fill + TS_PACKET_SIZE:fill + TS_PACKET_SIZE * 2] = state.pmt_packet;
+                        # Copies continue the continuity counters of their own
+                        state.buffer[fill + 3] = (state.buffer[fill + 3] & 0xF0) | state.psi_cc;
+                        state.buffer[fill + TS_PACKET_SIZE + 3] = (state.buffer[fill + TS_PACKET_SIZE + 3] & 0xF0) | state.psi_cc;
+                        state.psi_cc = (state.psi_cc + 1) % MAX_CC_COUNTER;
+                        state.fill = fill + TS_PACKET_SIZE * 2;
+                if trace:
+                    logging.debug("Stream id %d, buffer fill %d", state.stream_id, state.fill);
+                fill = state.fill;
+                state.buffer[fill:fill + TS_PACKET_SIZE] = buf;
+                state.fill = fill + TS_PACKET_SIZE;
                 continue;
-            if lookup.is_valid_audio_pid(pid):
-                stream_id = lookup.get_stream_id_by_audio_pid(pid);
-                #if pid == audio_pid and pid != 0x0:
-                logging.debug("AUDIO Stream id %d, buffer fill %d" % (stream_id, buffer_fill[stream_id]));
-                sequence_buffer[stream_id][buffer_fill[stream_id]:buffer_fill[stream_id] + TS_PACKET_SIZE] = buf;
-                buffer_fill[stream_id] += TS_PACKET_SIZE;
+            if kind == PID_AUDIO:
+                if trace:
+                    logging.debug("AUDIO Stream id %d, buffer fill %d", state.stream_id, state.fill);
+                fill = state.fill;
+                state.buffer[fill:fill + TS_PACKET_SIZE] = buf;
+                state.fill = fill + TS_PACKET_SIZE;
         except Exception as e:
             logging.critical("Exception occured while converting the file")
             logging.critical(e);
             traceback.print_exc()
         #sleep(1)
 
-# Saves the buffer into the output folder
-def save_buffer(buf, output_folder, timestamp):
-	#print "Saving the buffer of size %d" % (len(buf));
-	try:
-		# Obtain the lock
-		#fd = open("".join([output_folder, "/", "lock"]), "w+");
-		#fd.write("processing...");
-		#fd.flush();
-		#fd.close();
-		fd = open("".join([output_folder, "/", str(timestamp), ".raw"]), "wb");
-		logging.debug("Saving the buffer...")
-		fd.write(buf);
-		fd.flush();
-		fd.close();
-		#I think there is no need to do extra conversion since we already have MPEG2-TS stream which should be readable by the players
-		#The conversion is needed if we need to use different container type for example MPEG-4 contaiener.
-		#Also Flash does not support MPEG2 audio, so we need to transcode audio signal to AAC for example
-		logging.debug("SAVGING BUFFER TO OUTPUT: TIMESTAMP: %d" % timestamp)
-		ts_path_no_extension = "".join([output_folder, "/", str(timestamp)]);
-		result=os.popen("".join([config["EXEC_DIR"], "/", config["CONVERT_RAW_TS"], " ", ts_path_no_extension, " ", output_folder])).read().strip();
-		#os.remove("".join([output_folder, "/", "sequence", str(timestamp), ".raw"]));
-		set_ownership("".join([ts_path_no_extension, ".ts"]));
-		# Release the lock
-		#remove_file("".join([output_folder, "/", "lock"]));
-		#set_ownership("".join([output_folder, "/", "sequence", str(timestamp), ".ts"]));
-	except Exception as e:
-		logging.debug("Error saving the buffer...")
-		logging.debug(str(e));
-		exit(-1);
+# Writes the segments of all the cameras handled by the process
+segment_writer = None;
+segment_writer_lock = threading.Lock();
+
+def get_segment_writer(config):
+    global segment_writer;
+    with segment_writer_lock:
+        if segment_writer is None:
+            convert_script = None;
+            if config["TRANSCODE_AUDIO"]:
+                convert_script = "".join([config["EXEC_DIR"], "/", config["CONVERT_RAW_TS"]]);
+            segment_writer = SegmentWriter(config["SEGMENT_WRITER_THREADS"],
+                config["SEGMENT_WRITER_QUEUE"],
+                config["SEGMENT_FSYNC"],
+                set_ownership,
+                convert_script,
+                segment_written,
+                reclaim_space,
+                config["SEGMENT_WRITER_DROP_POLICY"],
+                config["SEGMENT_WRITER_BLOCK_TIMEOUT"]);
+        return segment_writer;
+
+# Retention policies of the cameras handled by the process by their folder
+retention_policies = {};
+retention_policies_lock = threading.Lock();
+
+def get_retention_policy(config):
+    folder = os.path.normpath(config["OUTPUT_FOLDER"]);
+    with retention_policies_lock:
+        if folder not in retention_policies:
+            retention_policies[folder] = RetentionPolicy(folder,
+                int(config["MAX_VIDEO_LIFETIME"]),
+                int(config["MAX_STORAGE_BYTES"]),
+                int(config["RETENTION_BUCKET_SECONDS"]),
+                int(config["MIN_FREE_BYTES"]));
+        return retention_policies[folder];
+
+def segment_written(path):
+    """
+    Tracks the file the writer has put in place
+    """
+    folder, name = os.path.split(path);
+    policy = retention_policies.get(os.path.normpath(folder), None);
+    if policy is not None:
+        policy.add(name);
+
+def reclaim_space(folder):
+    """
+    Removes the oldest recordings of the camera when the volume is
+    running out of space, called by the writer before every segment
+    """
+    policy = retention_policies.get(os.path.normpath(folder), None);
+    if policy is not None:
+        policy.reclaim(int(time.time()));
+
+# Linux prctl option which signals the child when the parent dies
+PR_SET_PDEATHSIG = 0x1;
+# Linux fcntl command which changes the capacity of the pipe
+F_SETPIPE_SZ = 1031;
+
+def terminate_with_parent():
+    """
+    Makes sure ffmpeg does not outlive the capture process
+    """
+    try:
+        libc = ctypes.CDLL("libc.so.6", use_errno=True);
+        libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM);
+    except Exception:
+        pass;
+
+def ffmpeg_command(config, output):
+    """
+    ffmpeg remuxing the RTSP stream of the camera into MPEG-TS
+    """
+    return ["ffmpeg", \
+            "-i", \
+            config["RTSP_URL"], \
+            #"-rtsp_transport", \
+            #config["TRANSPORT_PROTOCOL"], \
+            "-vcodec", "copy", \
+            "-acodec", "copy", \
+            "-preset", "veryfast",\
+            "-mpegts_flags", "pat_pmt_at_frames", \
+            "-copyts", \
+            "-f", "mpegts", \
+            output, \
+            #"out.ts"
+            ];
+
+def udp_url(config):
+    """
+    Where ffmpeg sends the datagrams, several packets per datagram cut the
+    number of system calls on both sides
+    """
+    return "udp://%s:%d?pkt_size=%d&buffer_size=%d" % (config["MPEGTS_UDP_IP"], config["MPEGTS_UDP_PORT"],
+        config["MPEGTS_PACKET_SIZE"], config["MPEGTS_SEND_BUFFER"]);
 
 def capturing(config):
     """
@@ -677,20 +799,8 @@ def capturing(config):
         if not os.path.exists(config["OUTPUT_FOLDER"]):
             os.makedirs(folder)
         try:
-            subprocess.run(["ffmpeg", \
-                    "-i", \
-                    config["RTSP_URL"], \
-                    #"-rtsp_transport", \
-                    #config["TRANSPORT_PROTOCOL"], \
-                    "-vcodec", "copy", \
-                    "-acodec", "copy", \
-                    "-preset", "veryfast",\
-                    "-mpegts_flags", "pat_pmt_at_frames", \
-                    "-copyts", \
-                    "-f", "mpegts", \
-                    "udp://" + str(config["MPEGTS_UDP_IP"]) + ":" + str(config["MPEGTS_UDP_PORT"]) + "?pkt_size=188&buffer_size=65535", \
-                    #"out.ts"
-                    ])
+            subprocess.run(ffmpeg_command(config, udp_url(config)), \
+                    preexec_fn = terminate_with_parent)
         except Exception as e:
             logging.critical("Exception occured while capturing the video stream ....!!!!")
             logging.critical(e);
@@ -698,37 +808,93 @@ def capturing(config):
         logging.debug("Capturing process died, restarting the ffmpeg process")
         sleep(10)
 
-def cleanup(config):
+def capturing_pipe(config):
     """
-    Cleans up old MP4 files
+    Runs ffmpeg writing MPEG-TS to its standard output and demuxes the
+    stream in the same thread, there is no loopback socket in between
     """
+    metrics = registry.camera(config["CAMERA_NAME"]);
+    # Outlive the restarts of ffmpeg
+    pool = create_buffer_pool(config, metrics);
+    publisher = create_publisher(config);
     while True:
+        folder = config["OUTPUT_FOLDER"]
+        if not os.path.exists(config["OUTPUT_FOLDER"]):
+            os.makedirs(folder)
         try:
-            if os.path.exists(config["OUTPUT_FOLDER"]):
-                files = os.listdir(config["OUTPUT_FOLDER"])
-                now = int(datetime.now().timestamp())
-                for file in files:
-                    if re.match("[0-9]+\.(mp4|mpeg4|mkv|ts)", file):
-                        ts = int(file.split(".")[0])
-                        if ts <= now - int(config["MAX_VIDEO_LIFETIME"]):
-                            logging.debug("Removing the file")
-                            os.remove(file)
+            process = subprocess.Popen(ffmpeg_command(config, "pipe:1"), \
+                    stdout = subprocess.PIPE, \
+                    bufsize = 0, \
+                    preexec_fn = terminate_with_parent)
+            try:
+                # Larger pipe absorbs the bursts around I-frames
+                fcntl.fcntl(process.stdout.fileno(), F_SETPIPE_SZ, config["PIPE_BUFFER_SIZE"]);
+            except OSError as e:
+                logging.debug("Cannot resize the pipe: %s" % str(e));
+            captureMPEGTS(config, metrics, PipeSource(process.stdout), pool, publisher);
+            process.stdout.close();
+            process.wait();
         except Exception as e:
-            logging.critical("Exception occured while removing the file... !!!")
+            logging.critical("Exception occured while capturing the video stream ....!!!!")
             logging.critical(e);
-        sleep(config["CLEAN_UP_INTERVAL"])
-
-capture_loop = threading.Thread(target = capturing, args = (config, ), daemon = True);
-capture_loop.start()
-
-cleanup_loop = threading.Thread(target = cleanup, args = (config, ), daemon = True);
-cleanup_loop.start()
-
-capture_ts_loop = threading.Thread(target = captureMPEGTS, args = (), daemon = True);
-capture_ts_loop.start();
-
-main_loop = True;
+            traceback.print_exc()
+        logging.debug("Capturing process died, restarting the ffmpeg process")
+        sleep(10)
 
-while main_loop:
-    logging.debug("Running RTSP stream capturing application");
-    sleep(10)
+def cleanup(cameras):
+    """
+    Removes the recordings of the cameras which are too old or do not fit
+    into their quota. Must run in the process which writes the segments of
+    the cameras, the writer reports the new files after the initial scan
+    """
+    policies = [];
+    for camera in cameras:
+        policy = get_retention_policy(camera);
+        policy.scan();
+        policies.append((camera, policy));
+    # The camera cleaned up most often sets the pace
+    interval = min([camera["CLEAN_UP_INTERVAL"] for camera in cameras]);
+    while True:
+        for camera, policy in policies:
+            try:
+                removed = policy.cleanup(int(datetime.now().timestamp()));
+                if removed:
+                    logging.debug("Removed %d files of the camera %s" % (removed, camera["CAMERA_NAME"]));
+                metrics = registry.camera(camera["CAMERA_NAME"]);
+                metrics.increment("retention_removed_files", removed);
+                metrics.set("retention_stored_bytes", policy.size);
+            except Exception as e:
+                logging.critical("Exception occured while removing the file... !!!")
+                logging.critical(e);
+        sleep(interval)
+
+def start_camera(config):
+    """
+    Starts the ffmpeg and the demuxer threads of the camera
+    """
+    if config["INGEST_MODE"] == "pipe":
+        capture_loop = threading.Thread(target = capturing_pipe, args = (config, ), daemon = True);
+        capture_loop.start()
+        return [capture_loop];
+    capture_loop = threading.Thread(target = capturing, args = (config, ), daemon = True);
+    capture_loop.start()
+    capture_ts_loop = threading.Thread(target = captureMPEGTS, args = (config, ), daemon = True);
+    capture_ts_loop.start();
+    return [capture_loop, capture_ts_loop];
+
+if __name__ == "__main__":
+    # Configure logging to console and file
+    configure_logging(config, LOG_FILE);
+    cameras = camera_configs(config);
+
+    cleanup_loop = threading.Thread(target = cleanup, args = (cameras, ), daemon = True);
+    cleanup_loop.start()
+
+    for camera in cameras:
+        start_camera(camera);
+
+    main_loop = True;
+
+    while main_loop:
+        logging.debug("Running RTSP stream capturing application");
+        sleep(10)
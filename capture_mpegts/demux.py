@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# socket functionality
+import socket
+
+# Logging
+import logging
+
+# NumPy is optional, strided slicing of the buffer is used without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TS_PACKET_SIZE             = 0xBC;
+SYNC_BYTE                  = 0x47;
+
+# Linux socket option which ignores net.core.rmem_max, needs CAP_NET_ADMIN
+SO_RCVBUFFORCE             = getattr(socket, "SO_RCVBUFFORCE", 33);
+
+if numpy is not None:
+    # Header of the TS packet as seen by NumPy, the PID and the flags
+    # share a big endian 16 bit word
+    TS_PACKET_DTYPE = numpy.dtype([
+        ("sync", numpy.uint8),
+        ("flags_pid", ">u2"),
+        ("flags", numpy.uint8),
+        ("payload", numpy.uint8, (TS_PACKET_SIZE - 4, ))
+    ]);
+
+def decode_headers(buffer, count, offset = 0):
+    """
+    Decodes the headers of count packets stored back to back in the
+    buffer (bytearray, mmap, ...) starting at the offset
+    """
+    if numpy is not None:
+        packets = numpy.frombuffer(buffer, dtype = TS_PACKET_DTYPE, count = count, offset = offset);
+        flags_pid = packets["flags_pid"];
+        flags = packets["flags"];
+        return (packets["sync"].tolist(),
+            (flags_pid >> 15).tolist(),
+            ((flags_pid >> 14) & 0x1).tolist(),
+            (flags_pid & 0x1FFF).tolist(),
+            ((flags >> 4) & 0x3).tolist(),
+            (flags & 0xF).tolist());
+    # Strided slices pick the same header byte out of every packet
+    end = offset + count * TS_PACKET_SIZE;
+    sync = buffer[offset:end:TS_PACKET_SIZE];
+    b1 = buffer[offset + 1:end:TS_PACKET_SIZE];
+    b2 = buffer[offset + 2:end:TS_PACKET_SIZE];
+    b3 = buffer[offset + 3:end:TS_PACKET_SIZE];
+    return (list(sync),
+        [b >> 7 for b in b1],
+        [(b >> 6) & 0x1 for b in b1],
+        [((h & 0x1F) << 8) | l for h, l in zip(b1, b2)],
+        [(b >> 4) & 0x3 for b in b3],
+        [b & 0xF for b in b3]);
+
+class UdpSource():
+    """
+    Datagrams sent by ffmpeg to the loopback interface
+    """
+    def __init__(self, ip, port, receive_buffer = 0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM);
+        if receive_buffer:
+            self.set_receive_buffer(receive_buffer);
+        self.sock.bind((ip, port));
+        self.port = self.sock.getsockname()[1];
+    def set_receive_buffer(self, size):
+        """
+        Grows the receive buffer of the socket and returns the effective
+        size. The kernel caps the request at net.core.rmem_max unless the
+        process is allowed to force it
+        """
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size);
+        # Linux reports the doubled value including the bookkeeping overhead
+        effective = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2;
+        if effective < size:
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, size);
+                effective = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2;
+            except OSError:
+                pass;
+        if effective < size:
+            logging.warning("Receive buffer is %d bytes instead of %d, raise net.core.rmem_max" % (effective, size));
+        else:
+            logging.info("Receive buffer is %d bytes" % effective);
+        return effective;
+    def receive_buffer(self):
+        return self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2;
+    def drops(self):
+        """
+        Datagrams the kernel dropped because the receive buffer was full,
+        taken from /proc/net/udp. Returns -1 when not available
+        """
+        local_port = ":%04X" % self.port;
+        try:
+            with open("/proc/net/udp") as fd:
+                for line in fd.readlines()[1:]:
+                    fields = line.split();
+                    if fields[1].endswith(local_port):
+                        return int(fields[-1]);
+        except (OSError, ValueError, IndexError):
+            pass;
+        return -1;
+    def fill(self, batch):
+        # Empty datagrams are not the end of the stream
+        while batch.receive(self.sock) == 0:
+            pass;
+        return batch.count;
+
+class PipeSource():
+    """
+    MPEG-TS written by ffmpeg to its standard output. When the demuxer
+    falls behind, the pipe fills up and ffmpeg blocks instead of dropping
+    """
+    def __init__(self, stream):
+        self.stream = stream;
+    def fill(self, batch):
+        return batch.read(self.stream);
+
+class PacketBatch():
+    """
+    Preallocated receive buffer holding a batch of TS packets. Datagrams
+    are received straight into the buffer and the header fields of all
+    packets are extracted at once
+    """
+    def __init__(self, max_packets, datagram_size = TS_PACKET_SIZE):
+        # At least one datagram has to fit into the buffer
+        self.capacity = max(max_packets, datagram_size // TS_PACKET_SIZE) * TS_PACKET_SIZE;
+        self.datagram_size = datagram_size;
+        self.buffer = bytearray(self.capacity);
+        self.view = memoryview(self.buffer);
+        self.size = 0;
+        self.filled = 0;
+        self.count = 0;
+    def receive(self, sock):
+        """
+        Blocks until the first datagram arrives, then drains whatever is
+        already queued in the socket without blocking
+        """
+        size = sock.recv_into(self.view[0:], self.datagram_size);
+        size -= size % TS_PACKET_SIZE;
+        while size + self.datagram_size <= self.capacity:
+            try:
+                received = sock.recv_into(self.view[size:], self.datagram_size, socket.MSG_DONTWAIT);
+            except (BlockingIOError, socket.timeout):
+                # Sockets with a timeout wait for the data even with MSG_DONTWAIT,
+                # keep the packets received so far
+                break;
+            # Datagrams always carry whole packets, drop the trailing garbage
+            size += received - (received % TS_PACKET_SIZE);
+        self.size = size;
+        self.filled = size;
+        self.count = size // TS_PACKET_SIZE;
+        return self.count;
+    def read(self, stream):
+        """
+        Reads a chunk of the byte stream (pipe) into the buffer. The stream
+        is not aligned to the datagrams, so the incomplete packet at the end
+        of the chunk is carried over to the next read. Returns 0 at the end
+        of the stream
+        """
+        carry = self.filled - self.size;
+        if carry > 0:
+            self.buffer[0:carry] = self.buffer[self.size:self.filled];
+        while True:
+            received = stream.readinto(self.view[carry:]);
+            if not received:
+                self.size = self.filled = self.count = 0;
+                return 0;
+            filled = carry + received;
+            # Skip the garbage until the next synchronization byte
+            start = 0;
+            if self.buffer[0] != SYNC_BYTE:
+                start = self.buffer.find(SYNC_BYTE, 0, filled);
+                if start < 0:
+                    start = filled;
+                self.buffer[0:filled - start] = self.buffer[start:filled];
+                filled -= start;
+            carry = filled;
+            if filled >= TS_PACKET_SIZE:
+                break;
+        self.filled = filled;
+        self.size = filled - (filled % TS_PACKET_SIZE);
+        self.count = self.size // TS_PACKET_SIZE;
+        return self.count;
+    def packet(self, index):
+        """
+        Returns a zero-copy view of the packet
+        """
+        offset = index * TS_PACKET_SIZE;
+        return self.view[offset:offset + TS_PACKET_SIZE];
+    def headers(self):
+        """
+        Returns lists of sync bytes, transport error indicators, payload
+        unit start indicators, PIDs, adaptation field controls and
+        continuity counters for every packet in the batch
+        """
+        return decode_headers(self.buffer, self.count);
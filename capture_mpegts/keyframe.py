@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+TS_PACKET_SIZE             = 0xBC;
+TS_HEADER_SIZE             = 0x4;
+
+# Adaptation field types
+TS_PACKET_ADAPTATION_ONLY        = 0x2;
+TS_PACKET_ADAPTATION_AND_PAYLOAD = 0x3;
+
+# PES header
+PES_HEADER_LENGTH_OFFSET   = 0x8;
+
+# Stream types carrying video we know how to slice
+STREAM_TYPE_H264           = 0x1b;
+STREAM_TYPE_H265           = 0x24;
+
+# H264
+H264_NAL_NONIDR_SLICE      = 0x1;
+H264_NAL_IDR_SLICE         = 0x5;
+H264_NAL_SPS               = 0x7;
+H264_NAL_PPS               = 0x8;
+
+# H265
+H265_NAL_BLA_W_LP          = 16;
+H265_NAL_CRA               = 21;
+H265_NAL_IRAP_RESERVED     = 23;
+H265_NAL_VPS               = 32;
+H265_NAL_SPS               = 33;
+H265_NAL_PPS               = 34;
+
+NAL_START_CODE             = b"\x00\x00\x01";
+
+# Roles of the NAL units which make up a key frame
+NAL_PARAMETER_SET_1        = 0x1;
+NAL_PARAMETER_SET_2        = 0x2;
+NAL_PARAMETER_SET_3        = 0x4;
+NAL_PICTURE                = 0x8;
+
+H264_KEY_FRAME             = NAL_PARAMETER_SET_1 | NAL_PARAMETER_SET_2 | NAL_PICTURE;
+H265_KEY_FRAME             = NAL_PARAMETER_SET_1 | NAL_PARAMETER_SET_2 | NAL_PARAMETER_SET_3 | NAL_PICTURE;
+
+def h264_nal_role(header):
+    nal_type = header & 0x1F;
+    # Same as before: SPS, PPS and a slice in the first packet of the PES
+    if nal_type == H264_NAL_IDR_SLICE or nal_type == H264_NAL_NONIDR_SLICE:
+        return NAL_PICTURE;
+    if nal_type == H264_NAL_SPS:
+        return NAL_PARAMETER_SET_1;
+    if nal_type == H264_NAL_PPS:
+        return NAL_PARAMETER_SET_2;
+    return 0;
+
+def h265_nal_role(header):
+    nal_type = (header >> 1) & 0x3F;
+    if H265_NAL_BLA_W_LP <= nal_type <= H265_NAL_IRAP_RESERVED:
+        return NAL_PICTURE;
+    if nal_type == H265_NAL_VPS:
+        return NAL_PARAMETER_SET_1;
+    if nal_type == H265_NAL_SPS:
+        return NAL_PARAMETER_SET_2;
+    if nal_type == H265_NAL_PPS:
+        return NAL_PARAMETER_SET_3;
+    return 0;
+
+def es_offset(b):
+    """
+    Offset of the elementary stream data in the packet which starts a PES
+    """
+    offset = TS_HEADER_SIZE;
+    adaptation = (b[3] & 0x30) >> 4;
+    if adaptation == TS_PACKET_ADAPTATION_ONLY or adaptation == TS_PACKET_ADAPTATION_AND_PAYLOAD:
+        offset += (b[offset] + 1);
+    if offset + PES_HEADER_LENGTH_OFFSET >= TS_PACKET_SIZE:
+        return TS_PACKET_SIZE;
+    return offset + PES_HEADER_LENGTH_OFFSET + b[offset + PES_HEADER_LENGTH_OFFSET] + 1;
+
+class KeyFrameDetector():
+    """
+    Finds key frames by jumping between NAL start codes with bytes.find.
+    Cameras repeat the same parameter sets on every key frame, so the
+    positions of the NAL units of the last key frame are remembered per
+    PID and checked first
+    """
+    def __init__(self):
+        self.codecs = {};
+        self.layouts = {};
+    def set_codec(self, pid, stream_type):
+        self.codecs[pid] = stream_type;
+        self.layouts.pop(pid, None);
+    def is_key_frame(self, b, pid = None):
+        if not isinstance(b, (bytes, bytearray)):
+            b = bytes(b);
+        if self.codecs.get(pid, STREAM_TYPE_H264) == STREAM_TYPE_H265:
+            nal_role = h265_nal_role;
+            key_frame = H265_KEY_FRAME;
+        else:
+            nal_role = h264_nal_role;
+            key_frame = H264_KEY_FRAME;
+        start = es_offset(b);
+        # Fast path: the NAL units sit where they were in the previous key frame
+        layout = self.layouts.get(pid, None);
+        if layout is not None:
+            found = 0;
+            for position, role in layout:
+                if b[position:position + 3] != NAL_START_CODE or nal_role(b[position + 3]) != role:
+                    break;
+                found |= role;
+            if found == key_frame:
+                return True;
+        found = 0;
+        positions = [];
+        position = b.find(NAL_START_CODE, start);
+        while position >= 0 and position + 3 < TS_PACKET_SIZE:
+            role = nal_role(b[position + 3]);
+            if role:
+                found |= role;
+                positions.append((position, role));
+                if found == key_frame:
+                    self.layouts[pid] = positions;
+                    return True;
+            position = b.find(NAL_START_CODE, position + 3);
+        return False;
+
+# Detector used by the callers which do not track PIDs
+default_detector = KeyFrameDetector();
+
+def is_key_frame(b):
+    return default_detector.is_key_frame(b);
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Logging
+import logging
+
+# Import OS stuff
+import os
+
+# Regular expressions
+import re
+
+# State file
+import json
+
+# Timing
+import time
+
+# Threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Folder of the parts inside of the output folder of the camera
+PARTS_FOLDER               = "parts";
+# Description of the live edge read by the backend
+LIVE_STATE_FILE            = "live.json";
+
+PART_FILE_PATTERN          = re.compile(r"^([0-9]+)\.[0-9]+\.ts$");
+
+class LivePublisher():
+    """
+    Publishes the segment being filled as LL-HLS partial segments. Every
+    part is a slice of the sequence buffer written to parts/<segment
+    timestamp>.<part index>.ts, followed by live.json listing the recent
+    segments and their parts. A single thread does all the writes so the
+    state file never lists a part which is not on the disk yet
+    """
+    def __init__(self, output_folder, part_target, window, set_ownership = None):
+        self.folder = "".join([output_folder, "/", PARTS_FOLDER]);
+        self.part_target = part_target;
+        self.window = window;
+        self.set_ownership = set_ownership;
+        self.segments = [];
+        # Last completed segment, kept by the caller's thread
+        self.last_sequence = 0;
+        self.executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "live-publisher");
+        os.makedirs(self.folder, exist_ok = True);
+        if self.set_ownership:
+            self.set_ownership(self.folder);
+        self.executor.submit(self.remove_parts, None);
+    def part(self, sequence, timestamp, data, duration, independent):
+        """
+        Queues the part of the segment being filled, data must be a copy
+        """
+        self.executor.submit(self.write_part, sequence, timestamp, data, duration, independent);
+    def complete(self, sequence, timestamp):
+        """
+        Marks the segment as complete, called after its last part
+        """
+        self.last_sequence = sequence;
+        self.executor.submit(self.complete_segment, sequence, timestamp);
+    def write_atomically(self, path, data):
+        directory, name = os.path.split(path);
+        temporary_path = "".join([directory, "/.", name, ".tmp"]);
+        with open(temporary_path, "wb") as fd:
+            fd.write(data);
+        if self.set_ownership:
+            self.set_ownership(temporary_path);
+        os.rename(temporary_path, path);
+    def segment(self, sequence, timestamp):
+        if self.segments and self.segments[-1]["sequence"] == sequence:
+            return self.segments[-1];
+        segment = {
+            "sequence": sequence,
+            "timestamp": timestamp,
+            "duration": None,
+            "parts": []
+        };
+        self.segments.append(segment);
+        return segment;
+    def write_part(self, sequence, timestamp, data, duration, independent):
+        try:
+            segment = self.segment(sequence, timestamp);
+            path = "".join([self.folder, "/", str(timestamp), ".", str(len(segment["parts"])), ".ts"]);
+            self.write_atomically(path, data);
+            segment["parts"].append({
+                "duration": round(duration, 3),
+                "independent": independent
+            });
+            self.publish();
+        except Exception as e:
+            logging.critical("Error publishing the part of the segment %d: %s", timestamp, str(e));
+    def complete_segment(self, sequence, timestamp):
+        try:
+            segment = self.segment(sequence, timestamp);
+            segment["duration"] = round(sum([part["duration"] for part in segment["parts"]]), 3);
+            # The window keeps the complete segments and the one being filled
+            if len(self.segments) > self.window + 1:
+                removed = self.segments[0:len(self.segments) - self.window - 1];
+                self.segments = self.segments[len(removed):];
+                self.publish();
+                self.remove_parts(self.segments[0]["timestamp"]);
+            else:
+                self.publish();
+        except Exception as e:
+            logging.critical("Error completing the segment %d: %s", timestamp, str(e));
+    def publish(self):
+        self.write_atomically("".join([self.folder, "/", LIVE_STATE_FILE]), json.dumps({
+            "part_target": self.part_target,
+            "updated": time.time(),
+            "segments": self.segments
+        }).encode("utf-8"));
+    def remove_parts(self, oldest):
+        """
+        Removes the parts of the segments older than the oldest one in the
+        window, or all of them
+        """
+        try:
+            for file in os.listdir(self.folder):
+                match = PART_FILE_PATTERN.match(file);
+                if match and (oldest is None or int(match.group(1)) < oldest):
+                    os.remove("".join([self.folder, "/", file]));
+            if oldest is None:
+                os.remove("".join([self.folder, "/", LIVE_STATE_FILE]));
+        except OSError:
+            pass;
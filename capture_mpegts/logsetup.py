@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Logging
+import logging
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+# import system library
+import sys
+
+# Queues
+import queue
+
+# Exit hooks
+import atexit
+
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s";
+
+# Listener of the process, the logging is configured only once
+listener = None;
+
+def configure_logging(config, filename = None, stream = sys.stdout):
+    """
+    Sends the log records through a queue to a background thread which
+    formats them and writes them to the console and the file, so the
+    demuxer never waits for the disk or the terminal
+    """
+    global listener;
+    if listener is not None:
+        return listener;
+    level = getattr(logging, str(config.get("LOG_LEVEL", "INFO")).upper(), logging.INFO);
+    formatter = logging.Formatter(LOG_FORMAT);
+    handlers = [logging.StreamHandler(stream)];
+    if filename:
+        handlers.append(RotatingFileHandler(filename, backupCount = 10));
+    for handler in handlers:
+        handler.setFormatter(formatter);
+    records = queue.SimpleQueue();
+    root = logging.getLogger();
+    for handler in list(root.handlers):
+        root.removeHandler(handler);
+    root.addHandler(QueueHandler(records));
+    root.setLevel(level);
+    listener = QueueListener(records, *handlers, respect_handler_level = True);
+    listener.start();
+    # Flush whatever is still queued when the process exits
+    atexit.register(listener.stop);
+    return listener;
+
+def forward_logging(records):
+    """
+    Sends the log records of a worker process to the supervisor through
+    the multiprocessing queue instead, only the supervisor writes the file
+    """
+    global listener;
+    root = logging.getLogger();
+    for handler in list(root.handlers):
+        root.removeHandler(handler);
+    if listener is not None:
+        atexit.unregister(listener.stop);
+        listener.stop();
+        for handler in listener.handlers:
+            handler.close();
+    root.addHandler(QueueHandler(records));
+    listener = None;
+
+def collect_logging(records):
+    """
+    Writes the records the workers forward to the handlers of this process,
+    returns the listener
+    """
+    if listener is None:
+        return None;
+    collector = QueueListener(records, *listener.handlers, respect_handler_level = True);
+    collector.start();
+    atexit.register(collector.stop);
+    return collector;
@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Threading
+import threading
+
+# HTTP endpoint
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS            = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0);
+
+class Histogram():
+    """
+    Distribution of the observed values, cumulative like in Prometheus
+    """
+    def __init__(self, bounds = LATENCY_BUCKETS):
+        self.bounds = bounds;
+        self.counts = [0] * len(bounds);
+        self.count = 0;
+        self.sum = 0.0;
+    def observe(self, value):
+        for i in range(len(self.bounds) - 1, -1, -1):
+            if value > self.bounds[i]:
+                break;
+            self.counts[i] += 1;
+        self.count += 1;
+        self.sum += value;
+    def snapshot(self):
+        return {
+            "buckets": [[bound, count] for bound, count in zip(self.bounds, self.counts)],
+            "count": self.count,
+            "sum": round(self.sum, 6)
+        };
+
+class CameraMetrics():
+    """
+    Counters of a single camera pipeline. Updated only from the threads
+    of the camera, so plain integer updates are good enough. Histograms
+    are fed by the shared segment writer as well and have a lock
+    """
+    def __init__(self, name):
+        self.name = name;
+        self.counters = {};
+        self.values = {};
+        self.histograms = {};
+        self.lock = threading.Lock();
+    def increment(self, counter, value = 1):
+        self.counters[counter] = self.counters.get(counter, 0) + value;
+    def set(self, name, value):
+        self.values[name] = value;
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name, None);
+            if histogram is None:
+                histogram = Histogram();
+                self.histograms[name] = histogram;
+            histogram.observe(value);
+    def snapshot(self):
+        result = dict(self.counters);
+        result.update(self.values);
+        with self.lock:
+            for name, histogram in self.histograms.items():
+                result[name] = histogram.snapshot();
+        return result;
+
+class MetricsRegistry():
+    """
+    Metrics of all the cameras handled by the process
+    """
+    def __init__(self):
+        self.lock = threading.Lock();
+        self.cameras = {};
+    def camera(self, name):
+        with self.lock:
+            metrics = self.cameras.get(name, None);
+            if metrics is None:
+                metrics = CameraMetrics(name);
+                self.cameras[name] = metrics;
+            return metrics;
+    def snapshot(self):
+        with self.lock:
+            cameras = list(self.cameras.values());
+        return dict([(metrics.name, metrics.snapshot()) for metrics in cameras]);
+
+# Process wide registry
+registry = MetricsRegistry();
+
+def prometheus_text(metrics):
+    """
+    Formats the metrics of the cameras in the Prometheus text format
+    """
+    lines = [];
+    for camera, values in sorted(metrics.items()):
+        for name, value in sorted(values.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append("capture_%s{camera=\"%s\"} %s" % (name, camera, value));
+            elif isinstance(value, dict) and "buckets" in value:
+                for bound, count in value["buckets"]:
+                    lines.append("capture_%s_bucket{camera=\"%s\",le=\"%s\"} %s" % (name, camera, bound, count));
+                lines.append("capture_%s_bucket{camera=\"%s\",le=\"+Inf\"} %s" % (name, camera, value["count"]));
+                lines.append("capture_%s_sum{camera=\"%s\"} %s" % (name, camera, value["sum"]));
+                lines.append("capture_%s_count{camera=\"%s\"} %s" % (name, camera, value["count"]));
+    return "\n".join(lines) + "\n";
+
+class MetricsServer():
+    """
+    Lightweight HTTP endpoint serving the metrics as JSON on /metrics.json
+    and in the Prometheus text format on /metrics
+    """
+    def __init__(self, ip, port, get_metrics):
+        self.get_metrics = get_metrics;
+        server = self;
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0];
+                if path == "/metrics.json":
+                    body = json.dumps(server.get_metrics()).encode("utf-8");
+                    content_type = "application/json";
+                elif path == "/metrics":
+                    body = prometheus_text(server.get_metrics()).encode("utf-8");
+                    content_type = "text/plain; version=0.0.4";
+                else:
+                    self.send_error(404);
+                    return;
+                self.send_response(200);
+                self.send_header("Content-Type", content_type);
+                self.send_header("Content-Length", str(len(body)));
+                self.end_headers();
+                self.wfile.write(body);
+            def log_message(self, format, *args):
+                pass;
+        self.httpd = ThreadingHTTPServer((ip, port), Handler);
+        self.httpd.daemon_threads = True;
+    def start(self):
+        thread = threading.Thread(target = self.httpd.serve_forever, daemon = True);
+        thread.start();
+        return thread;
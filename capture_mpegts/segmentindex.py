@@ -0,0 +1,66 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Binary data
+import struct
+
+# Layout of the <timestamp>.idx file written next to every segment, all
+# numbers are little endian:
+#   header: magic "TSIX", version, size of the entry, size of the segment
+#           in bytes, PTS right after the last frame (0 when unknown)
+#   entries: PTS of the key frame, byte offset of the PAT which precedes it
+INDEX_MAGIC                = b"TSIX";
+INDEX_VERSION              = 0x1;
+INDEX_HEADER               = struct.Struct("<4sHHIQ");
+INDEX_ENTRY                = struct.Struct("<QI");
+
+TS_PACKET_SIZE             = 0xBC;
+TS_HEADER_SIZE             = 0x4;
+
+# Adaptation field types
+TS_PACKET_ADAPTATION_ONLY        = 0x2;
+TS_PACKET_ADAPTATION_AND_PAYLOAD = 0x3;
+
+# PTS is a 33 bit counter of the 90 kHz clock
+PTS_WRAP                   = 1 << 33;
+NO_PTS                     = -1;
+
+def pes_pts(b):
+    """
+    PTS of the PES which starts in the packet, NO_PTS if there is none
+    """
+    offset = TS_HEADER_SIZE;
+    adaptation = (b[3] & 0x30) >> 4;
+    if adaptation == TS_PACKET_ADAPTATION_ONLY or adaptation == TS_PACKET_ADAPTATION_AND_PAYLOAD:
+        offset += (b[offset] + 1);
+    if offset + 14 > TS_PACKET_SIZE:
+        return NO_PTS;
+    if b[offset] != 0x0 or b[offset + 1] != 0x0 or b[offset + 2] != 0x1:
+        return NO_PTS;
+    # PTS_DTS_flags
+    if not (b[offset + 7] & 0x80):
+        return NO_PTS;
+    p = offset + 9;
+    return (((b[p] & 0x0E) << 29) | (b[p + 1] << 22) | ((b[p + 2] & 0xFE) << 14) |
+        (b[p + 3] << 7) | (b[p + 4] >> 1));
+
+def pack_index(size, end_pts, key_frames):
+    """
+    Serializes the key frames, list of (PTS, offset) tuples, of the segment
+    """
+    return b"".join([INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, INDEX_ENTRY.size, size, max(end_pts, 0))] +
+        [INDEX_ENTRY.pack(max(pts, 0), offset) for pts, offset in key_frames]);
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Logging
+import logging
+
+# PIDs are 13 bits long
+PID_COUNT                  = 0x2000;
+PAT_PID                    = 0x0;
+
+# What the packets of the PID carry
+PID_UNKNOWN                = 0x0;
+PID_PAT                    = 0x1;
+PID_PMT                    = 0x2;
+PID_VIDEO                  = 0x3;
+PID_AUDIO                  = 0x4;
+
+class StreamState():
+    """
+    State of a single program (stream) of the transport stream
+    """
+    __slots__ = ("stream_id", "buffer", "fill", "filling_timestamp", "playing_timestamp",
+        "waiting_timestamp", "sequence", "playlist_constructed", "output_folder",
+        "pat_packet", "pmt_packet", "pmt_pid", "pmt_processed", "video_pid", "audio_pid",
+        "lost", "duplicated", "errored", "key_frames", "max_pts", "last_pts",
+        "frame_duration", "psi_cc", "part_start", "part_pts", "part_independent");
+    def __init__(self, stream_id, buffer, output_folder, timestamp):
+        self.stream_id = stream_id;
+        self.buffer = buffer;
+        self.fill = 0;
+        self.filling_timestamp = timestamp;
+        self.playing_timestamp = -1;
+        self.waiting_timestamp = -1;
+        self.sequence = 1;
+        self.playlist_constructed = False;
+        self.output_folder = output_folder;
+        self.pat_packet = None;
+        self.pmt_packet = None;
+        self.pmt_pid = -1;
+        self.pmt_processed = False;
+        self.video_pid = -1;
+        self.audio_pid = -1;
+        # Damaged packets of the segment being filled
+        self.lost = 0;
+        self.duplicated = 0;
+        self.errored = 0;
+        # (PTS, offset) of every key frame of the segment being filled
+        self.key_frames = [];
+        self.max_pts = -1;
+        self.last_pts = -1;
+        self.frame_duration = 0;
+        # Continuity counter of the PAT and PMT copies
+        self.psi_cc = 0;
+        # Start of the low latency part being filled
+        self.part_start = 0;
+        self.part_pts = -1;
+        self.part_independent = False;
+
+class LookupTable():
+    """
+    Maps every PID straight to the kind of its packets and to the state of
+    the stream owning it, so the demuxer does one list index per packet
+    """
+    def __init__(self):
+        self.kinds = [PID_UNKNOWN] * PID_COUNT;
+        self.states = [None] * PID_COUNT;
+        self.kinds[PAT_PID] = PID_PAT;
+        self.streams = {};
+    def add_stream(self, state):
+        self.streams[state.stream_id] = state;
+    def get_stream_ids(self):
+        return list(self.streams.keys());
+    def is_stream_id_in_list(self, stream_id):
+        return stream_id in self.streams;
+    def get_stream(self, stream_id):
+        return self.streams.get(stream_id, None);
+    def set_pid(self, pid, kind, state):
+        self.kinds[pid] = kind;
+        self.states[pid] = state;
+    def clear_pid(self, pid):
+        if pid >= 0:
+            self.set_pid(pid, PID_UNKNOWN, None);
+    def set_pmt_pid(self, state, pmt_pid):
+        if state.pmt_pid != pmt_pid:
+            self.clear_pid(state.pmt_pid);
+        logging.debug("Mapping PMT PID %d to the stream %d" % (pmt_pid, state.stream_id));
+        state.pmt_pid = pmt_pid;
+        self.set_pid(pmt_pid, PID_PMT, state);
+    def set_video_pid(self, state, video_pid):
+        if state.video_pid != video_pid:
+            self.clear_pid(state.video_pid);
+        state.video_pid = video_pid;
+        self.set_pid(video_pid, PID_VIDEO, state);
+    def set_audio_pid(self, state, audio_pid):
+        if state.audio_pid != audio_pid:
+            self.clear_pid(state.audio_pid);
+        state.audio_pid = audio_pid;
+        self.set_pid(audio_pid, PID_AUDIO, state);
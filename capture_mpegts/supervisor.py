@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__author__ = "Dmitriy Kuptsov"
+__copyright__ = "Copyright 2023, strangebit"
+__license__ = "GPL"
+__version__ = "0.0.1a"
+__maintainer__ = "Dmitriy Kuptsov"
+__email__ = "dmitriy.kuptsov@gmail.com"
+__status__ = "development"
+
+# Logging
+import logging
+
+# Import OS stuff
+import os
+
+# Processes
+import multiprocessing
+import queue
+
+# Threading
+import threading
+
+# Timing
+import time
+from time import sleep
+
+# Configuration
+from config import config
+
+# Camera pipelines
+from capture import camera_configs, start_camera, cleanup, LOG_FILE
+from metrics import registry, MetricsServer
+from logsetup import configure_logging, forward_logging, collect_logging
+
+# Worker restart back off
+MIN_RESTART_DELAY_IN_SECONDS = 1;
+MAX_RESTART_DELAY_IN_SECONDS = 60;
+
+def run_worker(cameras, metrics_queue, interval, log_queue):
+    """
+    Runs the pipelines of a group of cameras in one process and reports
+    the metrics and the log records back to the supervisor. The retention
+    of the cameras runs here as well, next to the writer which reports
+    their new files
+    """
+    forward_logging(log_queue);
+    threading.Thread(target = cleanup, args = (cameras, ), daemon = True).start();
+    threads = [];
+    for camera in cameras:
+        logging.debug("Starting pipeline of the camera %s" % camera["CAMERA_NAME"]);
+        threads.extend(start_camera(camera));
+    while True:
+        sleep(interval);
+        metrics_queue.put((os.getpid(), registry.snapshot()));
+        if not all([thread.is_alive() for thread in threads]):
+            logging.critical("Camera pipeline died, restarting the worker");
+            os._exit(1);
+
+class Supervisor():
+    """
+    Spreads the cameras over a pool of worker processes, restarts the
+    workers which die
+    """
+    def __init__(self, config):
+        self.config = config;
+        self.cameras = camera_configs(config);
+        workers = config.get("WORKER_PROCESSES", 0) or os.cpu_count() or 1;
+        workers = max(1, min(workers, len(self.cameras)));
+        self.groups = [self.cameras[i::workers] for i in range(workers)];
+        self.context = multiprocessing.get_context("spawn");
+        self.metrics_queue = self.context.Queue();
+        # The log file is written by the supervisor alone
+        self.log_queue = self.context.Queue();
+        self.processes = [None] * workers;
+        self.restart_delay = [MIN_RESTART_DELAY_IN_SECONDS] * workers;
+        self.restart_at = [0] * workers;
+        self.restarts = [0] * workers;
+        self.started_at = [0] * workers;
+        self.metrics = {};
+        self.lock = threading.Lock();
+    def start_worker(self, index):
+        process = self.context.Process(target = run_worker,
+            args = (self.groups[index], self.metrics_queue, self.config["METRICS_INTERVAL"], self.log_queue),
+            name = "capture-worker-%d" % index,
+            daemon = True);
+        process.start();
+        self.processes[index] = process;
+        self.started_at[index] = time.monotonic();
+        logging.debug("Started worker %d (pid %d) for cameras %s" % (index, process.pid,
+            ", ".join([camera["CAMERA_NAME"] for camera in self.groups[index]])));
+    def check_workers(self):
+        now = time.monotonic();
+        for index, process in enumerate(self.processes):
+            if process is not None and process.is_alive():
+                continue;
+            if process is not None:
+                logging.critical("Worker %d exited with code %s" % (index, str(process.exitcode)));
+                self.processes[index] = None;
+                # Worker which was running fine for a while restarts quickly
+                if now - self.started_at[index] > MAX_RESTART_DELAY_IN_SECONDS:
+                    self.restart_delay[index] = MIN_RESTART_DELAY_IN_SECONDS;
+                self.restart_at[index] = now + self.restart_delay[index];
+                self.restart_delay[index] = min(self.restart_delay[index] * 2, MAX_RESTART_DELAY_IN_SECONDS);
+                self.restarts[index] += 1;
+            if now >= self.restart_at[index]:
+                self.start_worker(index);
+    def collect_metrics(self, timeout):
+        try:
+            pid, snapshot = self.metrics_queue.get(timeout = timeout);
+        except queue.Empty:
+            return;
+        with self.lock:
+            self.metrics.update(snapshot);
+    def get_metrics(self):
+        """
+        Latest metrics of every camera
+        """
+        with self.lock:
+            return dict(self.metrics);
+    def run(self):
+        collect_logging(self.log_queue);
+        if self.config["METRICS_PORT"]:
+            try:
+                MetricsServer(self.config["METRICS_IP"], self.config["METRICS_PORT"], self.get_metrics).start();
+            except OSError as e:
+                logging.critical("Cannot start the metrics endpoint: %s" % str(e));
+        deadline = time.monotonic();
+        while True:
+            self.check_workers();
+            self.collect_metrics(1);
+            if time.monotonic() >= deadline:
+                deadline = time.monotonic() + self.config["METRICS_INTERVAL"];
+                for name, values in sorted(self.get_metrics().items()):
+                    logging.info("Camera %s: %d packets, %d segments, %d lost, %d duplicated, %d errored" % (name,
+                        values.get("packets", 0), values.get("segments", 0), values.get("lost_packets", 0),
+                        values.get("duplicated_packets", 0), values.get("errored_packets", 0)));
+
+if __name__ == "__main__":
+    # Only the supervisor writes the log file, the workers forward to it
+    configure_logging(config, LOG_FILE);
+    Supervisor(config).run();
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Replays a recorded MPEG-TS file over UDP at a fixed bitrate, the same
+# way ffmpeg feeds the demuxer. Datagrams carry whole TS packets.
+#
+# Usage: python3 udp_replay.py <recording.ts> [--host 127.0.0.1] [--port 9000]
+#            [--bitrate 8] [--packet-size 1316] [--duration 30]
+
+# import system library
+import sys
+
+# Arguments
+import argparse
+
+# socket functionality
+import socket
+
+# Timing
+import time
+
+# Memory mapped input
+import mmap
+
+TS_PACKET_SIZE             = 0xBC;
+
+# Pacing does not sleep for less than this
+MIN_SLEEP_IN_SECONDS       = 0.001;
+
+def replay(path, host, port, bitrate, packet_size, duration):
+    """
+    Sends the file in a loop for the given number of seconds. Bitrate is in
+    megabits per second, 0 sends as fast as possible. Returns the number
+    of datagrams and bytes sent
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM);
+    datagrams = 0;
+    sent = 0;
+    with open(path, "rb") as fd, mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ) as data:
+        view = memoryview(data);
+        size = len(view) - (len(view) % TS_PACKET_SIZE);
+        bytes_per_second = bitrate * 1000000 / 8;
+        start = time.perf_counter();
+        offset = 0;
+        while True:
+            now = time.perf_counter();
+            if now - start >= duration:
+                break;
+            if bytes_per_second > 0:
+                ahead = sent / bytes_per_second - (now - start);
+                if ahead > MIN_SLEEP_IN_SECONDS:
+                    time.sleep(ahead);
+            end = min(offset + packet_size, size);
+            sock.sendto(view[offset:end], (host, port));
+            datagrams += 1;
+            sent += end - offset;
+            offset = end if end < size else 0;
+        view.release();
+    sock.close();
+    return datagrams, sent;
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Replays MPEG-TS over UDP");
+    parser.add_argument("path");
+    parser.add_argument("--host", default = "127.0.0.1");
+    parser.add_argument("--port", type = int, default = 9000);
+    parser.add_argument("--bitrate", type = float, default = 8, help = "Megabits per second, 0 is unlimited");
+    parser.add_argument("--packet-size", type = int, default = 7 * TS_PACKET_SIZE, help = "Bytes per datagram");
+    parser.add_argument("--duration", type = float, default = 30, help = "Seconds");
+    args = parser.parse_args();
+    if args.packet_size <= 0 or args.packet_size % TS_PACKET_SIZE:
+        print("Datagram size must be a multiple of %d bytes" % TS_PACKET_SIZE);
+        sys.exit(1);
+    datagrams, sent = replay(args.path, args.host, args.port, args.bitrate, args.packet_size, args.duration);
+    print("%d datagrams, %d bytes, %.2f Mbit/s" % (datagrams, sent, sent * 8 / args.duration / 1000000));
@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Logging
+import logging
+
+# Import OS stuff
+import os
+
+# Subprocesses
+import subprocess
+
+# Sidecar files
+import json
+
+# Timing
+import time
+
+# Threading
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# What happens to a segment when the queue is full
+DROP_POLICY_BLOCK          = "block";
+DROP_POLICY_DROP_NEWEST    = "drop_newest";
+DROP_POLICY_DROP_OLDEST    = "drop_oldest";
+
+class SegmentWriter():
+    """
+    Writes the finished segments on a bounded pool of threads. The segment
+    is written to a hidden temporary file and renamed into place, so the
+    readers never see a partially written .ts file. Every file in place
+    is reported to the written callback with its path, the reclaim
+    callback is given the output folder before every segment so that it
+    can make room on a full volume.
+
+    At most max_pending segments wait for the disk. When the disk stalls
+    and the queue is full, the drop policy decides: block the demuxer,
+    drop the new segment after waiting block_timeout seconds for a free
+    slot, or drop the oldest segment still waiting right away, so the
+    demuxer never stops reading the socket
+    """
+    def __init__(self, threads, max_pending, fsync = False, set_ownership = None, convert_script = None,
+        written = None, reclaim = None, drop_policy = DROP_POLICY_BLOCK, block_timeout = 1.0):
+        self.executor = ThreadPoolExecutor(max_workers = threads, thread_name_prefix = "segment-writer");
+        self.slots = threading.BoundedSemaphore(max_pending);
+        self.fsync = fsync;
+        self.set_ownership = set_ownership;
+        self.convert_script = convert_script;
+        self.written = written;
+        self.reclaim = reclaim;
+        self.drop_policy = drop_policy;
+        self.block_timeout = block_timeout;
+        self.pending = [];
+        self.lock = threading.Lock();
+    def acquire_slot(self):
+        """
+        Waits for a free slot in the queue according to the drop policy,
+        returns False if the new segment has to be dropped
+        """
+        if self.drop_policy == DROP_POLICY_BLOCK:
+            self.slots.acquire();
+            return True;
+        if self.drop_policy == DROP_POLICY_DROP_OLDEST:
+            if self.slots.acquire(blocking = False):
+                return True;
+            with self.lock:
+                pending = list(self.pending);
+            # Segments already being written cannot be cancelled, the
+            # cancelled one gives its slot back in its done callback
+            for future in pending:
+                if future.cancel():
+                    return self.slots.acquire(blocking = False);
+            return False;
+        return self.slots.acquire(timeout = self.block_timeout);
+    def submit(self, buf, output_folder, timestamp, size = None, release = None, meta = None, index = None, metrics = None):
+        """
+        Queues the segment for writing, see the drop policy for what
+        happens when too many segments are already waiting for the disk.
+        Only the first size bytes of the buffer are written, the buffer is
+        passed to release once the writer is done with it or the segment
+        is dropped. The meta dictionary is stored next to the segment as
+        <timestamp>.meta.json, the packed key frame index as <timestamp>.idx.
+        Queue depth, waiting and writing times and drops go to metrics.
+        Returns the future of the write or None if the segment was dropped
+        """
+        if not self.acquire_slot():
+            logging.critical("Segment writer queue is full, dropping the segment %d" % timestamp);
+            if metrics is not None:
+                metrics.increment("dropped_segments");
+            if release is not None:
+                release(buf);
+            return None;
+        # The worker takes its own view of the buffer, a cancelled segment
+        # leaves none behind when the buffer goes back to the pool
+        try:
+            future = self.executor.submit(self.write, buf, size, output_folder, timestamp, meta, index, metrics, time.monotonic());
+        except Exception:
+            self.slots.release();
+            raise;
+        with self.lock:
+            self.pending.append(future);
+            depth = len(self.pending);
+        if metrics is not None:
+            metrics.set("writer_queue_depth", depth);
+        def done(future):
+            with self.lock:
+                self.pending.remove(future);
+                depth = len(self.pending);
+            if metrics is not None:
+                metrics.set("writer_queue_depth", depth);
+            if future.cancelled():
+                logging.critical("Segment writer queue is full, dropped the waiting segment %d" % timestamp);
+                if metrics is not None:
+                    metrics.increment("dropped_segments");
+            if release is not None:
+                release(buf);
+            self.slots.release();
+        future.add_done_callback(done);
+        return future;
+    def write_file(self, path, buf):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644);
+        try:
+            view = memoryview(buf);
+            while len(view) > 0:
+                written = os.write(fd, view);
+                view = view[written:];
+            if self.fsync:
+                os.fsync(fd);
+        finally:
+            os.close(fd);
+    def notify(self, path):
+        if self.written:
+            try:
+                self.written(path);
+            except Exception as e:
+                logging.critical("Error reporting the file %s: %s" % (path, str(e)));
+    def write_sidecar(self, output_folder, timestamp, extension, data):
+        path = "".join([output_folder, "/", str(timestamp), extension]);
+        temporary_path = "".join([output_folder, "/.", str(timestamp), extension, ".tmp"]);
+        try:
+            self.write_file(temporary_path, data);
+            if self.set_ownership:
+                self.set_ownership(temporary_path);
+            os.rename(temporary_path, path);
+            self.notify(path);
+        except Exception as e:
+            logging.critical("Error saving the sidecar %s: %s" % (path, str(e)));
+            try:
+                os.remove(temporary_path);
+            except OSError:
+                pass;
+    def write_meta(self, output_folder, timestamp, meta):
+        self.write_sidecar(output_folder, timestamp, ".meta.json", json.dumps(meta).encode("utf-8"));
+    def write(self, buf, size, output_folder, timestamp, meta = None, index = None, metrics = None, queued = None):
+        started = time.monotonic();
+        if metrics is not None and queued is not None:
+            metrics.observe("writer_wait_seconds", started - queued);
+        if size is None:
+            size = len(buf);
+        with memoryview(buf) as view:
+            result = self.write_segment(view[0:size], output_folder, timestamp, meta, index);
+        if metrics is not None:
+            metrics.observe("write_seconds", time.monotonic() - started);
+            if not result:
+                metrics.increment("write_errors");
+        return result;
+    def write_segment(self, buf, output_folder, timestamp, meta = None, index = None):
+        ts_path_no_extension = "".join([output_folder, "/", str(timestamp)]);
+        path = "".join([ts_path_no_extension, ".ts"]);
+        temporary_path = "".join([output_folder, "/.", str(timestamp), ".ts.tmp"]);
+        if self.reclaim:
+            try:
+                self.reclaim(output_folder);
+            except Exception as e:
+                logging.critical("Error making room for the segment %s: %s" % (path, str(e)));
+        try:
+            if self.convert_script:
+                # Audio has to be transcoded, the script writes the final .ts itself
+                raw_path = "".join([ts_path_no_extension, ".raw"]);
+                self.write_file(raw_path, buf);
+                subprocess.run([self.convert_script, ts_path_no_extension, output_folder],
+                    stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL);
+                if self.set_ownership:
+                    self.set_ownership(path);
+                self.notify(path);
+                if meta is not None:
+                    self.write_meta(output_folder, timestamp, meta);
+                return True;
+            # The index is in place before the segment shows up, offsets
+            # are only valid for the untouched stream
+            if index is not None:
+                self.write_sidecar(output_folder, timestamp, ".idx", index);
+            self.write_file(temporary_path, buf);
+            if self.set_ownership:
+                self.set_ownership(temporary_path);
+            os.rename(temporary_path, path);
+            logging.debug("Segment %s was written" % path);
+            self.notify(path);
+            if meta is not None:
+                self.write_meta(output_folder, timestamp, meta);
+            return True;
+        except Exception as e:
+            logging.critical("Error saving the segment %s" % path);
+            logging.critical(str(e));
+            try:
+                os.remove(temporary_path);
+            except OSError:
+                pass;
+            return False;
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Logging
+import logging
+
+# Import OS stuff
+import os
+
+# Regular expressions
+import re
+
+# Sorted bucket list
+import bisect
+
+# Threading
+import threading
+
+# Segments and their sidecars, all named after the timestamp of the segment
+SEGMENT_FILE_PATTERN       = re.compile(r"^([0-9]+)\.(mp4|mpeg4|mkv|avi|ts|m4s|idx|meta\.json)$");
+# fMP4 initialization sections, every segment up to the next section needs it
+INIT_FILE_PATTERN          = re.compile(r"^([0-9]+)\.init\.mp4$");
+
+class RetentionPolicy():
+    """
+    Keeps the recordings of a camera younger than the maximum lifetime
+    and, with a quota, within the given number of bytes by removing the
+    oldest ones. The files are tracked in buckets of bucket_seconds by
+    their timestamp: a bucket which expired as a whole goes without
+    looking at its segments one by one and the newer buckets are never
+    touched, so a cleanup costs as much as there is to remove. The
+    folder is listed once, afterwards new files are reported with add().
+    With min_free_bytes the oldest recordings also make room whenever
+    the volume runs out of space, whatever their age. An fMP4
+    initialization section goes once a newer section exists and no
+    segment older than the newer one is left
+    """
+    def __init__(self, folder, max_lifetime, max_bytes = 0, bucket_seconds = 3600, min_free_bytes = 0):
+        self.folder = folder;
+        self.max_lifetime = max_lifetime;
+        self.max_bytes = max_bytes;
+        self.bucket_seconds = bucket_seconds;
+        self.min_free_bytes = min_free_bytes;
+        # Bucket start -> timestamp -> file name -> size
+        self.buckets = {};
+        self.order = [];
+        # Timestamps of the initialization sections and their sizes
+        self.inits = [];
+        self.init_sizes = {};
+        self.size = 0;
+        self.lock = threading.Lock();
+    def add(self, name, size = None):
+        """
+        Tracks the file of the folder, returns False if it is not a recording
+        """
+        match = SEGMENT_FILE_PATTERN.match(name) or INIT_FILE_PATTERN.match(name);
+        if not match:
+            return False;
+        if size is None:
+            try:
+                size = os.stat("".join([self.folder, "/", name])).st_size;
+            except OSError:
+                return False;
+        timestamp = int(match.group(1));
+        if match.re is INIT_FILE_PATTERN:
+            with self.lock:
+                if timestamp not in self.init_sizes:
+                    bisect.insort(self.inits, timestamp);
+                self.size += size - self.init_sizes.get(timestamp, 0);
+                self.init_sizes[timestamp] = size;
+            return True;
+        bucket = timestamp - timestamp % self.bucket_seconds;
+        with self.lock:
+            segments = self.buckets.get(bucket, None);
+            if segments is None:
+                segments = {};
+                self.buckets[bucket] = segments;
+                bisect.insort(self.order, bucket);
+            files = segments.setdefault(timestamp, {});
+            self.size += size - files.get(name, 0);
+            files[name] = size;
+        return True;
+    def discard(self, name):
+        """
+        Stops tracking the file which was removed by somebody else
+        """
+        match = INIT_FILE_PATTERN.match(name);
+        if match:
+            timestamp = int(match.group(1));
+            with self.lock:
+                if timestamp in self.init_sizes:
+                    self.size -= self.init_sizes.pop(timestamp);
+                    self.inits.remove(timestamp);
+            return;
+        match = SEGMENT_FILE_PATTERN.match(name);
+        if not match:
+            return;
+        timestamp = int(match.group(1));
+        bucket = timestamp - timestamp % self.bucket_seconds;
+        with self.lock:
+            files = self.buckets.get(bucket, {}).get(timestamp, None);
+            if files is not None and name in files:
+                self.size -= files.pop(name);
+    def scan(self):
+        """
+        Tracks every recording in the folder, returns the number of files
+        """
+        count = 0;
+        try:
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file() and self.add(entry.name, entry.stat().st_size):
+                            count += 1;
+                    except OSError:
+                        pass;
+        except OSError as e:
+            logging.debug("Cannot list %s: %s" % (self.folder, str(e)));
+        return count;
+    def over_quota(self):
+        return self.max_bytes > 0 and self.size > self.max_bytes;
+    def free_bytes(self):
+        stat = os.statvfs(self.folder);
+        return stat.f_bavail * stat.f_frsize;
+    def expire(self, now, needed = 0):
+        """
+        Stops tracking the segments which are too old, do not fit into the
+        quota or are among the oldest ones which free the needed number of
+        bytes, returns the names of their files
+        """
+        cutoff = now - self.max_lifetime;
+        names = [];
+        freed = 0;
+        with self.lock:
+            while self.order:
+                bucket = self.order[0];
+                segments = self.buckets[bucket];
+                if bucket + self.bucket_seconds - 1 <= cutoff:
+                    size = 0;
+                    for files in segments.values():
+                        names.extend(files.keys());
+                        size += sum(files.values());
+                    freed += size;
+                    self.size -= size;
+                    del self.buckets[bucket];
+                    self.order.pop(0);
+                    continue;
+                # The oldest bucket is partly expired, over the quota or
+                # has to make room
+                for timestamp in sorted(segments):
+                    if timestamp > cutoff and not self.over_quota() and freed >= needed:
+                        break;
+                    files = segments.pop(timestamp);
+                    names.extend(files.keys());
+                    size = sum(files.values());
+                    freed += size;
+                    self.size -= size;
+                if segments:
+                    break;
+                del self.buckets[bucket];
+                self.order.pop(0);
+            names.extend(self.expire_inits());
+        return names;
+    def expire_inits(self):
+        """
+        Stops tracking the initialization sections no segment needs any
+        more, returns the names of their files. Must hold the lock
+        """
+        names = [];
+        oldest = None;
+        if self.order:
+            oldest = min(self.buckets[self.order[0]]);
+        while len(self.inits) > 1 and (oldest is None or self.inits[1] <= oldest):
+            timestamp = self.inits.pop(0);
+            self.size -= self.init_sizes.pop(timestamp);
+            names.append("".join([str(timestamp), ".init.mp4"]));
+        return names;
+    def reclaim(self, now):
+        """
+        Removes the oldest recordings until the volume has min_free_bytes
+        free, ahead of the regular cleanup. Returns the number of files
+        """
+        if not self.min_free_bytes:
+            return 0;
+        try:
+            free = self.free_bytes();
+        except OSError:
+            return 0;
+        if free >= self.min_free_bytes:
+            return 0;
+        removed = self.remove(self.expire(now, self.min_free_bytes - free));
+        logging.critical("%d bytes free in %s, removed %d files of the oldest recordings" % (free, self.folder, removed));
+        return removed;
+    def cleanup(self, now):
+        """
+        Removes the expired files, returns their number
+        """
+        return self.remove(self.expire(now)) + self.reclaim(now);
+    def remove(self, names):
+        removed = 0;
+        for name in names:
+            try:
+                os.remove("".join([self.folder, "/", name]));
+                removed += 1;
+            except FileNotFoundError:
+                pass;
+            except OSError as e:
+                logging.critical("Cannot remove %s: %s" % (name, str(e)));
+        return removed;
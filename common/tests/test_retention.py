@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+# Copyright (C) 2019 strangebit
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Unit tests
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."));
+
+from retention import RetentionPolicy;
+
+START = 1700000000 - 1700000000 % 3600;
+
+class RetentionPolicyTest(unittest.TestCase):
+    def policy(self, max_lifetime = 7200, max_bytes = 0):
+        policy = RetentionPolicy(tempfile.gettempdir(), max_lifetime, max_bytes);
+        # A segment every 10 minutes over three hours
+        for i in range(18):
+            timestamp = START + i * 600;
+            policy.add("%d.ts" % timestamp, 100);
+            policy.add("%d.idx" % timestamp, 10);
+        return policy;
+    def test_ignores_other_files(self):
+        policy = RetentionPolicy(tempfile.gettempdir(), 7200);
+        self.assertFalse(policy.add("capture.log", 100));
+        self.assertFalse(policy.add(".sequence.json", 100));
+        self.assertEqual(policy.size, 0);
+    def test_whole_bucket_expires(self):
+        policy = self.policy();
+        names = policy.expire(START + 3600 + 7200 - 1);
+        self.assertEqual(len(names), 12);
+        self.assertEqual(policy.order, [START + 3600, START + 7200]);
+        self.assertEqual(policy.size, 12 * 110);
+    def test_partial_bucket_expires(self):
+        policy = self.policy();
+        names = policy.expire(START + 3600 + 7200 + 1200);
+        self.assertEqual(sorted(names), sorted(["%d.%s" % (START + i * 600, extension)
+            for i in range(9) for extension in ("ts", "idx")]));
+        self.assertEqual(policy.order, [START + 3600, START + 7200]);
+        self.assertEqual(sorted(policy.buckets[START + 3600]), [START + i * 600 for i in range(9, 12)]);
+        self.assertEqual(policy.size, 9 * 110);
+    def test_nothing_expires(self):
+        policy = self.policy();
+        self.assertEqual(policy.expire(START + 7200 - 1), []);
+        self.assertEqual(policy.size, 18 * 110);
+    def test_quota(self):
+        policy = self.policy(max_lifetime = 86400, max_bytes = 1000);
+        names = policy.expire(START + 3 * 3600);
+        # The oldest segments go until the rest fits
+        self.assertEqual(len(names), 2 * 9);
+        self.assertEqual(policy.size, 9 * 110);
+        self.assertFalse(policy.over_quota());
+    def test_needed_bytes(self):
+        policy = self.policy(max_lifetime = 86400);
+        names = policy.expire(START + 3 * 3600, 250);
+        self.assertEqual(len(names), 2 * 3);
+    def test_size_accounting(self):
+        policy = self.policy();
+        # A segment which grew is counted once
+        policy.add("%d.ts" % START, 150);
+        self.assertEqual(policy.size, 18 * 110 + 50);
+        policy.discard("%d.ts" % START);
+        policy.discard("%d.ts" % START);
+        self.assertEqual(policy.size, 18 * 110 - 100);
+        self.assertEqual(policy.expire(START + 3600 + 7200 - 1).count("%d.ts" % START), 0);
+    def test_init_sections(self):
+        policy = self.policy();
+        for timestamp in (START - 600, START + 4200, START + 9000):
+            policy.add("%d.init.mp4" % timestamp, 1000);
+        policy.add("%d.init.mp4" % START, 1000);
+        policy.discard("%d.init.mp4" % START);
+        self.assertEqual(policy.size, 18 * 110 + 3 * 1000);
+        # The first section is still needed by the segments until START + 4200
+        names = policy.expire(START + 3600 + 7200 - 1);
+        self.assertNotIn("%d.init.mp4" % (START - 600), names);
+        names = policy.expire(START + 3600 + 7200 + 600);
+        self.assertIn("%d.init.mp4" % (START - 600), names);
+        self.assertEqual(policy.inits, [START + 4200, START + 9000]);
+        # The newest section stays even without segments
+        names = policy.expire(START + 86400);
+        self.assertEqual(sorted(name for name in names if name.endswith(".init.mp4")), ["%d.init.mp4" % (START + 4200)]);
+        self.assertEqual(policy.inits, [START + 9000]);
+        self.assertEqual(policy.size, 1000);
+
+if __name__ == "__main__":
+    unittest.main();
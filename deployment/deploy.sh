@@ -7,8 +7,10 @@ sudo apt-get install python3-pip
 
 sudo pip3 install flask
 sudo pip3 install flask_cors
+sudo pip3 install gunicorn
 sudo pip3 install pycryptodome
 sudo pip3 install logging
+sudo pip3 install numpy
 
 echo "Creating application folders"
 sudo mkdir -p /opt/data2/ipcam/hls/
@@ -31,10 +33,12 @@ sudo chown www-data:www-data -R /opt/data2/ipcam/hls/
 
 echo "Copying the RTSP stream capture application"
 sudo rsync -rv ../capture/* /opt/data2/ipcam/capture/
+sudo rsync -rv ../common/* /opt/data2/ipcam/capture/
 sudo chown www-data:www-data -R /opt/data2/ipcam/capture/
 
 echo "Copying the RTSP stream capture application"
 sudo rsync -rv ../capture_mpegts/* /opt/data2/ipcam/capture_mpegts/
+sudo rsync -rv ../common/* /opt/data2/ipcam/capture_mpegts/
 sudo chown www-data:www-data -R /opt/data2/ipcam/capture_mpegts/
 
 echo "Copying the web application files"